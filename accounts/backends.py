@@ -1,11 +1,46 @@
 from django.contrib.auth.backends import ModelBackend
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Lower
+
 from .models import CustomUser
 
-class CustomUserBackend(ModelBackend):
+
+# ユーザー名・メールアドレスのどちらでもログインできる認証バックエンド
+class EmailOrUsernameBackend(ModelBackend):
+    """大文字小文字を区別せず、ユーザー名かメールアドレスでユーザーを1クエリで探す
+
+    パスワードのハッシュ計算は候補が見つかっても見つからなくても1回だけ行い、
+    応答時間からユーザーの有無が分からないようにする。
+    """
+
     def authenticate(self, request, username=None, password=None, **kwargs):
-        try:
-            user = CustomUser.objects.get(username=username)
-            if user.check_password(password):
-                return user
-        except CustomUser.DoesNotExist:
+        if username is None:
+            username = kwargs.get(CustomUser.USERNAME_FIELD)
+        if username is None or password is None:
             return None
+
+        user = self.find_user(username)
+        if user is None:
+            # ユーザーがいない場合もハッシュを計算して処理時間を揃える
+            CustomUser().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    def find_user(self, username):
+        """ユーザー名の完全一致 > ユーザー名 > メールアドレスの優先順で1件返す"""
+        value = username.strip()
+        lowered = value.lower()
+        return (
+            CustomUser._default_manager
+            .annotate(username_lower=Lower('username'))
+            .filter(Q(username_lower=lowered) | Q(email_lower=lowered))
+            .annotate(priority=Case(
+                When(username=value, then=Value(0)),
+                When(username_lower=lowered, then=Value(1)),
+                default=Value(2),
+            ))
+            .order_by('priority', 'pk')
+            .first()
+        )
@@ -0,0 +1,49 @@
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def fill_email_lower(apps, schema_editor):
+    # 一意索引を張る前に、大文字小文字違いを含む重複メールアドレスがないか確かめてから埋める
+    CustomUser = apps.get_model('accounts', 'CustomUser')
+    duplicates = list(
+        CustomUser.objects.exclude(email='')
+        .values(lowered=Lower('email'))
+        .annotate(n=Count('pk'))
+        .filter(n__gt=1)
+        .values_list('lowered', flat=True)
+    )
+    if duplicates:
+        raise RuntimeError(
+            'メールアドレスが重複しているユーザーがいます。整理してから再実行してください: '
+            + ', '.join(duplicates)
+        )
+    CustomUser.objects.exclude(email='').update(email_lower=Lower('email'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_customuser_address_customuser_birthday_and_more'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(django.db.models.functions.text.Lower('username'), name='accounts_user_username_ci_idx'),
+        ),
+        # 式や条件付きの一意索引は MySQL で作れないので、小文字にした値の列に普通の一意索引を張る
+        migrations.AddField(
+            model_name='customuser',
+            name='email_lower',
+            field=models.EmailField(blank=True, editable=False, max_length=254, null=True),
+        ),
+        migrations.RunPython(fill_email_lower, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='customuser',
+            name='email_lower',
+            field=models.EmailField(blank=True, editable=False, max_length=254, null=True, unique=True),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.db.models.functions import Lower
 
 
 # カスタムユーザー　有料会員定義
@@ -11,5 +12,20 @@ class CustomUser(AbstractUser):
     phone_number = models.CharField(max_length=15, blank=True)
     birthday = models.DateField(null=True, blank=True)
     job = models.CharField(max_length=50, blank=True)
+    # ログインでメールアドレスを大文字小文字を区別せずに引くため、小文字にした値を一意の列で持つ
+    # （MySQL は式や条件付きの一意索引を作れないので普通の列にする。未設定は NULL で重複を許す）
+    email_lower = models.EmailField(max_length=254, null=True, blank=True, unique=True, editable=False)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(Lower('username'), name='accounts_user_username_ci_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.email_lower = self.email.lower() if self.email else None
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'email_lower'}
+        super().save(*args, **kwargs)
 
 
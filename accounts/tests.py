@@ -1,3 +1,39 @@
+from django.contrib.auth import authenticate
+from django.db import IntegrityError
 from django.test import TestCase
 
-# Create your tests here.
+from .models import CustomUser
+
+
+# ユーザー名・メールアドレスでのログイン
+class EmailOrUsernameBackendTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('Taro', 'Taro.Nagoya@Example.com', 'password')
+
+    def test_username_login(self):
+        self.assertEqual(authenticate(username='Taro', password='password'), self.user)
+        self.assertEqual(authenticate(username='taro', password='password'), self.user)
+
+    def test_email_login_ignores_case(self):
+        self.assertEqual(authenticate(username='taro.nagoya@example.com', password='password'), self.user)
+        self.assertEqual(authenticate(username=' TARO.NAGOYA@EXAMPLE.COM ', password='password'), self.user)
+
+    def test_wrong_password(self):
+        self.assertIsNone(authenticate(username='Taro', password='wrong'))
+        self.assertIsNone(authenticate(username='nobody@example.com', password='password'))
+
+    def test_inactive_user(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(authenticate(username='taro.nagoya@example.com', password='password'))
+
+    def test_email_is_unique_ignoring_case(self):
+        CustomUser.objects.create_user('hanako', '', 'password')
+        CustomUser.objects.create_user('jiro', '', 'password')
+        with self.assertRaises(IntegrityError):
+            CustomUser.objects.create_user('taro2', 'taro.nagoya@example.com', 'password')
+
+    def test_email_change_updates_lookup_column(self):
+        self.user.email = 'New@Example.com'
+        self.user.save(update_fields=['email'])
+        self.assertEqual(authenticate(username='new@example.com', password='password'), self.user)
@@ -30,6 +30,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'userapp.middleware.QueryBudgetMiddleware',  # クエリ数の計測（QUERY_BUDGET_ENABLED で有効化）
 ]
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
@@ -106,22 +107,87 @@ LOGIN_REDIRECT_URL = 'userapp:index'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# キャッシュ設定（複数プロセス・複数台で動かす場合は Redis や Memcached などの共有キャッシュにする）
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# 店舗検索の設定
+SEARCH_PAGE_SIZE = 10  # 1ページの表示件数
+SEARCH_MAX_RESULTS = 1000  # キャッシュする検索結果の最大件数
+SEARCH_CACHE_ALIAS = 'default'  # 検索結果を保存するキャッシュ
+SEARCH_CACHE_TIMEOUT = 300  # 検索結果のキャッシュ有効期間（秒）
+
+# 空き状況（userapp/availability.py）
+AVAILABILITY_HOURS = ('11:00', '23:00')  # 時間帯を指定しないときに返す範囲
+AVAILABILITY_MAX_SHOPS = 50  # 1回に問い合わせできる店舗数
+AVAILABILITY_MAX_DAYS = 14  # 1回に問い合わせできる日数
+AVAILABILITY_CACHE_TIMEOUT = 300  # 店舗・日ごとの枠の残り席数のキャッシュ有効期間（秒）
+
+# 近くの店舗の検索（userapp/geo.py）
+GEO_CELL_DEGREES = 0.01  # グリッドのセルの大きさ（度）。変えたら geocode_shops --cells を実行する
+GEO_MAX_RADIUS = 5000  # 1回に探せる範囲（メートル）
+
+# 似ている店舗（userapp/similar.py）。変えたら refresh_similar_shops --all を実行する
+SIMILAR_SHOPS_COUNT = 10  # 店舗ごとに保存する件数
+SIMILAR_SHOPS_SHRINK = 5  # 共通のユーザーが少ない組の類似度を割り引く強さ
+SIMILAR_SHOPS_MAX_USER_ITEMS = 500  # これより多くの店舗に付けているユーザーは計算に使わない
+
+# 管理画面の一覧で、絞り込みがなく推定行数がこれ以上の表は件数を数えない（userapp/paginators.py）
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 10000
+
+# 書き出し（userapp/export.py）で1回に読む行数
+EXPORT_CHUNK_SIZE = 2000
+
+# 有料会員かどうかの判定結果をキャッシュする時間（秒）
+MEMBERSHIP_CACHE_TIMEOUT = 60
+
 # Stripe settings
 STRIPE_SECRET_KEY = 'sk_test_51PegsNHgh7sLH8myPovEAkC4vKrXmAMecdKrBbaW7tS4tKWH0ATCpAjz0HS5Qdbc5lnH1Zu5WHI4quuQCYTsx4fF0033T7zJoP'
 STRIPE_PUBLISHABLE_KEY = 'pk_test_51PegsNHgh7sLH8myw7KsXeXiADJWvP4d7hfco1kOfb1hTxeEZw8f4PdgXNxhri368KMNGeu3AehTuWBP6reIdH0i00JjXSkETX'
 STRIPE_PRICE_ID = 'price_1PehRdHgh7sLH8myyNDfnci9'
 
+# Stripe API の呼び出しはアウトボックスに登録し、process_stripe_outbox コマンドで実行する
+STRIPE_CLIENT = 'userapp.stripe_outbox.StripeClient'  # テストでは userapp.stripe_outbox.FakeStripeClient
+STRIPE_OUTBOX_MAX_ATTEMPTS = 8
+STRIPE_OUTBOX_BACKOFF = 2  # 秒（失敗のたびに倍にする）
+STRIPE_OUTBOX_BACKOFF_MAX = 600
+STRIPE_OUTBOX_BATCH_SIZE = 20
+STRIPE_OUTBOX_LOCK_TIMEOUT = 300  # 処理中のまま止まった処理を取り直すまでの秒数
+
+# Stripe Webhook（受信したイベントは process_stripe_events コマンドでまとめて反映する）
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')  # 未設定の間は Webhook を受け付けない（503）
+STRIPE_WEBHOOK_TOLERANCE = 300  # 署名のタイムスタンプの許容秒数
+STRIPE_EVENT_BATCH_SIZE = 100
+
+# Stripe API の接続（userapp/stripe_gateway.py）
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')  # 例: http://localhost:12111（run_stripe_stub / stripe-mock）
+STRIPE_TIMEOUTS = {  # (接続, 読み取り) 秒
+    'default': (3.05, 10),
+    'create_subscription': (3.05, 20),
+}
+STRIPE_MAX_NETWORK_RETRIES = 2
+STRIPE_BREAKER_THRESHOLD = 5  # 連続でこの回数失敗したら呼び出しを止める
+STRIPE_BREAKER_RESET_TIMEOUT = 30  # 止めてから再び試すまでの秒数
+
 # Custom authentication backend
 AUTHENTICATION_BACKENDS = [
-    'django.contrib.auth.backends.ModelBackend',  # 既存の認証バックエンド
-    'userapp.backends.EmailBackend',  # 新しいメールアドレス認証バックエンド
-    'accounts.backends.CustomUserBackend',  # カスタム認証バックエンドを使用
+    # ユーザー名・メールアドレスを1クエリで引き、ハッシュ計算は1回だけにする
+    'accounts.backends.EmailOrUsernameBackend',
 ]
 
 AUTH_USER_MODEL = 'accounts.CustomUser'
 
 # メール設定
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# メールはキューに保存してすぐ返し、send_queued_email コマンドが QUEUED_EMAIL_BACKEND で送る
+EMAIL_BACKEND = 'userapp.mail.QueuedEmailBackend'
+QUEUED_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+QUEUED_EMAIL_BATCH_SIZE = 50
+QUEUED_EMAIL_MAX_ATTEMPTS = 5
+QUEUED_EMAIL_BACKOFF = 30  # 秒（失敗のたびに倍にする）
+QUEUED_EMAIL_LOCK_TIMEOUT = 300  # 送信中のまま止まったメールを取り直すまでの秒数
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
@@ -131,7 +197,17 @@ DEFAULT_FROM_EMAIL = EMAIL_HOST_USER  # メール送信元アドレス
 
 # ローカル開発時はメール送信をコンソールに出力する設定
 if DEBUG:
-    EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    QUEUED_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+# リクエストごとのクエリ数の計測（有効にするとレスポンスヘッダとログにクエリ数・DB時間を出す）
+QUERY_BUDGET_ENABLED = False
+QUERY_BUDGET_DEFAULT = 20  # URL名ごとの指定がない場合のクエリ数の上限
+QUERY_BUDGET_REPEAT_THRESHOLD = 5  # 同じ形のSQLがこの回数以上ならN+1として警告
+QUERY_BUDGETS = {
+    'userapp:shop_info': 8,
+    'userapp:favorites': 6,
+    'userapp:reservations': 6,
+}
 
 # SQLログ出力のためのLOGGING設定
 LOGGING = {
@@ -148,5 +224,13 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'DEBUG',
         },
+        'userapp.middleware': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'userapp.stripe_gateway': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
@@ -3,7 +3,40 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth import get_user_model
 # 管理画面に登録するモデルをインポート
-from .models import Category, Review, Shop, Subscription, Profile
+from .models import Category, Review, Shop, Subscription, Profile, Reservation, StripeOperation
+from . import export, search, stripe_outbox
+from .paginators import EstimatedCountPaginator
+
+# 一覧で絞り込んだ行を書き出すアクション（行は送りながら読むので件数が多くてもよい）
+@admin.action(description='選択した行をCSVで書き出す', permissions=['view'])
+def export_csv(modeladmin, request, queryset):
+    return export.streaming_response(queryset, 'csv')
+
+@admin.action(description='選択した行をJSONLで書き出す', permissions=['view'])
+def export_jsonl(modeladmin, request, queryset):
+    return export.streaming_response(queryset, 'jsonl')
+
+# 営業時間を解析できなかった店舗の絞り込み（手で直す対象）
+class OpeningHoursErrorFilter(admin.SimpleListFilter):
+    title = '営業時間の解析'
+    parameter_name = 'opening_hours_error'
+
+    def lookups(self, request, model_admin):
+        return (('error', '解析できない'), ('ok', '解析済み'))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'error':
+            return queryset.exclude(opening_hours_error='')
+        if self.value() == 'ok':
+            return queryset.filter(opening_hours_error='')
+        return queryset
+
+# 行数の多い表でも一覧が重くならないようにする共通設定
+class ScalableModelAdmin(admin.ModelAdmin):
+    # 絞り込みのない一覧では件数を推定値にする
+    paginator = EstimatedCountPaginator
+    # 絞り込み時に「全○件」を出すための表全体の COUNT(*) を省く
+    show_full_result_count = False
 
 # カテゴリモデルの管理画面設定
 @admin.register(Category)
@@ -19,44 +52,95 @@ class CategoryAdmin(admin.ModelAdmin):
 
 # レビューモデルの管理画面設定
 @admin.register(Review)
-class ReviewAdmin(admin.ModelAdmin):
+class ReviewAdmin(ScalableModelAdmin):
     # 一覧表示の際に表示するフィールド
     list_display = ('shop', 'user', 'score')
+    # 一覧で表示する店舗・ユーザーを1クエリで読む
+    list_select_related = ('shop', 'user')
+    # 店舗・ユーザーは全件の選択肢を描画せず検索して選ぶ
+    autocomplete_fields = ('shop', 'user')
     # 詳細編集画面へのリンクを設定するフィールド
     list_display_links = ('shop',)
     # 一覧画面で編集可能にするフィールド
     list_editable = ('score',)
+    # 投稿日で期間を絞り込む（date_hierarchy は年月の一覧を作るのに全件を走査するので使わない）
+    list_filter = (('created_at', admin.DateFieldListFilter),)
+    # 書き出し
+    actions = (export_csv, export_jsonl)
+
+# 予約モデルの管理画面設定
+@admin.register(Reservation)
+class ReservationAdmin(ScalableModelAdmin):
+    # 一覧表示の際に表示するフィールド
+    list_display = ('shop', 'user', 'date_time', 'num_people')
+    list_select_related = ('shop', 'user')
+    autocomplete_fields = ('shop', 'user')
+    # 予約日時で期間を絞り込む
+    list_filter = (('date_time', admin.DateFieldListFilter),)
+    # 書き出し
+    actions = (export_csv, export_jsonl)
 
 # 店舗モデルの管理画面設定
 @admin.register(Shop)
-class ShopAdmin(admin.ModelAdmin):
+class ShopAdmin(ScalableModelAdmin):
     # 一覧表示の際に表示するフィールド
     list_display = ('name', 'category', 'address', 'price_range', 'region')
-    # 検索可能なフィールド（地域、予算、評価を含む）
-    search_fields = ('name', 'address', 'price_range', 'region', 'category__name')
+    list_select_related = ('category',)
+    # 検索は店舗名・カテゴリ名・住所・紹介文の検索インデックスを使う（get_search_results）
+    search_fields = ('name',)
     # フィルター可能なフィールド（地域、予算、評価を追加）
-    list_filter = ('category', 'region', 'price_range')
+    list_filter = ('category', 'region', 'price_range', OpeningHoursErrorFilter)
+    autocomplete_fields = ('category',)
+    # 営業時間を解析できなかった理由（営業時間・定休日を直して保存すると解析し直す）
+    readonly_fields = ('opening_hours_error',)
+
+    def get_search_results(self, request, queryset, search_term):
+        # LIKE '%...%' による全件走査とカテゴリの JOIN を避け、フリーワード検索と同じインデックスで引く
+        # （一致する店舗はすべて出す。適合度の上位だけに絞らない）
+        if not search.parse_query(search_term):
+            return queryset, False
+        return search.filter_matching(queryset, search_term), False
 
 # サブスクリプションモデルの管理画面設定
 @admin.register(Subscription)
-class SubscriptionAdmin(admin.ModelAdmin):
+class SubscriptionAdmin(ScalableModelAdmin):
     # 一覧表示の際に表示するフィールド
     list_display = ('user', 'stripe_customer_id', 'stripe_subscription_id', 'active')
+    list_select_related = ('user',)
+    autocomplete_fields = ('user',)
     # 詳細編集画面へのリンクを設定するフィールド
     list_display_links = ('user',)
     # 一覧画面で編集可能にするフィールド
     list_editable = ('active',)
+    # 書き出し
+    actions = (export_csv, export_jsonl)
 
 # プロフィールモデルの管理画面設定
 @admin.register(Profile)
-class ProfileAdmin(admin.ModelAdmin):
+class ProfileAdmin(ScalableModelAdmin):
     # 一覧表示の際に表示するフィールド
     list_display = ('user', 'user_type', 'username_kana', 'post_code', 'address', 'tel', 'birth_date', 'business')
+    list_select_related = ('user',)
+    autocomplete_fields = ('user',)
     # 検索可能なフィールド
     search_fields = ('user__username', 'user__email', 'username_kana', 'post_code', 'address', 'tel', 'business')
     # フィルター可能なフィールド
     list_filter = ('user_type',)
 
+# Stripe の処理（アウトボックス）の管理画面設定。失敗したまま止まった処理を確認して再実行する
+@admin.action(description='選択した失敗の処理を再実行する')
+def retry_operations(modeladmin, request, queryset):
+    count = stripe_outbox.retry(queryset)
+    modeladmin.message_user(request, f'{count}件の処理を再実行待ちにしました。')
+
+@admin.register(StripeOperation)
+class StripeOperationAdmin(ScalableModelAdmin):
+    list_display = ('operation', 'user', 'status', 'attempts', 'last_error', 'created_at', 'updated_at')
+    list_select_related = ('user',)
+    list_filter = ('status', 'operation')
+    readonly_fields = ('operation', 'user', 'payload', 'idempotency_key', 'attempts', 'result', 'last_error')
+    actions = [retry_operations]
+
 # カスタムユーザーモデルの管理画面設定
 User = get_user_model()
 
@@ -67,6 +151,8 @@ class ProfileInline(admin.StackedInline):
 
 class UserAdmin(BaseUserAdmin):
     inlines = (ProfileInline,)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 # カスタムユーザーモデルの登録（すでに登録されている場合は再登録しない）
 try:
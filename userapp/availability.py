@@ -0,0 +1,106 @@
+"""予約の空き状況
+
+複数の店舗・複数日の空き席数を、予約枠 ReservationSlot の「席数 - 予約済みの席数」から
+1回のクエリで求める（ReservationSlot の (shop, start) の一意制約のインデックスを使う）。
+予約の受付（booking.book）と同じ値を読むので、表示と受付の判定が食い違わない。
+まだ行のない枠は予約がないので、店舗の席数がそのまま残り席数になる。
+枠ごとの残り席数は店舗・日ごとにキャッシュし、その日の予約が作成・削除されたら破棄する。
+店舗の席数を変えるとこれからの枠の席数も変わるので、キャッシュには読んだときの席数も入れておき、
+読み出した店舗の席数と違えば読み直す（破棄のときに店舗を読まなくてよいよう、キーには含めない）。
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .booking import slot_start
+from .models import ReservationSlot, Shop
+
+
+def cache_key(shop_id, day):
+    return f'availability:{shop_id}:{day.isoformat()}'
+
+
+def invalidate(shop_id, date_time):
+    cache.delete(cache_key(shop_id, timezone.localtime(date_time).date()))
+
+
+def local_datetime(day, at):
+    return timezone.make_aware(datetime.combine(day, at))
+
+
+def default_hours():
+    start, end = getattr(settings, 'AVAILABILITY_HOURS', ('11:00', '23:00'))
+    return time.fromisoformat(start), time.fromisoformat(end)
+
+
+def remaining_seats(shops, days):
+    """{(店舗ID, 日付): {枠の開始時刻 'HH:MM': 残り席数}} を返す（キャッシュにない分は1クエリで読む）"""
+    capacities = {shop.pk: shop.capacity for shop in shops}
+    keys = {cache_key(shop.pk, day): (shop.pk, day) for shop in shops for day in days}
+    result = {}
+    for key, (capacity, remaining) in cache.get_many(list(keys)).items():
+        # 席数が変わる前に読んだ分は使わない
+        if capacity == capacities[keys[key][0]]:
+            result[keys[key]] = remaining
+    missing = [value for value in keys.values() if value not in result]
+    if not missing:
+        return result
+
+    loaded = {key: {} for key in missing}
+    missing_days = [day for _, day in missing]
+    rows = (
+        ReservationSlot.objects.filter(
+            shop_id__in={shop_id for shop_id, _ in missing},
+            start__gte=local_datetime(min(missing_days), time.min),
+            start__lt=local_datetime(max(missing_days) + timedelta(days=1), time.min),
+        )
+        .values_list('shop_id', 'start', 'capacity', 'booked')
+        .order_by()
+    )
+    for shop_id, start, capacity, booked in rows:
+        local = timezone.localtime(start)
+        remaining = loaded.get((shop_id, local.date()))
+        if remaining is not None:
+            remaining[local.strftime('%H:%M')] = max(0, capacity - booked)
+    cache.set_many(
+        {cache_key(shop_id, day): (capacities[shop_id], remaining) for (shop_id, day), remaining in loaded.items()},
+        getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 300),
+    )
+    result.update(loaded)
+    return result
+
+
+def slot_starts(shop, day, start_time, end_time):
+    """day の start_time から end_time までに始まる枠の開始日時"""
+    current = slot_start(shop, local_datetime(day, start_time))
+    end = local_datetime(day, end_time)
+    step = timedelta(minutes=shop.slot_minutes)
+    while current < end:
+        yield current
+        current += step
+
+
+def get_availability(shop_ids, date_from, date_to, start_time=None, end_time=None):
+    """店舗ごとの、期間内の各枠の残り席数 {店舗: [(枠の開始日時, 残り席数), ...]}
+
+    開始済みの枠は含めない。時間帯を省略すると AVAILABILITY_HOURS を使う。
+    """
+    if start_time is None or end_time is None:
+        start_time, end_time = default_hours()
+    shops = list(Shop.objects.filter(pk__in=shop_ids).only('pk', 'name', 'capacity', 'slot_minutes').order_by('pk'))
+    days = [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+    remaining = remaining_seats(shops, days)
+    now = timezone.now()
+
+    result = {}
+    for shop in shops:
+        slots = []
+        for day in days:
+            per_slot = remaining[(shop.pk, day)]
+            for start in slot_starts(shop, day, start_time, end_time):
+                if start >= now:
+                    slots.append((start, per_slot.get(start.strftime('%H:%M'), shop.capacity)))
+        result[shop] = slots
+    return result
@@ -0,0 +1,21 @@
+"""大きな表を少しずつ読む
+
+主キー順に chunk_size 件ずつ「前のチャンクの最後のIDより後」を取り直していく
+（キーセット方式）。OFFSET のように読み飛ばす行が増えず、件数が増えてもメモリ使用量は
+一定で、読んでいる間トランザクションやサーバー側カーソルを開いたままにしない。
+書き出し（export.py）と似ている店舗の計算（similar.py）で使う。
+"""
+
+
+def iter_rows(queryset, columns, chunk_size=2000):
+    """主キー順に chunk_size 件ずつ読み、列の値のタプルを返す"""
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list('pk', *columns)[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        last_pk = rows[-1][0]
@@ -0,0 +1,61 @@
+"""予約枠の席数管理
+
+予約は店舗ごとの時間枠（Shop.slot_minutes 分単位）に割り当て、枠の
+予約済み席数を「席数を超えない場合だけ加算する」条件付き UPDATE で増やす。
+行単位の1文で判定と加算を行うので、同時に予約が来ても席数を超えず、
+テーブル全体をロックする必要もない。
+"""
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, IntegerField
+from django.utils import timezone
+
+from .models import Reservation, ReservationSlot
+
+
+class SlotFullError(Exception):
+    """予約枠に空きがない"""
+
+
+def slot_start(shop, date_time):
+    """予約日時が含まれる枠の開始日時（店舗の現地時刻で区切る）"""
+    local = timezone.localtime(date_time)
+    minutes = (local.hour * 60 + local.minute) // shop.slot_minutes * shop.slot_minutes
+    return local.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+
+
+def get_slot(shop, start):
+    slot, _ = ReservationSlot.objects.get_or_create(shop=shop, start=start, defaults={'capacity': shop.capacity})
+    return slot
+
+
+def book(shop, user, date_time, num_people):
+    """空きがあれば予約を作成する。満席なら SlotFullError を送出する"""
+    if num_people < 1 or num_people > shop.capacity:
+        raise SlotFullError
+    with transaction.atomic():
+        slot = get_slot(shop, slot_start(shop, date_time))
+        # capacity - num_people は MySQL の符号なし整数の列では負にできずエラーになるので、加算の側で比べる
+        reserved = ReservationSlot.objects.annotate(
+            booked_after=ExpressionWrapper(F('booked') + num_people, output_field=IntegerField()),
+        ).filter(pk=slot.pk, booked_after__lte=F('capacity')).update(booked=F('booked') + num_people)
+        if not reserved:
+            raise SlotFullError
+        return Reservation.objects.create(
+            shop=shop, user=user, date_time=date_time, num_people=num_people, slot=slot,
+        )
+
+
+def sync_capacity(shop):
+    """店舗の席数の変更をこれからの枠に反映する"""
+    ReservationSlot.objects.filter(shop=shop, start__gte=timezone.now()).exclude(
+        capacity=shop.capacity,
+    ).update(capacity=shop.capacity)
+
+
+def release(reservation):
+    """予約の席を枠に戻す（予約の削除時にシグナルから呼ぶ）"""
+    if reservation.slot_id is None:
+        return
+    ReservationSlot.objects.filter(pk=reservation.slot_id, booked__gte=reservation.num_people).update(
+        booked=F('booked') - reservation.num_people,
+    )
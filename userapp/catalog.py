@@ -0,0 +1,54 @@
+"""カテゴリ一覧のプロセス内キャッシュ
+
+カテゴリはほとんど変わらないので、一覧はプロセスごとに保持し、共有キャッシュの
+バージョンキーと照合して変更があったときだけ読み直す。定常状態ではDBに問い合わせない。
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import Category
+
+VERSION_KEY = 'category_catalog:version'
+
+_lock = threading.Lock()
+_catalog = (None, [])  # (バージョン, カテゴリ一覧)
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version(**kwargs):
+    """カテゴリの変更時に呼び、各プロセスの一覧を読み直させる"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def get_categories():
+    """カテゴリの一覧（category_l 順）を返す。返した一覧は変更しないこと"""
+    global _catalog
+    version = get_version()
+    cached_version, categories = _catalog
+    if cached_version != version:
+        with _lock:
+            cached_version, categories = _catalog
+            if cached_version != version:
+                categories = list(Category.objects.order_by('category_l', 'pk'))
+                _catalog = (version, categories)
+    return categories
+
+
+def get_category(pk):
+    """IDからカテゴリを引く（見つからなければ None）"""
+    for category in get_categories():
+        if str(category.pk) == str(pk):
+            return category
+    return None
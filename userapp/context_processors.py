@@ -1,9 +1,14 @@
-from .models import Category
+from functools import partial
+
+from .catalog import get_categories
+from .membership import is_paid_member
 
 def common(request):
     """テンプレートに毎回渡すデータ"""
     context = {
-        'category_list': Category.objects.all().order_by('category_l'),
+        'category_list': get_categories(),
+        # テンプレートで参照されたときだけ判定する
+        'is_paid_member': partial(is_paid_member, request.user),
     }
 
     return context
@@ -0,0 +1,127 @@
+"""レビュー・予約・サブスクリプションの書き出し（CSV・JSONL）
+
+管理画面のアクションと export_data コマンドで使う。必要な列だけを values_list で
+読み、主キー順に EXPORT_CHUNK_SIZE 件ずつ取り直していく（batching.iter_rows）ので、
+件数が増えてもメモリ使用量は一定で、書き出しの間トランザクションやサーバー側カーソルを
+開いたままにしない。CSV では、表計算ソフトで数式として実行されないよう、
+=・+・-・@ などで始まる文字列の先頭に ' を付ける。
+"""
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .batching import iter_rows
+from .models import Reservation, Review, Subscription
+
+
+class Dataset:
+    def __init__(self, model, columns, date_field=None):
+        self.model = model
+        self.columns = columns
+        self.date_field = date_field  # 期間で絞り込む列（なければ絞り込めない）
+
+
+DATASETS = {
+    'reviews': Dataset(
+        Review,
+        ['id', 'shop_id', 'shop__name', 'user_id', 'user__username', 'score', 'comment', 'created_at', 'updated_at'],
+        'created_at',
+    ),
+    'reservations': Dataset(
+        Reservation,
+        ['id', 'shop_id', 'shop__name', 'user_id', 'user__username', 'date_time', 'num_people'],
+        'date_time',
+    ),
+    'subscriptions': Dataset(
+        Subscription,
+        ['id', 'user_id', 'user__username', 'user__email', 'stripe_customer_id', 'stripe_subscription_id', 'active'],
+    ),
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def dataset_for(model):
+    for name, dataset in DATASETS.items():
+        if dataset.model is model:
+            return name, dataset
+    raise LookupError(model)
+
+
+def filter_dates(dataset, queryset, since=None, until=None):
+    """since・until（日付、両端を含む）で絞り込む"""
+    if since is None and until is None:
+        return queryset
+    if dataset.date_field is None:
+        raise ValueError(f'{dataset.model.__name__} は期間で絞り込めません')
+    if since is not None:
+        queryset = queryset.filter(**{
+            f'{dataset.date_field}__gte': timezone.make_aware(datetime.combine(since, time.min)),
+        })
+    if until is not None:
+        queryset = queryset.filter(**{
+            f'{dataset.date_field}__lt': timezone.make_aware(datetime.combine(until + timedelta(days=1), time.min)),
+        })
+    return queryset
+
+
+# 表計算ソフトが数式として解釈する先頭の文字（タブ・改行の後ろに数式を置くものも含める）
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat()
+    return value
+
+
+def csv_value(value):
+    """CSV のセルの値（レビュー本文などの文字列は数式として実行されないようにする）"""
+    value = format_value(value)
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class Echo:
+    """csv.writer の書き込み先（書いた行をそのまま返す）"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(columns, rows, bom=False):
+    writer = csv.writer(Echo())
+    if bom:
+        # Excel で開いても文字化けしないようにする
+        yield '\ufeff'
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([csv_value(value) for value in row])
+
+
+def jsonl_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, map(format_value, row))), ensure_ascii=False) + '\n'
+
+
+def lines(dataset, queryset, fmt, chunk_size=None, bom=False):
+    rows = iter_rows(queryset, dataset.columns, chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000))
+    if fmt == 'csv':
+        return csv_lines(dataset.columns, rows, bom=bom)
+    return jsonl_lines(dataset.columns, rows)
+
+
+def streaming_response(queryset, fmt):
+    """queryset を書き出すダウンロードのレスポンス（行は送りながら読む）"""
+    name, dataset = dataset_for(queryset.model)
+    response = StreamingHttpResponse(lines(dataset, queryset, fmt, bom=fmt == 'csv'), content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{name}-{timezone.localdate():%Y%m%d}.{fmt}"'
+    return response
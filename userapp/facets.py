@@ -0,0 +1,136 @@
+"""検索結果の絞り込み候補ごとの件数（ファセット）
+
+カテゴリ・地域・価格帯・評価の組み合わせごとの件数を1回のGROUP BYで取得し、
+各ファセットの件数はPythonで集計する。あるファセットの件数は、そのファセット
+以外の選択中の条件だけを適用して数える（選択を切り替えたときの件数になる）。
+"""
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from django.db.models import Count
+from django.db.models.functions import Floor
+
+from . import search_query
+from .forms import PRICE_CHOICES, REGION_CHOICES, SCORE_CHOICES
+from .catalog import get_categories
+
+FACET_FIELDS = ('selected_category', 'region', 'price_range', 'rating')
+
+FACET_LABELS = {
+    'selected_category': '業態',
+    'region': '地域',
+    'price_range': '価格帯',
+    'rating': '評価',
+}
+
+# ファセットの対象外の条件（これだけで絞り込んだ結果を集計の母集団にする）
+BASE_FIELDS = ('freeword', 'open_at')
+
+
+def _price_bands():
+    bands = []
+    for value, _ in PRICE_CHOICES:
+        low, high = value.split('-')
+        bands.append((value, int(low), int(high) if high else None))
+    return bands
+
+
+def price_band(budget):
+    """予算額が含まれる価格帯の選択値を返す"""
+    if budget is None:
+        return None
+    for value, low, high in _price_bands():
+        if budget >= low and (high is None or budget <= high):
+            return value
+    return None
+
+
+def rating_band(avg_floor):
+    """平均評価の整数部を評価の選択値にする（レビューなしは対象外）"""
+    if not avg_floor:
+        return None
+    return str(int(avg_floor))
+
+
+def build_cube(base_params):
+    """ファセットの値の組み合わせごとの件数を1クエリで取得する"""
+    query = search_query.filter_shops(base_params)
+    rows = (
+        query.order_by()
+        .annotate(rating_floor=Floor('avg_score'))
+        .values('category_id', 'region', 'min_budget', 'rating_floor')
+        .annotate(n=Count('pk'))
+    )
+    cube = defaultdict(int)
+    for row in rows:
+        key = (
+            str(row['category_id']),
+            row['region'] or '',
+            price_band(row['min_budget']),
+            rating_band(row['rating_floor']),
+        )
+        cube[key] += row['n']
+    category_ids = {key[0] for key in cube}
+    return {
+        'cells': list(cube.items()),
+        'categories': {str(c.pk): c.name for c in get_categories() if str(c.pk) in category_ids},
+    }
+
+
+def get_cube(base_params):
+    cache = search_query.get_cache()
+    key = search_query.cache_key('facets', base_params)
+    cube = cache.get(key)
+    if cube is None:
+        cube = build_cube(base_params)
+        cache.set(key, cube, search_query.cache_timeout())
+    return cube
+
+
+def _matches(field, cell_value, selected):
+    if field == 'region':
+        # 検索と同じく部分一致
+        return selected in cell_value
+    return cell_value == selected
+
+
+def facet_counts(params):
+    """選択中の条件に対する各ファセットの件数を返す"""
+    base_params = {k: v for k, v in params.items() if k in BASE_FIELDS}
+    cube = get_cube(base_params)
+    counts = {field: defaultdict(int) for field in FACET_FIELDS}
+    for key, n in cube['cells']:
+        cell = dict(zip(FACET_FIELDS, key))
+        for field in FACET_FIELDS:
+            others = (f for f in FACET_FIELDS if f != field and f in params)
+            if all(_matches(f, cell[f], params[f]) for f in others):
+                counts[field][cell[field]] += n
+    return counts, cube['categories']
+
+
+def build_facets(params):
+    """テンプレートで表示するファセットの一覧を返す"""
+    counts, categories = facet_counts(params)
+    choices = {
+        'selected_category': sorted(categories.items(), key=lambda item: int(item[0])),
+        'region': REGION_CHOICES,
+        'price_range': PRICE_CHOICES,
+        'rating': [(str(value), label) for value, label in reversed(SCORE_CHOICES)],
+    }
+    facets = []
+    for field in FACET_FIELDS:
+        options = []
+        for value, label in choices[field]:
+            if field == 'region':
+                count = sum(n for v, n in counts[field].items() if value in v)
+            else:
+                count = counts[field].get(value, 0)
+            options.append({
+                'value': value,
+                'label': label,
+                'count': count,
+                'selected': params.get(field) == value,
+                'query': urlencode(dict(params, **{field: value})),
+            })
+        facets.append({'field': field, 'label': FACET_LABELS[field], 'options': options})
+    return facets
@@ -1,4 +1,7 @@
 from django import forms
+from django.forms.models import ModelChoiceIterator
+from . import hours
+from .catalog import get_categories, get_category
 from .models import Category, Review, Reservation
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm, UserChangeForm
 from django.conf import settings
@@ -27,8 +30,37 @@ REGION_CHOICES = [
     ('中区', '中区'),
 ]
 
+class CachedCategoryIterator(ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for category in get_categories():
+            yield self.choice(category)
+
+    def __len__(self):
+        return len(get_categories()) + (1 if self.field.empty_label is not None else 0)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(get_categories())
+
+# カテゴリの選択肢と入力チェックをキャッシュ済みの一覧で行う（DBに問い合わせない）
+class CategoryChoiceField(forms.ModelChoiceField):
+    iterator = CachedCategoryIterator
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        category = get_category(value)
+        if category is None:
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+        return category
+
 class SearchForm(forms.Form):
-    selected_category = forms.ModelChoiceField(
+    selected_category = CategoryChoiceField(
         label='業態',
         required=False,
         queryset=Category.objects.all(),
@@ -61,6 +93,16 @@ class SearchForm(forms.Form):
         self.fields['price_range'].widget.attrs.update({'class': 'form-control'})
         self.fields['rating'].widget.attrs.update({'class': 'form-control'})
 
+def clean_unique_email(email, user=None):
+    """ほかのユーザーが大文字小文字違いも含めて使っているメールアドレスならエラーにする"""
+    if email:
+        others = User.objects.filter(email_lower=email.lower())
+        if user is not None and user.pk is not None:
+            others = others.exclude(pk=user.pk)
+        if others.exists():
+            raise forms.ValidationError('このメールアドレスは既に登録されています。')
+    return email
+
 class SignUpForm(UserCreationForm):
     class Meta:
         model = User
@@ -72,6 +114,10 @@ class SignUpForm(UserCreationForm):
             field.widget.attrs['class'] = 'form-control'
             field.widget.attrs['placeholder'] = field.label
 
+    def clean_email(self):
+        # メールアドレスでもログインするため、大文字小文字を区別せず重複を禁止する
+        return clean_unique_email(self.cleaned_data.get('email'))
+
 class EmailLoginForm(AuthenticationForm):
     username = forms.EmailField(label='Email', max_length=254)
 
@@ -97,8 +143,77 @@ class ReservationForm(forms.ModelForm):
         fields = ['date_time', 'num_people', 'shop']  # datetimeと人数を追加
         widgets = {
             'date_time': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
+            'shop': forms.HiddenInput(),  # 全店舗の選択肢を描画しないよう隠しフィールドにする
         }
 
+    def clean_num_people(self):
+        num_people = self.cleaned_data['num_people']
+        if num_people < 1:
+            raise forms.ValidationError('人数は1人以上で入力してください。')
+        return num_people
+
+# 空き状況の検索条件（?shops=1,2,3&date_from=2026-10-23&date_to=2026-10-24&people=4&start=17:00&end=21:00）
+class AvailabilityForm(forms.Form):
+    shops = forms.CharField()
+    date_from = forms.DateField()
+    date_to = forms.DateField(required=False)
+    people = forms.IntegerField(min_value=1, required=False)
+    start = forms.TimeField(required=False)
+    end = forms.TimeField(required=False)
+
+    def clean_shops(self):
+        try:
+            shop_ids = sorted({int(value) for value in self.cleaned_data['shops'].split(',') if value.strip()})
+        except ValueError:
+            raise forms.ValidationError('店舗IDはカンマ区切りの数値で指定してください。')
+        max_shops = getattr(settings, 'AVAILABILITY_MAX_SHOPS', 50)
+        if not shop_ids or len(shop_ids) > max_shops:
+            raise forms.ValidationError(f'店舗は1〜{max_shops}件で指定してください。')
+        return shop_ids
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        if date_from is None:
+            return cleaned_data
+        date_to = cleaned_data.get('date_to') or date_from
+        max_days = getattr(settings, 'AVAILABILITY_MAX_DAYS', 14)
+        if date_to < date_from or (date_to - date_from).days >= max_days:
+            raise forms.ValidationError(f'期間は{max_days}日以内で指定してください。')
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if (start is None) != (end is None) or (start is not None and start >= end):
+            raise forms.ValidationError('時間帯は開始と終了を指定してください。')
+        cleaned_data['date_to'] = date_to
+        cleaned_data['people'] = cleaned_data.get('people') or 1
+        return cleaned_data
+
+# 近くの店舗の検索条件（?lat=35.17&lng=136.90&radius=1000）
+class NearbyForm(forms.Form):
+    lat = forms.FloatField(min_value=-90, max_value=90)
+    lng = forms.FloatField(min_value=-180, max_value=180)
+    radius = forms.IntegerField(min_value=1, required=False)
+    limit = forms.IntegerField(min_value=1, max_value=100, required=False)
+    open_at = forms.CharField(required=False)  # now・2026-10-25T22:00・22:00・6-22:00（0=月曜）
+
+    def clean_radius(self):
+        radius = self.cleaned_data.get('radius') or 1000
+        max_radius = getattr(settings, 'GEO_MAX_RADIUS', 5000)
+        if radius > max_radius:
+            raise forms.ValidationError(f'範囲は{max_radius}メートル以内で指定してください。')
+        return radius
+
+    def clean_limit(self):
+        return self.cleaned_data.get('limit') or 20
+
+    def clean_open_at(self):
+        value = self.cleaned_data.get('open_at')
+        if not value:
+            return None
+        open_at = hours.parse_open_at(value)
+        if open_at is None:
+            raise forms.ValidationError('営業中の日時は now・YYYY-MM-DDTHH:MM・HH:MM・曜日(0-6)-HH:MM で指定してください。')
+        return open_at
+
 # レビュー編集フォーム
 class ReviewEditForm(forms.ModelForm):
     class Meta:
@@ -125,3 +240,7 @@ class ProfileEditForm(UserChangeForm):
         for field in self.fields.values():
             field.widget.attrs['class'] = 'form-control'
             field.widget.attrs['placeholder'] = field.label
+
+    def clean_email(self):
+        # 自分のアドレスのままなら重複にしない（一意の列 email_lower で保存時に 500 にならないようにする）
+        return clean_unique_email(self.cleaned_data.get('email'), self.instance)
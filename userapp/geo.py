@@ -0,0 +1,161 @@
+"""店舗の位置と近くの店舗の検索
+
+空間インデックス（PostGIS など）は使わず、店舗ごとに位置を含むグリッドのセル
+（Shop.geo_cell、GEO_CELL_DEGREES 度四方）を保存しておく。近くの店舗は、探す範囲に
+掛かるセルを列挙してインデックスで候補を絞り、正確な距離は Python で計算して
+範囲外を除く。SQLite でもサーバーのDBでも同じように動く。極の近くのように
+掛かるセルが多すぎる範囲は、セルを使わず緯度の範囲で候補を絞る。
+
+住所から位置への変換は、同梱の住所表（userapp/data/addresses.csv）を使って
+オフラインで行う。住所表は国土交通省「位置参照情報」（大字・町丁目レベル）と
+同じ列名なので、ダウンロードしたファイルに差し替えて精度を上げられる。
+"""
+import csv
+import math
+import re
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+
+from .models import Shop
+
+EARTH_RADIUS = 6371008.8  # 地球の平均半径（メートル）
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+DEFAULT_TABLE = Path(__file__).resolve().parent / 'data' / 'addresses.csv'
+
+MAX_CELLS = 1000  # これより多くのセルに掛かる範囲（極の近く）はセルで絞らない
+CELLS_PER_QUERY = 500  # IN に並べるセルの数（DBの変数の数の上限を超えないようにする）
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """2点間の距離（メートル、球面上の大円距離）"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def bounds(latitude, longitude, radius):
+    """(latitude, longitude) から radius メートル以内を含む (緯度の幅, 経度の幅)（度、片側）"""
+    dlat = radius / METRES_PER_DEGREE
+    # 経度1度の長さは極に近いほど短いので、範囲の極側の端の緯度で幅を決める
+    edge = min(abs(latitude) + dlat, 90)
+    cos = math.cos(math.radians(edge))
+    dlng = min(radius / (METRES_PER_DEGREE * cos), 180) if cos > 1e-9 else 180
+    return dlat, dlng
+
+
+def cells_within(latitude, longitude, radius):
+    """(latitude, longitude) から radius メートル以内に掛かるセルのキー。MAX_CELLS を超えるなら None"""
+    size = getattr(settings, 'GEO_CELL_DEGREES', 0.01)
+    dlat, dlng = bounds(latitude, longitude, radius)
+    ys = range(math.floor((latitude - dlat) / size), math.floor((latitude + dlat) / size) + 1)
+    xs = range(math.floor((longitude - dlng) / size), math.floor((longitude + dlng) / size) + 1)
+    if len(ys) * len(xs) > MAX_CELLS:
+        return None
+    return [f'{y}:{x}' for y in ys for x in xs]
+
+
+def candidates(latitude, longitude, radius, queryset):
+    """範囲に掛かるセルの店舗（セルが多すぎるときは緯度の範囲の店舗）"""
+    cells = cells_within(latitude, longitude, radius)
+    if cells is None:
+        dlat, _ = bounds(latitude, longitude, radius)
+        yield from queryset.filter(
+            latitude__range=(latitude - dlat, latitude + dlat), longitude__isnull=False,
+        )
+        return
+    for start in range(0, len(cells), CELLS_PER_QUERY):
+        yield from queryset.filter(geo_cell__in=cells[start:start + CELLS_PER_QUERY])
+
+
+def nearby(latitude, longitude, radius, queryset=None, limit=None):
+    """radius メートル以内の店舗を近い順に返す（各店舗の distance 属性に距離を入れる）"""
+    if queryset is None:
+        queryset = Shop.objects.all()
+    shops = []
+    for shop in candidates(latitude, longitude, radius, queryset):
+        shop.distance = distance(latitude, longitude, shop.latitude, shop.longitude)
+        if shop.distance <= radius:
+            shops.append(shop)
+    shops.sort(key=lambda shop: (shop.distance, shop.pk))
+    return shops[:limit] if limit else shops
+
+
+# 住所の正規化
+_POSTAL_CODE_RE = re.compile(r'^〒?\d{3}-?\d{4}')
+_CHOME_RE = re.compile(r'(\d+)(?:丁目|[-‐ー−の])')
+_CHOME_SUFFIX_RE = re.compile(r'[一二三四五六七八九十]+丁目$')
+_KANJI_DIGITS = '〇一二三四五六七八九'
+
+
+def kanji_number(n):
+    """丁目の番号を漢数字にする（1〜99）"""
+    tens, ones = divmod(n, 10)
+    text = ''
+    if tens:
+        text = ('' if tens == 1 else _KANJI_DIGITS[tens]) + '十'
+    if ones or not text:
+        text += _KANJI_DIGITS[ones]
+    return text
+
+
+def normalize_address(address):
+    """住所の表記を住所表に揃える（「栄3-5-1」→「栄三丁目5-1」）"""
+    text = ''.join(unicodedata.normalize('NFKC', address or '').split())
+    text = _POSTAL_CODE_RE.sub('', text)
+    match = _CHOME_RE.search(text)
+    if match and 0 < int(match.group(1)) < 100:
+        text = f'{text[:match.start()]}{kanji_number(int(match.group(1)))}丁目{text[match.end():]}'
+    return text
+
+
+class AddressTable:
+    """住所の先頭から最も長く一致する地名の代表点を引く表
+
+    町丁目のほか、「栄」のような丁目を除いた町名と市区町村も、含まれる
+    町丁目の代表点の平均で引けるようにする（表に行があればそちらを使う）。
+    """
+
+    def __init__(self, rows):
+        self.points = {}
+        sums = {}
+        for prefecture, city, town, latitude, longitude in rows:
+            town_base = _CHOME_SUFFIX_RE.sub('', town)
+            keys = {prefecture + city + town: True, city + town: True}
+            keys.update({key: False for key in (
+                prefecture + city, city, prefecture + city + town_base, city + town_base,
+            ) if key not in keys})
+            for key, exact in keys.items():
+                if exact:
+                    self.points[key] = (latitude, longitude)
+                else:
+                    total = sums.setdefault(key, [0.0, 0.0, 0])
+                    total[0] += latitude
+                    total[1] += longitude
+                    total[2] += 1
+        for key, (lat_sum, lng_sum, count) in sums.items():
+            self.points.setdefault(key, (lat_sum / count, lng_sum / count))
+
+    @classmethod
+    def load(cls, path=None, encoding='utf-8'):
+        rows = []
+        with open(path or DEFAULT_TABLE, encoding=encoding, newline='') as f:
+            for row in csv.DictReader(f):
+                rows.append((
+                    row['都道府県名'].strip(), row['市区町村名'].strip(), (row['大字町丁目名'] or '').strip(),
+                    float(row['緯度']), float(row['経度']),
+                ))
+        return cls(rows)
+
+    def lookup(self, address):
+        """住所の (緯度, 経度)。見つからなければ None"""
+        text = normalize_address(address)
+        for end in range(len(text), 0, -1):
+            point = self.points.get(text[:end])
+            if point is not None:
+                return point
+        return None
@@ -0,0 +1,272 @@
+"""営業時間・定休日の解析と「営業中」の絞り込み
+
+Shop.opening_hours・regular_holiday の自由記述を、曜日ごとの営業区間
+（OpeningPeriod: 曜日, 開店の分, 閉店の分）に変換して保存する。区間は 0〜1440 分に
+収め、日付をまたぐ営業（17:00～翌2:00）は翌日の 0:00〜2:00 に分けるので、
+「その時刻に営業中の店舗」は (曜日, 開店, 閉店) のインデックスで引ける。
+
+括弧の中も読み、「11:00~23:00(土日祝は11:00~22:00)」のように曜日を指定した時間帯は、
+曜日を指定しない時間帯よりその曜日で優先する。ラストオーダーの時刻は営業区間に関係しないので読み飛ばす。
+解析できなかった記述は理由を Shop.opening_hours_error に残す
+（index_opening_hours コマンドの出力や管理画面の絞り込みで確認して直す）。
+祝日と「第2火曜」のような月単位の休みは週単位の区間にできないので扱わない。
+"""
+import re
+import unicodedata
+from datetime import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OpeningPeriod, Shop
+
+WEEKDAYS = '月火水木金土日'  # datetime.weekday() の順
+MINUTES_PER_DAY = 24 * 60
+ALL_DAYS = frozenset(range(7))
+
+_TIME = r'(翌)?(\d{1,2})(?::(\d{2})|時(半|(\d{1,2})分)?)'
+_DAY = r'[月火水木金土日](?:曜日?)?'
+_TOKEN_RE = re.compile(
+    rf'(?P<range>{_TIME}\s*[~\-]\s*{_TIME})'
+    r'|(?P<allday>24時間(?:営業)?)'
+    rf'|(?P<dayrange>{_DAY}\s*[~\-]\s*{_DAY})'
+    r'|(?P<weekdays>平日)'
+    r'|(?P<everyday>毎日|全日|無休|年中無休)'
+    r'|(?P<holiday>祝日?|祭日|祝前日)'
+    rf'|(?P<day>{_DAY})'
+    r'|(?P<skip>[\s,、/;:・&]+|定休日?|毎週|ランチ|ディナー|モーニング|昼|夜|朝|営業|は|から|まで|頃|及び|および|と)'
+)
+_LAST_ORDER_RE = re.compile(rf'(?:L\.?\s*O\.?|ラストオーダー)\s*[:.]?\s*{_TIME}', re.IGNORECASE)
+_DAY_RANGE_RE = re.compile(rf'({_DAY})\s*[~\-]\s*({_DAY})')
+_NO_HOLIDAY_RE = re.compile(r'^(?:なし|無し|年中無休|無休|不定休|-)$')
+_MONTHLY_RE = re.compile(r'第\d')
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text or '')
+    text = text.replace('〜', '~').replace('‐', '-').replace('−', '-')
+    text = re.sub(r'(?<=\d)[ー–—―](?=\d|翌)', '-', text)
+    text = _LAST_ORDER_RE.sub(' ', text)
+    # 括弧の中の補足（曜日ごとの時間帯など）も読むので、区切りにするだけにする
+    return re.sub(r'[()\[\]【】]', ' ', text).strip()
+
+
+def _minute(groups):
+    next_day, hour, minute, suffix, suffix_minute = groups
+    value = int(hour) * 60
+    if minute:
+        value += int(minute)
+    elif suffix == '半':
+        value += 30
+    elif suffix_minute:
+        value += int(suffix_minute)
+    if next_day:
+        value += MINUTES_PER_DAY
+    return value
+
+
+def _day_range(text):
+    start, end = (WEEKDAYS.index(day[0]) for day in _DAY_RANGE_RE.fullmatch(text).groups())
+    days = {start}
+    while start != end:
+        start = (start + 1) % 7
+        days.add(start)
+    return days
+
+
+def tokenize(text):
+    """(種類, 値) の列と、読めなかった部分の一覧を返す"""
+    tokens, unknown = [], []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            # 次に読める位置までを解析できない部分として残す
+            end = pos + 1
+            while end < len(text) and _TOKEN_RE.match(text, end) is None:
+                end += 1
+            unknown.append(text[pos:end])
+            pos = end
+            continue
+        kind = match.lastgroup
+        if kind == 'range':
+            groups = match.groups()
+            tokens.append(('range', (_minute(groups[1:6]), _minute(groups[6:11]))))
+        elif kind == 'allday':
+            tokens.append(('range', (0, MINUTES_PER_DAY)))
+        elif kind == 'dayrange':
+            tokens.append(('days', _day_range(match.group())))
+        elif kind == 'weekdays':
+            tokens.append(('days', set(range(5))))
+        elif kind == 'everyday':
+            tokens.append(('days', set(ALL_DAYS)))
+        elif kind == 'holiday':
+            tokens.append(('days', set()))
+        elif kind == 'day':
+            tokens.append(('days', {WEEKDAYS.index(match.group()[0])}))
+        pos = match.end()
+    return tokens, unknown
+
+
+def parse_opening_hours(text):
+    """営業時間を [(営業日の曜日, 開店の分, 閉店の分)] にする。閉店は 1440 を超えることがある
+
+    曜日の指定（「月~金」「土日祝」）はその後の時間帯に掛かる。指定がなければ毎日。
+    曜日を指定した時間帯のある曜日では、曜日を指定しない時間帯を使わない。
+    """
+    tokens, unknown = tokenize(normalize(text))
+    problems = [f'解析できない記述があります: {text}'] if unknown else []
+    intervals, everyday = [], []
+    specified = set()  # 時間帯を曜日で指定した曜日
+    days, collecting = None, False
+    for kind, value in tokens:
+        if kind == 'days':
+            if not collecting:
+                days, collecting = set(), True
+            days |= value
+            continue
+        collecting = False
+        start, end = value
+        if end <= start:
+            end += MINUTES_PER_DAY  # 「18:00~2:00」は翌日の2時まで
+        if end - start > MINUTES_PER_DAY or start >= 2 * MINUTES_PER_DAY:
+            problems.append(f'時間帯が不正です: {start // 60}:{start % 60:02d}')
+            continue
+        if days is None:
+            everyday.extend((day, start, end) for day in sorted(ALL_DAYS))
+        else:
+            specified |= days
+            intervals.extend((day, start, end) for day in sorted(days))
+    intervals += [interval for interval in everyday if interval[0] not in specified]
+    if not intervals and not problems:
+        problems.append('営業時間が見つかりません')
+    return intervals, problems
+
+
+def parse_regular_holiday(text):
+    """定休日を曜日の集合にする（祝日は無視する）"""
+    text = normalize(text)
+    if not text or _NO_HOLIDAY_RE.match(text):
+        return set(), []
+    if _MONTHLY_RE.search(text):
+        return set(), [f'月単位の定休日は扱えません: {text}']
+    tokens, unknown = tokenize(text)
+    problems = [f'解析できない定休日があります: {text}'] if unknown else []
+    closed = set()
+    for kind, value in tokens:
+        if kind == 'range':
+            problems.append(f'定休日に時間帯は指定できません: {text}')
+        elif kind == 'days' and value != ALL_DAYS:
+            closed |= value
+    return closed, problems
+
+
+def parse(opening_hours, regular_holiday=''):
+    """営業時間と定休日から、曜日ごとの営業区間 [(曜日, 開店の分, 閉店の分)] と問題点の一覧を返す"""
+    if not (opening_hours or '').strip():
+        return [], []
+    intervals, problems = parse_opening_hours(opening_hours)
+    closed, holiday_problems = parse_regular_holiday(regular_holiday)
+    problems += holiday_problems
+
+    by_day = {day: [] for day in range(7)}
+    for day, start, end in intervals:
+        if day in closed:
+            continue
+        # 日付をまたぐ分は翌日の区間にする
+        day_offset, start = divmod(start, MINUTES_PER_DAY)
+        end -= day_offset * MINUTES_PER_DAY
+        day = (day + day_offset) % 7
+        by_day[day].append((start, min(end, MINUTES_PER_DAY)))
+        if end > MINUTES_PER_DAY:
+            by_day[(day + 1) % 7].append((0, end - MINUTES_PER_DAY))
+
+    # 重なる区間をまとめる
+    periods = []
+    for day, spans in by_day.items():
+        merged = []
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        periods.extend((day, start, end) for start, end in merged)
+    return periods, problems
+
+
+def index_shops(shops):
+    """店舗の営業区間を作り直し、解析できなかった店舗の数を返す"""
+    shops = list(shops)
+    periods, changed, failed = [], [], 0
+    for shop in shops:
+        intervals, problems = parse(shop.opening_hours, shop.regular_holiday)
+        periods.extend(
+            OpeningPeriod(shop_id=shop.pk, weekday=day, open_minute=start, close_minute=end)
+            for day, start, end in intervals
+        )
+        error = ' / '.join(problems)[:255]
+        failed += bool(error)
+        if error != shop.opening_hours_error:
+            shop.opening_hours_error = error
+            changed.append(shop)
+    with transaction.atomic():
+        OpeningPeriod.objects.filter(shop_id__in=[shop.pk for shop in shops]).delete()
+        OpeningPeriod.objects.bulk_create(periods)
+        # bulk_update は保存のシグナルを飛ばさないので、営業区間の作り直しが繰り返されない
+        Shop.objects.bulk_update(changed, ['opening_hours_error'])
+    return failed
+
+
+def rebuild(queryset=None, batch_size=1000):
+    """店舗の営業区間をまとめて作り直す。(店舗数, 解析できなかった店舗数) を返す"""
+    if queryset is None:
+        queryset = Shop.objects.all()
+    queryset = queryset.only('pk', 'opening_hours', 'regular_holiday', 'opening_hours_error').order_by('pk')
+    total = failed = 0
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return total, failed
+        failed += index_shops(batch)
+        total += len(batch)
+        last_pk = batch[-1].pk
+
+
+def parse_open_at(value):
+    """open_at の指定を (曜日, 0時からの分) にする。解釈できなければ None
+
+    「now」（現在）・「2026-10-25T22:00」（日時）・「22:00」（今日）・「6-22:00」（曜日-時刻、0=月曜）を受け付ける。
+    """
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value == 'now':
+        moment = timezone.localtime()
+        return moment.weekday(), moment.hour * 60 + moment.minute
+    match = re.fullmatch(r'([0-6])-(\d{1,2}):(\d{2})', value) or re.fullmatch(r'()(\d{1,2}):(\d{2})', value)
+    if match:
+        day, hour, minute = match.groups()
+        if int(hour) > 23 or int(minute) > 59:
+            return None
+        weekday = int(day) if day else timezone.localdate().weekday()
+        return weekday, int(hour) * 60 + int(minute)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if timezone.is_aware(moment):
+        moment = timezone.localtime(moment)
+    return moment.weekday(), moment.hour * 60 + moment.minute
+
+
+def format_open_at(weekday, minute):
+    """検索条件の正規形（キャッシュキーが曜日と時刻だけで決まるようにする）"""
+    return f'{weekday}-{minute // 60:02d}:{minute % 60:02d}'
+
+
+def open_shop_ids(weekday, minute):
+    """その曜日・時刻に営業中の店舗IDのサブクエリ"""
+    return OpeningPeriod.objects.filter(
+        weekday=weekday, open_minute__lte=minute, close_minute__gt=minute,
+    ).values('shop_id')
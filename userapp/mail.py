@@ -0,0 +1,211 @@
+"""メールの送信キュー
+
+EMAIL_BACKEND に QueuedEmailBackend を指定すると、send_mail やパスワード
+リセットのメールは QueuedEmail に保存されるだけになり、リクエストはすぐに返る。
+send_queued_email コマンドが QUEUED_EMAIL_BACKEND（SMTP・ファイル・コンソールなど）の
+接続を1つ開いたまま、溜まったメールをまとめて送る。ワーカーが同時に動いても同じメールを
+二重に送らないよう、送る前に条件付き UPDATE で1通ずつ「送信中」にして確保する。
+"""
+import base64
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.utils import timezone
+
+from .models import QueuedEmail
+
+logger = logging.getLogger(__name__)
+
+
+def is_connection_error(error):
+    """接続が使えなくなったエラーか（SMTPException も OSError の派生なので区別する）"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_retryable(error):
+    """時間をおけば送れる見込みがあるか（4xx の一時エラーと接続エラー）"""
+    if is_connection_error(error):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+class QueuedEmailBackend(BaseEmailBackend):
+    """メールを送らずに QueuedEmail として保存するバックエンド"""
+
+    def send_messages(self, email_messages):
+        rows = [to_row(message) for message in email_messages if message.recipients()]
+        QueuedEmail.objects.bulk_create(rows)
+        return len(rows)
+
+
+def to_row(message):
+    attachments = []
+    for attachment in message.attachments:
+        if not isinstance(attachment, tuple):
+            raise ValueError('MIMEBase の添付はキューに保存できません')
+        filename, content, mimetype = attachment
+        if isinstance(content, str):
+            content = content.encode()
+        attachments.append([filename, base64.b64encode(content).decode('ascii'), mimetype])
+    return QueuedEmail(
+        subject=message.subject,
+        body=message.body,
+        from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(message.to),
+        cc=list(message.cc),
+        bcc=list(message.bcc),
+        reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers),
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+        attachments=attachments,
+    )
+
+
+def to_message(row, connection=None):
+    message = EmailMultiAlternatives(
+        subject=row.subject,
+        body=row.body,
+        from_email=row.from_email,
+        to=row.to,
+        cc=row.cc,
+        bcc=row.bcc,
+        reply_to=row.reply_to,
+        headers=row.headers,
+        alternatives=[tuple(alternative) for alternative in row.alternatives],
+        connection=connection,
+    )
+    for filename, content, mimetype in row.attachments:
+        message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+def max_attempts():
+    return getattr(settings, 'QUEUED_EMAIL_MAX_ATTEMPTS', 5)
+
+
+def backoff(attempts):
+    base = getattr(settings, 'QUEUED_EMAIL_BACKOFF', 30)
+    return min(getattr(settings, 'QUEUED_EMAIL_BACKOFF_MAX', 3600), base * 2 ** (attempts - 1))
+
+
+def get_delivery_connection():
+    """実際に送信するバックエンドの接続（開くのは呼び出し側）"""
+    return get_connection(
+        getattr(settings, 'QUEUED_EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend'),
+        fail_silently=False,
+    )
+
+
+def claim(batch_size):
+    """送信時刻を過ぎたメールを取り出して送信中にする
+
+    読み取った時点から状態と時刻が変わっていない行だけを条件付き UPDATE で確保するので、
+    複数のワーカーが同じメールを取り合わない。送信中のまま止まったもの（ワーカーの
+    異常終了など）は QUEUED_EMAIL_LOCK_TIMEOUT 秒後に取り直す。
+    """
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=getattr(settings, 'QUEUED_EMAIL_LOCK_TIMEOUT', 300))
+    due = QueuedEmail.objects.filter(
+        status__in=[QueuedEmail.PENDING, QueuedEmail.SENDING], next_attempt_at__lte=now,
+    )
+    claimed = []
+    for pk, status, next_attempt_at in due.order_by('next_attempt_at', 'pk').values_list(
+        'pk', 'status', 'next_attempt_at',
+    )[:batch_size]:
+        if QueuedEmail.objects.filter(pk=pk, status=status, next_attempt_at=next_attempt_at).update(
+            status=QueuedEmail.SENDING, next_attempt_at=locked_until,
+        ):
+            claimed.append(pk)
+    return list(QueuedEmail.objects.filter(pk__in=claimed).order_by('pk'))
+
+
+def release(rows):
+    """確保したまま送らなかったメールを送信待ちに戻す"""
+    QueuedEmail.objects.filter(pk__in=[row.pk for row in rows], status=QueuedEmail.SENDING).update(
+        status=QueuedEmail.PENDING, next_attempt_at=timezone.now(),
+    )
+
+
+def send_one(row, connection):
+    """1通送信する。接続が切れていたら開き直して1回だけ送り直す"""
+    message = to_message(row, connection)
+    try:
+        connection.send_messages([message])
+    except smtplib.SMTPServerDisconnected:
+        connection.close()
+        connection.open()
+        connection.send_messages([message])
+
+
+def record_failure(row, error):
+    row.last_error = f'{type(error).__name__}: {error}'
+    if is_retryable(error) and row.attempts < max_attempts():
+        row.status = QueuedEmail.PENDING
+        row.next_attempt_at = timezone.now() + timedelta(seconds=backoff(row.attempts))
+        logger.warning('メール送信を再試行します: #%s (%s)', row.pk, row.last_error)
+    else:
+        row.status = QueuedEmail.FAILED
+        logger.error('メール送信に失敗しました: #%s (%s)', row.pk, row.last_error)
+    row.save(update_fields=['attempts', 'status', 'next_attempt_at', 'last_error'])
+
+
+def send_batch(rows, connection):
+    """同じ接続でまとめて送信し、1通ごとに結果を記録する。送信できた件数を返す
+
+    接続が使えなくなったら、残りは送信待ちに戻して例外を送出する（次回に回す）。
+    """
+    sent = []
+    remaining = list(rows)
+    try:
+        while remaining:
+            row = remaining.pop(0)
+            row.attempts += 1
+            try:
+                send_one(row, connection)
+            except Exception as e:
+                record_failure(row, e)
+                if is_connection_error(e):
+                    raise
+            else:
+                row.status = QueuedEmail.SENT
+                row.sent_at = timezone.now()
+                sent.append(row)
+    finally:
+        QueuedEmail.objects.bulk_update(sent, ['attempts', 'status', 'sent_at'])
+        if remaining:
+            release(remaining)
+    return len(sent)
+
+
+def drain(connection=None, batch_size=None):
+    """送信待ちのメールがなくなるまで、1つの接続で送る。送信できた件数を返す"""
+    batch_size = batch_size or getattr(settings, 'QUEUED_EMAIL_BATCH_SIZE', 50)
+    rows = claim(batch_size)
+    if not rows:
+        return 0
+    own_connection = connection is None
+    connection = connection or get_delivery_connection()
+    sent = 0
+    try:
+        connection.open()
+        while rows:
+            sent += send_batch(rows, connection)
+            rows = claim(batch_size)
+    except Exception:
+        # 接続を開けなかったときも、確保した分は送信待ちに戻す
+        release(rows)
+        raise
+    finally:
+        if own_connection:
+            connection.close()
+    return sent
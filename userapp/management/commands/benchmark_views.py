@@ -0,0 +1,152 @@
+import json
+import logging
+import math
+import subprocess
+import time
+from contextlib import ExitStack
+from itertools import combinations
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from userapp import search_query
+from userapp.middleware import QueryRecorder
+from userapp.models import Category, Favorite, Reservation, Shop
+
+User = get_user_model()
+
+# 静的ファイルのマニフェストがなくてもテンプレートを描画できるようにする
+BENCHMARK_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def percentile(values, p):
+    """最近傍順位法によるパーセンタイル"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = '主要なビューをテストクライアントで実行し、レイテンシとクエリ数をJSONで出力する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='シナリオごとの実行回数')
+        parser.add_argument('--warmup', type=int, default=2, help='計測前に捨てる実行回数')
+        parser.add_argument('--cold-cache', action='store_true', help='毎回検索キャッシュを無効にして計測する')
+        parser.add_argument('--output', help='結果を書き出すファイル（省略時は標準出力）')
+
+    def handle(self, *args, **options):
+        shop = Shop.objects.order_by('-review_count', 'pk').first()
+        user = self.pick_user()
+        if shop is None or user is None:
+            raise CommandError('店舗またはユーザーがありません。先に generate_dataset を実行してください。')
+
+        # SQLのDEBUGログが計測を乱さないよう、実行中は抑える
+        db_logger = logging.getLogger('django.db.backends')
+        level = db_logger.level
+        db_logger.setLevel(logging.WARNING)
+        try:
+            with override_settings(STORAGES=BENCHMARK_STORAGES, QUERY_BUDGET_ENABLED=False):
+                results = self.run_scenarios(shop, user, options)
+        finally:
+            db_logger.setLevel(level)
+
+        report = {
+            'commit': self.git_commit(),
+            'iterations': options['iterations'],
+            'cold_cache': options['cold_cache'],
+            'scenarios': results,
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+            self.stdout.write(self.style.SUCCESS(f'{options["output"]} に書き出しました'))
+        else:
+            self.stdout.write(output)
+
+    def pick_user(self):
+        """お気に入りと予約の多いユーザーを選ぶ"""
+        user_id = (
+            Favorite.objects.values('user_id').annotate(n=Count('pk')).order_by('-n')
+            .values_list('user_id', flat=True).first()
+        )
+        if user_id is None:
+            user_id = Reservation.objects.values_list('user_id', flat=True).first()
+        if user_id is None:
+            return User.objects.order_by('pk').first()
+        return User.objects.get(pk=user_id)
+
+    def search_scenarios(self, shop):
+        """検索条件のすべての組み合わせ"""
+        filters = {
+            'selected_category': str(shop.category_id),
+            'freeword': shop.name[:3],
+            'region': shop.region or '中区',
+            'price_range': '1000-2999',
+            'rating': '3',
+        }
+        scenarios = []
+        for size in range(len(filters) + 1):
+            for fields in combinations(filters, size):
+                name = 'search:' + ('+'.join(fields) or 'all')
+                scenarios.append((name, reverse('userapp:search'), {f: filters[f] for f in fields}, False))
+        return scenarios
+
+    def run_scenarios(self, shop, user, options):
+        scenarios = [
+            ('index', reverse('userapp:index'), {}, False),
+            *self.search_scenarios(shop),
+            ('shop_info', reverse('userapp:shop_info', args=[shop.pk]), {}, False),
+            ('shop_info:login', reverse('userapp:shop_info', args=[shop.pk]), {}, True),
+            ('favorites', reverse('userapp:favorites'), {}, True),
+            ('reservations', reverse('userapp:reservations'), {}, True),
+        ]
+        anonymous = Client(HTTP_HOST='127.0.0.1')
+        logged_in = Client(HTTP_HOST='127.0.0.1')
+        logged_in.force_login(user)
+
+        results = {}
+        for name, url, params, login in scenarios:
+            client = logged_in if login else anonymous
+            timings = []
+            queries = []
+            for i in range(options['warmup'] + options['iterations']):
+                if options['cold_cache']:
+                    search_query.bump_version()
+                recorder = QueryRecorder()
+                with ExitStack() as stack:
+                    for connection in connections.all():
+                        stack.enter_context(connection.execute_wrapper(recorder))
+                    start = time.perf_counter()
+                    response = client.get(url, params)
+                    elapsed = time.perf_counter() - start
+                if response.status_code != 200:
+                    raise CommandError(f'{name}: ステータス {response.status_code}')
+                if i >= options['warmup']:
+                    timings.append(elapsed * 1000)
+                    queries.append(recorder.count)
+            results[name] = {
+                'p50_ms': round(percentile(timings, 50), 2),
+                'p95_ms': round(percentile(timings, 95), 2),
+                'p99_ms': round(percentile(timings, 99), 2),
+                'mean_ms': round(sum(timings) / len(timings), 2),
+                'queries': max(queries),
+            }
+            self.stderr.write(f'{name}: p50={results[name]["p50_ms"]}ms queries={results[name]["queries"]}')
+        return results
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,37 @@
+import sys
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from userapp import export
+
+
+class Command(BaseCommand):
+    help = 'レビュー・予約・サブスクリプションを CSV・JSONL で書き出す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(export.DATASETS))
+        parser.add_argument('--format', choices=sorted(export.CONTENT_TYPES), default='csv')
+        parser.add_argument('--since', type=date.fromisoformat, help='この日以降（YYYY-MM-DD）')
+        parser.add_argument('--until', type=date.fromisoformat, help='この日まで（YYYY-MM-DD）')
+        parser.add_argument('--output', '-o', default='-', help='出力ファイル（省略時は標準出力）')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        dataset = export.DATASETS[options['dataset']]
+        try:
+            queryset = export.filter_dates(dataset, dataset.model.objects.all(), options['since'], options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+        lines = export.lines(dataset, queryset, options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            sys.stdout.writelines(lines)
+            return
+        count = 0
+        with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+            for line in lines:
+                f.write(line)
+                count += 1
+        if options['format'] == 'csv':
+            count -= 1  # 見出し行
+        self.stderr.write(self.style.SUCCESS(f'{count}件を書き出しました: {options["output"]}'))
@@ -0,0 +1,203 @@
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from userapp import booking, hours, search, search_query
+from userapp.models import (
+    BUDGET_CHOICES, REGION_CHOICES, Category, Favorite, Profile, Reservation, ReservationSlot, Review, Shop,
+    budget_bounds,
+)
+
+User = get_user_model()
+
+CATEGORY_GROUPS = ['和食', '洋食', '中華', '居酒屋', 'カフェ', '焼肉', 'ラーメン', 'その他']
+FOODS = [
+    'ひつまぶし', '味噌かつ', '手羽先', 'きしめん', '台湾ラーメン', 'あんかけスパ',
+    '味噌煮込みうどん', '天むす', 'どて煮', '小倉トースト', '鉄板ナポリタン', 'カレーうどん',
+]
+AREAS = ['名駅', '栄', '大須', '金山', '覚王山', '八事', '大曽根', '今池']
+SUFFIXES = ['本店', '支店', '亭', '屋', '堂', '庵', '食堂']
+TOWNS = ['栄', '錦', '丸の内', '大須', '御器所', '川名', '大曽根', '清水']
+HOURS = ['11:00～22:00', '11:30～14:00, 17:00～23:00', '7:00～16:00', '17:00～翌2:00', '10:00～21:00']
+HOLIDAYS = ['月曜日', '火曜日', '水曜日', '日曜日', '不定休', '年中無休']
+COMMENTS = ['とても美味しかったです。', '雰囲気が良いお店でした。', 'また行きたいです。', '少し待ちました。', '量が多くて満足。']
+
+
+class Command(BaseCommand):
+    help = 'ベンチマーク用の合成データ（カテゴリ・店舗・ユーザー・レビュー・お気に入り・予約）を生成する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--shops', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--reviews', type=int, default=5000)
+        parser.add_argument('--favorites', type=int, default=2000)
+        parser.add_argument('--reservations', type=int, default=2000)
+        parser.add_argument('--skew', type=float, default=1.1, help='人気の偏り（Zipf分布の指数）')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        categories = self.create_categories(options['categories'])
+        shops = self.create_shops(options['shops'], categories, options['skew'])
+        users = self.create_users(options['users'])
+        if shops and users:
+            # 人気順をIDと無関係にするためシャッフルしてから重みを付ける
+            shops = list(shops)
+            self.rng.shuffle(shops)
+            shop_weights = list(accumulate(1 / rank ** options['skew'] for rank in range(1, len(shops) + 1)))
+            self.create_reviews(options['reviews'], shops, shop_weights, users)
+            self.create_favorites(options['favorites'], shops, shop_weights, users)
+            self.create_reservations(options['reservations'], shops, shop_weights, users)
+
+        # bulk_create ではシグナルが飛ばないので、派生データは最後にまとめて作り直す
+        self.stdout.write('評価の集計値・検索インデックス・営業区間を再作成しています...')
+        Shop.recompute_ratings()
+        search.rebuild_index()
+        hours.rebuild()
+        search_query.bump_version()
+        self.stdout.write(self.style.SUCCESS('合成データの生成が完了しました'))
+
+    def bulk_create(self, model, objects):
+        """バッチ単位で登録し、登録された行のIDを返す（DBを問わず主キーを取り直す）"""
+        last_pk = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        with transaction.atomic():
+            for start in range(0, len(objects), self.batch_size):
+                model.objects.bulk_create(objects[start:start + self.batch_size])
+        ids = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+        self.stdout.write(f'{model.__name__}: {len(ids)}件')
+        return ids
+
+    def create_categories(self, count):
+        categories = []
+        for i in range(count):
+            name = FOODS[i % len(FOODS)]
+            if i >= len(FOODS):
+                name = f'{name}{i // len(FOODS) + 1}'
+            categories.append(Category(category_l=CATEGORY_GROUPS[i % len(CATEGORY_GROUPS)], name=name))
+        return self.bulk_create(Category, categories)
+
+    def create_shops(self, count, category_ids, skew):
+        if not category_ids:
+            return []
+        # カテゴリの人気にも偏りをつける
+        category_weights = list(accumulate(1 / rank ** skew for rank in range(1, len(category_ids) + 1)))
+        regions = [value for value, _ in REGION_CHOICES]
+        budgets = [value for value, _ in BUDGET_CHOICES]
+        shops = []
+        for i in range(count):
+            rng = self.rng
+            category_id = rng.choices(category_ids, cum_weights=category_weights)[0]
+            food = rng.choice(FOODS)
+            region = rng.choice(regions)
+            price_range = rng.choices(budgets, weights=[4, 3, 2, 1])[0]
+            min_budget, max_budget = budget_bounds(price_range)
+            shops.append(Shop(
+                name=f'{rng.choice(AREAS)}{food}{rng.choice(SUFFIXES)} {i + 1}',
+                pr_long=f'{rng.choice(AREAS)}で人気の{food}のお店です。',
+                description=f'名物の{food}をはじめ、名古屋めしを楽しめます。',
+                price_range=price_range,
+                min_budget=min_budget,
+                max_budget=max_budget,
+                address=f'愛知県名古屋市{region}{rng.choice(TOWNS)}{rng.randint(1, 5)}-{rng.randint(1, 30)}',
+                tel=f'052-{rng.randint(100, 999)}-{rng.randint(1000, 9999)}',
+                opening_hours=rng.choice(HOURS),
+                regular_holiday=rng.choice(HOLIDAYS),
+                category_id=category_id,
+                region=region,
+            ))
+        return self.bulk_create(Shop, shops)
+
+    def create_users(self, count):
+        # パスワードのハッシュ計算は重いので全ユーザーで共有する
+        password = make_password('password')
+        offset = User.objects.count()
+        users = []
+        for i in range(count):
+            email = f'user{offset + i:07d}@example.com'
+            # bulk_create は save() を通らないので、小文字のメールアドレスもここで入れる
+            users.append(User(username=f'user{offset + i:07d}', email=email, email_lower=email, password=password))
+        ids = self.bulk_create(User, users)
+        # post_save が飛ばないのでプロフィールもまとめて作る
+        existing = set(Profile.objects.filter(user_id__in=ids).values_list('user_id', flat=True))
+        self.bulk_create(Profile, [Profile(user_id=pk) for pk in ids if pk not in existing])
+        return ids
+
+    def pick_pairs(self, count, shops, shop_weights, users):
+        """(店舗, ユーザー) の重複しない組を人気の偏りに従って選ぶ"""
+        pairs = set()
+        attempts = 0
+        while len(pairs) < count and attempts < count * 5:
+            attempts += 1
+            shop_id = self.rng.choices(shops, cum_weights=shop_weights)[0]
+            pairs.add((shop_id, self.rng.choice(users)))
+        return sorted(pairs)
+
+    def create_reviews(self, count, shops, shop_weights, users):
+        existing = set(Review.objects.values_list('shop_id', 'user_id'))
+        # 店舗ごとの「実力」を決め、スコアはその周辺に散らす
+        quality = {shop_id: self.rng.uniform(2, 4.8) for shop_id in shops}
+        reviews = []
+        for shop_id, user_id in self.pick_pairs(count, shops, shop_weights, users):
+            if (shop_id, user_id) in existing:
+                continue
+            score = min(5, max(1, round(self.rng.gauss(quality[shop_id], 0.8))))
+            reviews.append(Review(shop_id=shop_id, user_id=user_id, score=score, comment=self.rng.choice(COMMENTS)))
+        self.bulk_create(Review, reviews)
+
+    def create_favorites(self, count, shops, shop_weights, users):
+        favorites = [
+            Favorite(shop_id=shop_id, user_id=user_id)
+            for shop_id, user_id in self.pick_pairs(count, shops, shop_weights, users)
+        ]
+        self.bulk_create(Favorite, favorites)
+
+    def create_reservations(self, count, shops, shop_weights, users):
+        """予約を予約枠に割り当てて登録する
+
+        予約の受付（booking.book）と空き状況は予約枠の予約済みの席数を読むので、枠も作り、
+        予約済みの席数を予約の人数の合計に合わせる。席数を超える予約は book と同じく作らない。
+        """
+        today = timezone.localtime().replace(minute=0, second=0, microsecond=0)
+        shop_map = Shop.objects.only('pk', 'capacity', 'slot_minutes').in_bulk(shops)
+        slots = {(slot.shop_id, slot.start): slot for slot in ReservationSlot.objects.filter(start__gte=today)}
+        reservations = []
+        touched = {}  # 予約を入れた枠（登録順を保つ）
+        for _ in range(count):
+            date_time = today + timedelta(days=self.rng.randint(0, 60))
+            date_time = date_time.replace(hour=self.rng.choice([11, 12, 13, 17, 18, 19, 20, 21]))
+            shop = shop_map[self.rng.choices(shops, cum_weights=shop_weights)[0]]
+            num_people = self.rng.choices([1, 2, 3, 4, 6, 8], weights=[2, 6, 2, 3, 1, 1])[0]
+            key = (shop.pk, booking.slot_start(shop, date_time))
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = ReservationSlot(shop_id=shop.pk, start=key[1], capacity=shop.capacity)
+            if slot.booked + num_people > slot.capacity:
+                continue
+            slot.booked += num_people
+            touched[key] = slot
+            reservations.append((key, Reservation(
+                shop_id=shop.pk, user_id=self.rng.choice(users), date_time=date_time, num_people=num_people,
+            )))
+
+        existing = [slot for slot in touched.values() if slot.pk is not None]
+        self.bulk_create(ReservationSlot, [slot for slot in touched.values() if slot.pk is None])
+        with transaction.atomic():
+            ReservationSlot.objects.bulk_update(existing, ['booked'], batch_size=self.batch_size)
+        # bulk_create で主キーが返らないDBもあるので、枠のIDは引き直す
+        slot_ids = {
+            (shop_id, start): pk
+            for pk, shop_id, start in ReservationSlot.objects.filter(start__gte=today).values_list('pk', 'shop_id', 'start')
+        }
+        for key, reservation in reservations:
+            reservation.slot_id = slot_ids[key]
+        self.bulk_create(Reservation, [reservation for _, reservation in reservations])
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from userapp import geo
+from userapp.models import Shop, geo_cell
+
+
+class Command(BaseCommand):
+    help = '同梱の住所表（または --table の位置参照情報）を使って、店舗の住所から緯度・経度を設定する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', help='住所表のCSV（都道府県名・市区町村名・大字町丁目名・緯度・経度の列）')
+        parser.add_argument('--encoding', default='utf-8', help='住所表の文字コード（位置参照情報は cp932）')
+        parser.add_argument('--all', action='store_true', help='位置を設定済みの店舗も住所から設定し直す')
+        parser.add_argument('--cells', action='store_true', help='住所は見ずにグリッドのセルだけ計算し直す（GEO_CELL_DEGREES の変更後）')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['cells']:
+            shops = Shop.objects.filter(latitude__isnull=False, longitude__isnull=False)
+            updated = 0
+            for batch in self.batches(shops, batch_size):
+                for shop in batch:
+                    shop.geo_cell = geo_cell(shop.latitude, shop.longitude)
+                Shop.objects.bulk_update(batch, ['geo_cell'])
+                updated += len(batch)
+            self.stdout.write(self.style.SUCCESS(f'{updated}件の店舗のセルを計算し直しました'))
+            return
+
+        try:
+            table = geo.AddressTable.load(options['table'], options['encoding'])
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f'住所表を読み込めません: {e}')
+        shops = Shop.objects.all() if options['all'] else Shop.objects.filter(latitude__isnull=True)
+
+        located = missed = 0
+        for batch in self.batches(shops, batch_size):
+            changed = []
+            for shop in batch:
+                point = table.lookup(shop.address)
+                if point is None:
+                    missed += 1
+                    self.stderr.write(f'位置が見つかりません: #{shop.pk} {shop.address or "（住所なし）"}')
+                    continue
+                shop.latitude, shop.longitude = point
+                shop.geo_cell = geo_cell(*point)
+                changed.append(shop)
+            with transaction.atomic():
+                Shop.objects.bulk_update(changed, ['latitude', 'longitude', 'geo_cell'])
+            located += len(changed)
+            self.stdout.write(f'{located + missed}件処理しました')
+        self.stdout.write(self.style.SUCCESS(f'{located}件の店舗に位置を設定しました（見つからない住所 {missed}件）'))
+
+    def batches(self, queryset, batch_size):
+        """主キー順に batch_size 件ずつ返す（更新しながら読んでも行を飛ばさない）"""
+        queryset = queryset.only('pk', 'address', 'latitude', 'longitude').order_by('pk')
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1].pk
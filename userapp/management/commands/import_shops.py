@@ -0,0 +1,267 @@
+import csv
+import json
+import sys
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from userapp import catalog, hours, search, search_query
+from userapp.models import BUDGET_CHOICES, REGION_CHOICES, Category, ReservationSlot, Shop, budget_bounds, geo_cell
+
+# 取り込む店舗の列（category_l・category で業態を指定する）
+TEXT_FIELDS = ['name', 'pr_long', 'price_range', 'address', 'tel', 'opening_hours', 'regular_holiday', 'description', 'region']
+INT_FIELDS = ['capacity', 'slot_minutes']
+COORDINATE_RANGES = {'latitude': 90, 'longitude': 180}
+CHOICES = {
+    'price_range': {value for value, _ in BUDGET_CHOICES},
+    'region': {value for value, _ in REGION_CHOICES},
+}
+
+
+class RowError(ValueError):
+    """取り込めない行"""
+
+
+class Command(BaseCommand):
+    help = (
+        '店舗を CSV・JSONL から一括で登録・更新する。'
+        'id が一致する店舗、id がなければ店舗名と住所が一致する店舗を更新し、それ以外は新規に登録する'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='入力ファイル（- で標準入力）')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='省略時は拡張子で判断する')
+        parser.add_argument('--encoding', default='utf-8-sig')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if Path(path).suffix in ('.jsonl', '.ndjson') else 'csv')
+        self.batch_size = options['batch_size']
+        self.counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+        self.capacity_changed = False
+        self.categories_created = False
+        self.explicit_ids = False
+        # 業態は (category_l, name) → ID の対応を最初に読み込み、行ごとには問い合わせない
+        self.categories = {(c.category_l, c.name): c.pk for c in Category.objects.all()}
+        self.category_ids = set(self.categories.values())
+
+        self.started = time.monotonic()
+        if path == '-':
+            self.import_file(sys.stdin, fmt)
+        else:
+            try:
+                with open(path, encoding=options['encoding'], newline='') as f:
+                    self.import_file(f, fmt)
+            except OSError as e:
+                raise CommandError(e)
+
+        # bulk_create・bulk_update ではシグナルが飛ばないので、検索インデックスと営業区間は
+        # バッチごとに登録・更新した店舗の分だけ作り直し（write_batch）、残りは最後にまとめて反映する
+        self.stdout.write('派生データを更新しています...')
+        if self.explicit_ids:
+            self.reset_sequence()
+        if self.capacity_changed:
+            self.sync_slot_capacity()
+        if self.categories_created:
+            catalog.bump_version()
+        if self.counts['created'] or self.counts['updated']:
+            search_query.bump_version()
+
+        counts = self.counts
+        self.stdout.write(self.style.SUCCESS(
+            f'取り込みが完了しました（新規 {counts["created"]}件・更新 {counts["updated"]}件・'
+            f'変更なし {counts["unchanged"]}件・エラー {counts["errors"]}件、{time.monotonic() - self.started:.1f}秒）'
+        ))
+
+    def import_file(self, f, fmt):
+        batch = []
+        for line_no, row in self.read_rows(f, fmt):
+            try:
+                batch.append(self.parse_row(row))
+            except RowError as e:
+                self.counts['errors'] += 1
+                self.stderr.write(f'{line_no}行目: {e}')
+                continue
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+
+    def read_rows(self, f, fmt):
+        """(行番号, dict) を1行ずつ返す（ファイル全体は読み込まない）"""
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                self.counts['errors'] += 1
+                self.stderr.write(f'{line_no}行目: JSONとして読めません（{e}）')
+                continue
+            yield line_no, row
+
+    def parse_row(self, row):
+        """行を (照合キー, 店舗の値) に変換する"""
+        if not isinstance(row, dict):
+            raise RowError('オブジェクトではありません')
+        values = {}
+        for field in TEXT_FIELDS:
+            if field in row:
+                value = row[field]
+                value = str(value).strip() if value is not None else ''
+                if value and field in CHOICES and value not in CHOICES[field]:
+                    raise RowError(f'{field} の値が不正です: {value}')
+                values[field] = value or None
+        for field in INT_FIELDS:
+            if row.get(field) not in (None, ''):
+                try:
+                    values[field] = int(row[field])
+                except (TypeError, ValueError):
+                    raise RowError(f'{field} は数値で指定してください: {row[field]}')
+                if values[field] < 1:
+                    raise RowError(f'{field} は1以上で指定してください')
+        for field, limit in COORDINATE_RANGES.items():
+            if field in row:
+                try:
+                    values[field] = float(row[field]) if row[field] not in (None, '') else None
+                except (TypeError, ValueError):
+                    raise RowError(f'{field} は数値で指定してください: {row[field]}')
+                if values[field] is not None and abs(values[field]) > limit:
+                    raise RowError(f'{field} の値が範囲外です: {row[field]}')
+        if ('latitude' in values) != ('longitude' in values):
+            raise RowError('latitude と longitude は両方指定してください')
+        if 'latitude' in values:
+            values['geo_cell'] = geo_cell(values['latitude'], values['longitude'])
+        if not values.get('name'):
+            raise RowError('name は必須です')
+        if 'price_range' in values:
+            values['min_budget'], values['max_budget'] = budget_bounds(values['price_range'])
+        values['category_id'] = self.resolve_category(row)
+
+        pk = row.get('id')
+        if pk not in (None, ''):
+            try:
+                return ('id', int(pk)), values
+            except (TypeError, ValueError):
+                raise RowError(f'id は数値で指定してください: {pk}')
+        return ('name', values['name'], values.get('address')), values
+
+    def resolve_category(self, row):
+        category_id = row.get('category_id')
+        if category_id not in (None, ''):
+            try:
+                category_id = int(category_id)
+            except (TypeError, ValueError):
+                category_id = None
+            if category_id not in self.category_ids:
+                raise RowError(f'category_id の業態がありません: {row["category_id"]}')
+            return category_id
+        category_l = str(row.get('category_l') or '').strip()
+        name = str(row.get('category') or '').strip()
+        if not category_l or not name:
+            raise RowError('category_l と category（または category_id）は必須です')
+        key = (category_l, name)
+        if key not in self.categories:
+            # 未登録の業態はその場で作る（以降は対応表から引く）
+            category = Category.objects.create(category_l=category_l, name=name)
+            self.categories[key] = category.pk
+            self.category_ids.add(category.pk)
+            self.categories_created = True
+        return self.categories[key]
+
+    def write_batch(self, batch):
+        """1バッチ分を既存の店舗と照合し、まとめて登録・更新する"""
+        ids = [key[1] for key, _ in batch if key[0] == 'id']
+        names = [key[1] for key, _ in batch if key[0] == 'name']
+        existing = {('id', shop.pk): shop for shop in Shop.objects.filter(pk__in=ids)}
+        # 店舗名のインデックス（shop_name_idx）で引き、住所はPython側で照合する
+        for shop in Shop.objects.filter(name__in=names).order_by('pk'):
+            existing.setdefault(('name', shop.name, shop.address), shop)
+
+        to_create = {}
+        to_update = {}
+        fields = set()
+        hours_changed = set()  # 営業時間・定休日を変えた店舗の照合キー
+        for key, values in batch:
+            pending = key in to_create  # 同じバッチ内で先に出てきた新規の店舗
+            shop = to_create[key] if pending else existing.get(key)
+            if shop is None:
+                shop = Shop(**values)
+                if key[0] == 'id':
+                    shop.pk = key[1]
+                    self.explicit_ids = True
+                to_create[key] = shop
+                continue
+            changed = [field for field, value in values.items() if getattr(shop, field) != value]
+            if not changed:
+                if not pending and key not in to_update:
+                    self.counts['unchanged'] += 1
+                continue
+            for field in changed:
+                setattr(shop, field, values[field])
+            if not pending:
+                fields.update(changed)
+                to_update[key] = shop
+                self.capacity_changed = self.capacity_changed or 'capacity' in changed
+                if {'opening_hours', 'regular_holiday'} & set(changed):
+                    hours_changed.add(key)
+
+        with transaction.atomic():
+            Shop.objects.bulk_create(to_create.values(), batch_size=self.batch_size)
+            if to_update:
+                Shop.objects.bulk_update(to_update.values(), sorted(fields), batch_size=self.batch_size)
+        self.counts['created'] += len(to_create)
+        self.counts['updated'] += len(to_update)
+        self.index_batch(to_create, to_update, hours_changed)
+        self.report_progress()
+
+    def index_batch(self, to_create, to_update, hours_changed):
+        """登録・更新した店舗だけ、検索インデックスと営業区間を作り直す"""
+        created = list(to_create.values())
+        if any(shop.pk is None for shop in created):
+            self.resolve_created_pks(to_create)
+        changed = {**to_create, **to_update}
+        search.index_shops(shop.pk for shop in changed.values())
+        hours.index_shops(created + [to_update[key] for key in hours_changed])
+
+    def resolve_created_pks(self, to_create):
+        """bulk_create で主キーが返らないDB（MySQL）では、照合キーで登録した店舗を引き直す
+
+        既存の店舗と照合キーが一致した行は更新になるので、新規の店舗の照合キーはDB内で一意になる。
+        """
+        shops = {key: shop for key, shop in to_create.items() if shop.pk is None}
+        for shop in Shop.objects.filter(name__in={key[1] for key in shops}).only('pk', 'name', 'address'):
+            created = shops.get(('name', shop.name, shop.address))
+            if created is not None:
+                created.pk = shop.pk
+
+    def report_progress(self):
+        counts = self.counts
+        total = counts['created'] + counts['updated'] + counts['unchanged'] + counts['errors']
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(f'{total}件処理しました（{total / elapsed if elapsed else 0:.0f}件/秒）')
+
+    def reset_sequence(self):
+        """id を指定して登録した後、DBの連番を最大の id の続きに合わせる"""
+        statements = connection.ops.sequence_reset_sql(no_style(), [Shop])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def sync_slot_capacity(self):
+        """席数を変えた店舗の、これからの予約枠の席数を合わせる"""
+        ReservationSlot.objects.filter(start__gte=timezone.now()).exclude(capacity=F('shop__capacity')).update(
+            capacity=Subquery(Shop.objects.filter(pk=OuterRef('shop_id')).values('capacity')[:1]),
+        )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from userapp import hours, search_query
+from userapp.models import Shop
+
+
+class Command(BaseCommand):
+    help = '店舗の営業時間・定休日を解析して営業区間を作り直し、解析できなかった店舗を一覧する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--report', action='store_true', help='作り直さずに、解析できなかった店舗を一覧するだけにする')
+
+    def handle(self, *args, **options):
+        if not options['report']:
+            total, failed = hours.rebuild(batch_size=options['batch_size'])
+            search_query.bump_version()
+            self.stdout.write(self.style.SUCCESS(f'{total}件の店舗の営業区間を作り直しました（解析できない店舗 {failed}件）'))
+
+        shops = Shop.objects.exclude(opening_hours_error='').order_by('pk').values_list(
+            'pk', 'name', 'opening_hours', 'regular_holiday', 'opening_hours_error',
+        )
+        for pk, name, opening_hours, regular_holiday, error in shops.iterator(chunk_size=options['batch_size']):
+            self.stdout.write(f'#{pk} {name}: 営業時間「{opening_hours or ""}」定休日「{regular_holiday or ""}」 → {error}')
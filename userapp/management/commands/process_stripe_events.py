@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from userapp import stripe_events
+
+
+class Command(BaseCommand):
+    help = '受信したStripe Webhookイベントをまとめてサブスクリプションに反映するワーカー'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='未処理のイベントを1回だけ処理して終了する')
+        parser.add_argument('--interval', type=float, default=5, help='イベントがないときに待つ秒数')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            processed = stripe_events.drain(batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f'{processed}件のStripeイベントを反映しました')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
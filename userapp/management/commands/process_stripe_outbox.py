@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from userapp import stripe_outbox
+
+
+class Command(BaseCommand):
+    help = '登録されたStripeの処理（アウトボックス）を実行するワーカー'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='実行可能な処理を1回だけ処理して終了する')
+        parser.add_argument('--interval', type=float, default=2, help='処理がないときに待つ秒数')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        client = stripe_outbox.get_client()
+        while True:
+            processed = stripe_outbox.drain(client, batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f'{processed}件のStripe処理を実行しました')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
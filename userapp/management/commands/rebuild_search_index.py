@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from userapp import search
+
+
+class Command(BaseCommand):
+    help = '店舗のフリーワード検索インデックスを作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        total = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{total}件の店舗をインデックスしました（{type(backend).__name__}）'
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from userapp import similar
+
+
+class Command(BaseCommand):
+    help = 'レビューとお気に入りから、店舗ごとの似ている店舗を計算し直す（既定ではレビュー・お気に入りが変わった店舗の分だけ）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='すべての店舗を計算し直す（設定を変えたときや定期的な全体の見直しに使う）')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = similar.refresh(full=options['all'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count}件の店舗の似ている店舗を計算し直しました'))
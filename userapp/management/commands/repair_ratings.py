@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from userapp.models import Shop
+
+
+class Command(BaseCommand):
+    help = 'レビューから店舗の評価集計値（件数・合計・平均）を計算し直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shop_ids', nargs='*', type=int, help='対象の店舗ID（省略時は全店舗）')
+
+    def handle(self, *args, **options):
+        shops = Shop.objects.all()
+        if options['shop_ids']:
+            shops = shops.filter(pk__in=options['shop_ids'])
+        updated = Shop.recompute_ratings(shops)
+        self.stdout.write(self.style.SUCCESS(f'{updated}件の店舗の評価を更新しました'))
@@ -0,0 +1,91 @@
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """このアプリが使う Stripe API だけを返す簡易スタブ"""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive を確かめられるようにする
+    delay = 0
+    fail_rate = 0
+    responses = {}
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+    def handle_api(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if self.delay:
+            time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            return self.send_json(500, {'error': {'type': 'api_error', 'message': 'stub failure'}})
+
+        key = self.headers.get('Idempotency-Key')
+        if key and key in self.responses:
+            return self.send_json(200, self.responses[key])
+        body = self.build(method, self.path.split('?')[0].rstrip('/'))
+        if body is None:
+            return self.send_json(404, {'error': {'type': 'invalid_request_error', 'message': 'unknown path'}})
+        if key:
+            self.responses[key] = body
+        self.send_json(200, body)
+
+    def build(self, method, path):
+        suffix = uuid.uuid4().hex[:14]
+        if method == 'POST' and path == '/v1/customers':
+            return {'id': f'cus_stub{suffix}', 'object': 'customer'}
+        if method == 'POST' and path == '/v1/subscriptions':
+            return {'id': f'sub_stub{suffix}', 'object': 'subscription', 'status': 'active'}
+        if method == 'DELETE' and path.startswith('/v1/subscriptions/'):
+            return {'id': path.rsplit('/', 1)[1], 'object': 'subscription', 'status': 'canceled'}
+        if method == 'POST' and path == '/v1/checkout/sessions':
+            session_id = f'cs_test_stub{suffix}'
+            return {
+                'id': session_id, 'object': 'checkout.session',
+                'url': f'http://{self.headers.get("Host")}/checkout/{session_id}',
+            }
+        return None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', f'req_stub{uuid.uuid4().hex[:14]}')
+        # ヘッダと本文を1回で書き込み、keep-alive 接続で遅延ACKの待ちが出ないようにする
+        self._headers_buffer.append(b'\r\n' + data)
+        self.wfile.write(b''.join(self._headers_buffer))
+        self._headers_buffer = []
+
+
+class Command(BaseCommand):
+    help = 'Stripe API のローカルスタブを起動する（STRIPE_API_BASE に指定して使う）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--delay', type=float, default=0, help='応答までに待つ秒数（タイムアウトの確認用）')
+        parser.add_argument('--fail-rate', type=float, default=0, help='500エラーを返す割合（0〜1）')
+
+    def handle(self, *args, **options):
+        handler = type('Handler', (StubHandler,), {
+            'delay': options['delay'],
+            'fail_rate': options['fail_rate'],
+            'responses': {},
+        })
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), handler)
+        self.stdout.write(f'Stripe スタブを http://127.0.0.1:{options["port"]} で起動しました')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,31 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from userapp import mail
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '送信待ちのメールを1つの接続でまとめて送るワーカー'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='送信待ちのメールを1回だけ送って終了する')
+        parser.add_argument('--interval', type=float, default=5, help='送信待ちがないときに待つ秒数')
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                sent = mail.drain(batch_size=options['batch_size'])
+            except OSError as e:
+                # 接続できない間は送信待ちのまま残し、次の周回で送り直す
+                logger.warning('メールサーバーに接続できません: %s', e)
+                sent = 0
+            if sent:
+                self.stdout.write(f'{sent}通のメールを送信しました')
+            if options['once']:
+                return
+            time.sleep(options['interval'])
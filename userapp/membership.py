@@ -0,0 +1,67 @@
+"""有料会員かどうかの判定
+
+有料会員の判定は Subscription.active を正とし、結果はユーザーごとに短時間キャッシュする。
+CustomUser.is_paid_member と Profile.user_type は Subscription の保存時に同期する。
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Profile, Subscription
+
+STATUS_PAID = 'paid'
+STATUS_INACTIVE = 'inactive'  # 登録はあるが無効（解約済み・決済待ち）
+STATUS_NONE = 'none'  # 未登録
+
+
+def cache_key(user_id):
+    return f'membership:{user_id}'
+
+
+def get_status(user):
+    """ユーザーの会員状態を返す（同じリクエスト内ではユーザーオブジェクトに保持する）"""
+    if not user.is_authenticated:
+        return STATUS_NONE
+    status = getattr(user, '_membership_status', None)
+    if status is None:
+        key = cache_key(user.pk)
+        status = cache.get(key)
+        if status is None:
+            active = Subscription.objects.filter(user_id=user.pk).values_list('active', flat=True).first()
+            if active is None:
+                status = STATUS_NONE
+            else:
+                status = STATUS_PAID if active else STATUS_INACTIVE
+            cache.set(key, status, getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 60))
+        user._membership_status = status
+    return status
+
+
+def is_paid_member(user):
+    return get_status(user) == STATUS_PAID
+
+
+def invalidate(user_id):
+    cache.delete(cache_key(user_id))
+
+
+def sync_user_flags(user_id, active):
+    """ユーザーとプロフィールの有料会員フラグを Subscription に合わせる"""
+    get_user_model().objects.filter(pk=user_id).exclude(is_paid_member=active).update(is_paid_member=active)
+    user_type = 'payed' if active else 'free'
+    if not Profile.objects.filter(user_id=user_id).update(user_type=user_type):
+        # 一括登録したユーザーなどでプロフィールが未作成ならここで作る
+        Profile.objects.get_or_create(user_id=user_id, defaults={'user_type': user_type})
+
+
+def sync_many(states):
+    """{ユーザーID: 有料会員か} をまとめて同期し、キャッシュを破棄する（bulk_update の後に使う）"""
+    for active in (True, False):
+        user_ids = [user_id for user_id, value in states.items() if value == active]
+        if user_ids:
+            get_user_model().objects.filter(pk__in=user_ids).exclude(is_paid_member=active).update(is_paid_member=active)
+            Profile.objects.filter(user_id__in=user_ids).update(user_type='payed' if active else 'free')
+    keys = [cache_key(user_id) for user_id in states]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,86 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """値やIN句の個数の違いを無視したSQLの形を返す"""
+    sql = _IN_LIST_RE.sub('IN (...)', sql)
+    sql = _LITERAL_RE.sub('?', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+class QueryRecorder:
+    """connection.execute_wrapper に渡して、実行されたクエリを記録する"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def repeated(self, threshold):
+        """同じ形のSQLが threshold 回以上実行されたもの（N+1の疑い）"""
+        return [(sql, n) for sql, n in self.fingerprints.most_common() if n >= threshold]
+
+
+# リクエストごとのクエリ数・DB時間を計測し、予算超過やN+1を警告する
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.default_budget = getattr(settings, 'QUERY_BUDGET_DEFAULT', 20)
+        self.budgets = getattr(settings, 'QUERY_BUDGETS', {})
+        self.repeat_threshold = getattr(settings, 'QUERY_BUDGET_REPEAT_THRESHOLD', 5)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        view_name = match.view_name if match else None
+        budget = self.budgets.get(view_name, self.default_budget)
+        repeated = recorder.repeated(self.repeat_threshold)
+        over_budget = recorder.count > budget
+
+        response['X-DB-Query-Count'] = str(recorder.count)
+        response['X-DB-Time-Ms'] = f'{recorder.duration * 1000:.1f}'
+        if over_budget:
+            response['X-DB-Query-Budget-Exceeded'] = str(budget)
+
+        record = {
+            'path': request.path,
+            'view': view_name,
+            'queries': recorder.count,
+            'db_time_ms': round(recorder.duration * 1000, 1),
+            'budget': budget,
+            'repeated': [{'sql': sql, 'count': n} for sql, n in repeated],
+        }
+        level = logging.WARNING if over_budget or repeated else logging.INFO
+        logger.log(level, json.dumps(record, ensure_ascii=False), extra={'query_budget': record})
+        return response
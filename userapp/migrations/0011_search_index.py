@@ -0,0 +1,52 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:04
+
+import django.db.models.deletion
+from django.db import OperationalError, migrations, models
+
+
+def create_fts_table(apps, schema_editor):
+    # FTS5はSQLiteのみ。拡張が無効なビルドでは転置インデックスにフォールバックする
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS userapp_shop_fts "
+            "USING fts5(name, category, body, tokenize='ascii')"
+        )
+    except OperationalError:
+        pass
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS userapp_shop_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0010_remove_shop_rating_alter_shop_price_range_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopSearchDocument',
+            fields=[
+                ('shop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='userapp.shop')),
+                ('length', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShopSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=10)),
+                ('tf', models.PositiveIntegerField(default=1)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='userapp.shop')),
+            ],
+            options={
+                'unique_together': {('token', 'shop')},
+            },
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
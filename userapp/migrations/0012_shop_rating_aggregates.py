@@ -0,0 +1,46 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:06
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, FloatField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+
+def backfill_ratings(apps, schema_editor):
+    Shop = apps.get_model('userapp', 'Shop')
+    Review = apps.get_model('userapp', 'Review')
+    reviews = Review.objects.filter(shop=OuterRef('pk')).order_by().values('shop')
+    Shop.objects.update(
+        review_count=Coalesce(Subquery(reviews.annotate(c=Count('pk')).values('c')), 0),
+        score_sum=Coalesce(Subquery(reviews.annotate(s=Sum('score')).values('s')), 0),
+    )
+    Shop.objects.update(avg_score=Case(
+        When(review_count=0, then=Value(0.0)),
+        default=Cast(F('score_sum'), FloatField()) / F('review_count'),
+        output_field=FloatField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0011_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='avg_score',
+            field=models.FloatField(db_index=True, default=0, verbose_name='平均評価'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='レビュー数'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='score_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='スコア合計'),
+        ),
+        migrations.RunPython(backfill_ratings, migrations.RunPython.noop),
+    ]
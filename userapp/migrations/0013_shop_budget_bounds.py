@@ -0,0 +1,40 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:06
+
+from django.db import migrations, models
+
+
+def backfill_budget_bounds(apps, schema_editor):
+    Shop = apps.get_model('userapp', 'Shop')
+    shops = []
+    for shop in Shop.objects.exclude(price_range__isnull=True).exclude(price_range='').only('pk', 'price_range'):
+        try:
+            shop.min_budget = shop.max_budget = int(shop.price_range)
+        except ValueError:
+            continue
+        shops.append(shop)
+    Shop.objects.bulk_update(shops, ['min_budget', 'max_budget'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0012_shop_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='max_budget',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='予算上限'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='min_budget',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='予算下限'),
+        ),
+        migrations.AddIndex(
+            model_name='shop',
+            index=models.Index(fields=['min_budget', 'max_budget'], name='shop_budget_idx'),
+        ),
+        migrations.RunPython(backfill_budget_bounds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0013_shop_budget_bounds'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['shop', '-created_at'], name='review_shop_created_idx'),
+        ),
+    ]
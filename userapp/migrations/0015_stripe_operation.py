@@ -0,0 +1,39 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:17
+
+import django.db.models.deletion
+import django.utils.timezone
+import userapp.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0014_review_shop_created_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeOperation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('create_subscription', 'サブスクリプション登録'), ('cancel_subscription', 'サブスクリプション解約'), ('create_checkout_session', 'Checkoutセッション作成')], max_length=30, verbose_name='処理')),
+                ('payload', models.JSONField(default=dict)),
+                ('idempotency_key', models.CharField(default=userapp.models.new_idempotency_key, editable=False, max_length=64, unique=True)),
+                ('status', models.CharField(choices=[('pending', '処理待ち'), ('processing', '処理中'), ('done', '完了'), ('failed', '失敗')], default='pending', max_length=20, verbose_name='状態')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='試行回数')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='次回実行日時')),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='stripe_op_due_idx'), models.Index(fields=['user', '-created_at'], name='stripe_op_user_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:24
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_slots(apps, schema_editor):
+    # これからの予約を枠にまとめ、埋まっている席数を集計する（既存の超過分は席数を広げて収める）
+    Reservation = apps.get_model('userapp', 'Reservation')
+    ReservationSlot = apps.get_model('userapp', 'ReservationSlot')
+    reservations = list(
+        Reservation.objects.filter(date_time__gte=timezone.now()).select_related('shop')
+        .only('pk', 'date_time', 'num_people', 'shop__capacity', 'shop__slot_minutes')
+    )
+    groups = defaultdict(list)
+    for reservation in reservations:
+        local = timezone.localtime(reservation.date_time)
+        minutes = (local.hour * 60 + local.minute) // reservation.shop.slot_minutes * reservation.shop.slot_minutes
+        start = local.replace(hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+        groups[(reservation.shop, start)].append(reservation)
+    for (shop, start), members in groups.items():
+        booked = sum(r.num_people for r in members)
+        slot = ReservationSlot.objects.create(
+            shop_id=shop.pk, start=start, capacity=max(shop.capacity, booked), booked=booked,
+        )
+        for reservation in members:
+            reservation.slot_id = slot.pk
+    Reservation.objects.bulk_update(reservations, ['slot'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0017_queued_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='capacity',
+            field=models.PositiveIntegerField(default=20, verbose_name='1枠あたりの席数'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='slot_minutes',
+            field=models.PositiveSmallIntegerField(default=60, verbose_name='予約枠の長さ（分）'),
+        ),
+        migrations.CreateModel(
+            name='ReservationSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='枠の開始日時')),
+                ('capacity', models.PositiveIntegerField(verbose_name='席数')),
+                ('booked', models.PositiveIntegerField(default=0, verbose_name='予約済みの席数')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='userapp.shop')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='slot',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='userapp.reservationslot'),
+        ),
+        migrations.AddConstraint(
+            model_name='reservationslot',
+            constraint=models.UniqueConstraint(fields=('shop', 'start'), name='reservation_slot_uniq'),
+        ),
+        migrations.RunPython(backfill_slots, migrations.RunPython.noop),
+    ]
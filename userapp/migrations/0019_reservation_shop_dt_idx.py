@@ -0,0 +1,19 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0018_reservation_slots'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['shop', 'date_time'], name='reservation_shop_dt_idx'),
+        ),
+    ]
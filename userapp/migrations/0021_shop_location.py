@@ -0,0 +1,28 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0020_admin_date_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=24, verbose_name='グリッドのセル'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, verbose_name='緯度'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, verbose_name='経度'),
+        ),
+    ]
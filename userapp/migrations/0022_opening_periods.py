@@ -0,0 +1,53 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_opening_periods(apps, schema_editor):
+    # 解析は現行の hours.parse を使う（記述から区間を作るだけでモデルには触れない）
+    from userapp.hours import parse
+
+    Shop = apps.get_model('userapp', 'Shop')
+    OpeningPeriod = apps.get_model('userapp', 'OpeningPeriod')
+    periods, failed = [], []
+    for shop in Shop.objects.only('pk', 'opening_hours', 'regular_holiday').iterator(chunk_size=1000):
+        intervals, problems = parse(shop.opening_hours, shop.regular_holiday)
+        periods.extend(
+            OpeningPeriod(shop_id=shop.pk, weekday=day, open_minute=start, close_minute=end)
+            for day, start, end in intervals
+        )
+        if problems:
+            shop.opening_hours_error = ' / '.join(problems)[:255]
+            failed.append(shop)
+    OpeningPeriod.objects.bulk_create(periods, batch_size=1000)
+    Shop.objects.bulk_update(failed, ['opening_hours_error'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0021_shop_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='opening_hours_error',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='営業時間の解析エラー'),
+        ),
+        migrations.CreateModel(
+            name='OpeningPeriod',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(verbose_name='曜日')),
+                ('open_minute', models.PositiveSmallIntegerField(verbose_name='開店（0時からの分）')),
+                ('close_minute', models.PositiveSmallIntegerField(verbose_name='閉店（0時からの分）')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='opening_periods', to='userapp.shop')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['weekday', 'open_minute', 'close_minute'], name='opening_period_idx')],
+            },
+        ),
+        migrations.RunPython(build_opening_periods, migrations.RunPython.noop),
+    ]
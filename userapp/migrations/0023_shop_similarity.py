@@ -0,0 +1,32 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0022_opening_periods'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='similar_shops_stale',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ShopSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='順位')),
+                ('score', models.FloatField(verbose_name='類似度')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='userapp.shop')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='userapp.shop')),
+            ],
+            options={
+                'unique_together': {('shop', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:58
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def fix_zero_slot_minutes(apps, schema_editor):
+    # 制約を付ける前に、枠の長さが 0 の店舗を既定値に戻す
+    Shop = apps.get_model('userapp', 'Shop')
+    Shop.objects.filter(slot_minutes__lt=1).update(slot_minutes=60)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0023_shop_similarity'),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_zero_slot_minutes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='shop',
+            name='slot_minutes',
+            field=models.PositiveSmallIntegerField(default=60, validators=[django.core.validators.MinValueValidator(1)], verbose_name='予約枠の長さ（分）'),
+        ),
+        migrations.AddConstraint(
+            model_name='shop',
+            constraint=models.CheckConstraint(check=models.Q(('slot_minutes__gte', 1)), name='shop_slot_minutes_positive'),
+        ),
+    ]
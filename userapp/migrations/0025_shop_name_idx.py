@@ -0,0 +1,17 @@
+# Generated by Django 5.0.5 on 2026-10-18 20:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0024_shop_slot_minutes_positive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shop',
+            index=models.Index(fields=['name'], name='shop_name_idx'),
+        ),
+    ]
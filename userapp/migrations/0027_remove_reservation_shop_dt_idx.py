@@ -0,0 +1,18 @@
+# Generated by Django 5.0.5 on 2026-10-18 22:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userapp', '0026_queued_email_sending'),
+    ]
+
+    operations = [
+        # 空き状況は予約枠 ReservationSlot から読むので、予約の (店舗, 日時) のインデックスは使わない
+        migrations.RemoveIndex(
+            model_name='reservation',
+            name='reservation_shop_dt_idx',
+        ),
+    ]
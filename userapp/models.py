@@ -1,7 +1,14 @@
-from django.db import models
+import math
+import uuid
+
+from django.db import models, transaction
+from django.db.models import Case, Count, F, FloatField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
 from django.conf import settings
+from django.core.validators import MinValueValidator
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
 
 # 店舗カテゴリ
 class Category(models.Model):
@@ -34,6 +41,21 @@ BUDGET_CHOICES = [
     ('5000', '5000円'),
 ]
 
+def budget_bounds(price_range):
+    """予算の選択値を (下限, 上限) の整数に変換する"""
+    try:
+        budget = int(price_range)
+    except (TypeError, ValueError):
+        return None, None
+    return budget, budget
+
+def geo_cell(latitude, longitude):
+    """緯度・経度を含むグリッドのセル（GEO_CELL_DEGREES 度四方）のキー。位置がなければ空文字"""
+    if latitude is None or longitude is None:
+        return ''
+    size = getattr(settings, 'GEO_CELL_DEGREES', 0.01)
+    return f'{math.floor(latitude / size)}:{math.floor(longitude / size)}'
+
 # 店舗情報
 class Shop(models.Model):
     name = models.CharField("店舗名", max_length=255)
@@ -46,16 +68,80 @@ class Shop(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name="カテゴリ")
     description = models.TextField(blank=True, null=True)
     region = models.CharField("地域", max_length=10, choices=REGION_CHOICES, blank=True, null=True)  # 地域を選択式に変更
+    # レビューの集計値（Review の保存・削除時に差分で更新する）
+    review_count = models.PositiveIntegerField("レビュー数", default=0)
+    score_sum = models.PositiveIntegerField("スコア合計", default=0)
+    avg_score = models.FloatField("平均評価", default=0, db_index=True)
+    # 予算の数値版（price_range から保存時に設定し、範囲検索に使う）
+    min_budget = models.PositiveIntegerField("予算下限", blank=True, null=True, editable=False)
+    max_budget = models.PositiveIntegerField("予算上限", blank=True, null=True, editable=False)
+    # 予約枠（1枠あたりの席数と枠の長さ）
+    capacity = models.PositiveIntegerField("1枠あたりの席数", default=20)
+    slot_minutes = models.PositiveSmallIntegerField("予約枠の長さ（分）", default=60, validators=[MinValueValidator(1)])
+    # 位置（geocode_shops コマンドで住所から設定する）と、近くの店舗を探すためのグリッドのセル
+    latitude = models.FloatField("緯度", blank=True, null=True)
+    longitude = models.FloatField("経度", blank=True, null=True)
+    geo_cell = models.CharField("グリッドのセル", max_length=24, blank=True, default='', editable=False, db_index=True)
+    # 営業時間・定休日を営業区間（OpeningPeriod）にできなかった理由（空なら解析済み）
+    opening_hours_error = models.CharField("営業時間の解析エラー", max_length=255, blank=True, default='', editable=False)
+    # レビュー・お気に入りが変わり、似ている店舗の計算し直しが必要（similar.py）
+    similar_shops_stale = models.BooleanField(default=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['min_budget', 'max_budget'], name='shop_budget_idx'),
+            # import_shops で id のない行を店舗名・住所で既存の店舗と照合する
+            models.Index(fields=['name'], name='shop_name_idx'),
+        ]
+        constraints = [
+            # 枠の長さが 0 だと予約日時を枠に割り当てられない（booking.slot_start）
+            models.CheckConstraint(check=models.Q(slot_minutes__gte=1), name='shop_slot_minutes_positive'),
+        ]
     
     def __str__(self):
         return self.name
 
-    #def update_rating(self):
-       # """レビューに基づいて店舗の平均評価を更新する"""
-        #reviews = self.review_set.all()
-        #if reviews.exists():
-            #self.rating = reviews.aggregate(models.Avg('score'))['score__avg']
-            #self.save()
+    def save(self, *args, **kwargs):
+        self.min_budget, self.max_budget = budget_bounds(self.price_range)
+        self.geo_cell = geo_cell(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'price_range' in update_fields:
+            kwargs['update_fields'] = update_fields = {*update_fields, 'min_budget', 'max_budget'}
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geo_cell'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def update_rating(cls, shop_id, count_delta, score_delta):
+        """レビューの増減を店舗の集計値に反映する"""
+        with transaction.atomic():
+            cls.objects.filter(pk=shop_id).update(
+                review_count=F('review_count') + count_delta,
+                score_sum=F('score_sum') + score_delta,
+            )
+            # UPDATE内の列参照の評価順はDBごとに異なるので、平均は別の文で更新する
+            cls.objects.filter(pk=shop_id).update(avg_score=AVG_SCORE)
+
+    @classmethod
+    def recompute_ratings(cls, shops=None):
+        """レビューから集計値を一括で計算し直す"""
+        if shops is None:
+            shops = cls.objects.all()
+        reviews = Review.objects.filter(shop=OuterRef('pk')).order_by().values('shop')
+        with transaction.atomic():
+            updated = shops.update(
+                review_count=Coalesce(Subquery(reviews.annotate(c=Count('pk')).values('c')), 0),
+                score_sum=Coalesce(Subquery(reviews.annotate(s=Sum('score')).values('s')), 0),
+            )
+            shops.update(avg_score=AVG_SCORE)
+        return updated
+
+# 平均評価の計算式（レビューがなければ0）
+AVG_SCORE = Case(
+    When(review_count=0, then=Value(0.0)),
+    default=Cast(F('score_sum'), FloatField()) / F('review_count'),
+    output_field=FloatField(),
+)
 
 # レビュー
 class Review(models.Model):
@@ -68,14 +154,53 @@ class Review(models.Model):
 
     class Meta:
         unique_together = ('shop', 'user')
+        indexes = [
+            models.Index(fields=['shop', '-created_at'], name='review_shop_created_idx'),
+            # 管理画面・書き出しの期間での絞り込み
+            models.Index(fields=['created_at'], name='review_created_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 編集時に差分を計算できるよう、読み込んだ時点の値を覚えておく
+        instance._loaded_rating = (instance.__dict__.get('shop_id'), instance.__dict__.get('score'))
+        return instance
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.shop.update_rating()  # レビューが保存されるたびに評価を更新
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # レビューが保存されるたびに評価を更新
+            if adding:
+                Shop.update_rating(self.shop_id, 1, self.score)
+            else:
+                old_shop_id, old_score = getattr(self, '_loaded_rating', (None, None))
+                if old_shop_id is None or old_score is None:
+                    Shop.recompute_ratings(Shop.objects.filter(pk=self.shop_id))
+                elif old_shop_id != self.shop_id:
+                    Shop.update_rating(old_shop_id, -1, -old_score)
+                    Shop.update_rating(self.shop_id, 1, self.score)
+                elif old_score != self.score:
+                    Shop.update_rating(self.shop_id, 0, self.score - old_score)
+        self._loaded_rating = (self.shop_id, self.score)
 
     def __str__(self):
         return f'{self.shop.name} - {self.user.username}'
 
+# 検索インデックス（FTS5が使えないDB向けの転置インデックス）
+class ShopSearchDocument(models.Model):
+    shop = models.OneToOneField(Shop, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    length = models.PositiveIntegerField(default=0)
+
+class ShopSearchToken(models.Model):
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=10)
+    tf = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('token', 'shop')
+
 # サブスクリプション
 class Subscription(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -86,16 +211,179 @@ class Subscription(models.Model):
     def __str__(self):
         return self.user.username
 
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+# Stripe API の呼び出し待ち（アウトボックス）
+class StripeOperation(models.Model):
+    CREATE_SUBSCRIPTION = 'create_subscription'
+    CANCEL_SUBSCRIPTION = 'cancel_subscription'
+    CREATE_CHECKOUT_SESSION = 'create_checkout_session'
+    OPERATION_CHOICES = (
+        (CREATE_SUBSCRIPTION, 'サブスクリプション登録'),
+        (CANCEL_SUBSCRIPTION, 'サブスクリプション解約'),
+        (CREATE_CHECKOUT_SESSION, 'Checkoutセッション作成'),
+    )
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '処理待ち'),
+        (PROCESSING, '処理中'),
+        (DONE, '完了'),
+        (FAILED, '失敗'),
+    )
+
+    operation = models.CharField('処理', max_length=30, choices=OPERATION_CHOICES)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    payload = models.JSONField(default=dict)
+    # 再試行してもStripe側で二重に処理されないよう、呼び出しごとに同じキーを送る
+    idempotency_key = models.CharField(max_length=64, unique=True, default=new_idempotency_key, editable=False)
+    status = models.CharField('状態', max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField('試行回数', default=0)
+    next_attempt_at = models.DateTimeField('次回実行日時', default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='stripe_op_due_idx'),
+            models.Index(fields=['user', '-created_at'], name='stripe_op_user_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_operation_display()} ({self.get_status_display()})'
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+# Stripe から受け取った Webhook イベント（受信時はそのまま保存し、後でまとめて反映する）
+class StripeEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='stripe_event_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.type} ({self.event_id})'
+
+# 送信待ちのメール（QueuedEmailBackend が登録し、send_queued_email コマンドが送る）
+class QueuedEmail(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '送信待ち'),
+        (SENDING, '送信中'),
+        (SENT, '送信済み'),
+        (FAILED, '送信失敗'),
+    )
+
+    subject = models.CharField('件名', max_length=998)
+    body = models.TextField('本文', blank=True)
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    alternatives = models.JSONField(default=list)  # [[本文, MIMEタイプ], ...]
+    attachments = models.JSONField(default=list)  # [[ファイル名, base64の内容, MIMEタイプ], ...]
+    status = models.CharField('状態', max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField('試行回数', default=0)
+    # 送信待ちなら次に送る時刻、送信中なら取り直してよい時刻（ワーカーの異常終了に備える）
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='queued_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} ({self.get_status_display()})'
+
+# 予約枠ごとの埋まっている席数（予約時に条件付きUPDATEで加算する）
+class ReservationSlot(models.Model):
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE)
+    start = models.DateTimeField("枠の開始日時")
+    capacity = models.PositiveIntegerField("席数")
+    booked = models.PositiveIntegerField("予約済みの席数", default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'start'], name='reservation_slot_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop.name} - {self.start} ({self.booked}/{self.capacity})'
+
+    @property
+    def remaining(self):
+        return max(0, self.capacity - self.booked)
+
 # 店舗予約
 class Reservation(models.Model):
     shop = models.ForeignKey(Shop, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     date_time = models.DateTimeField("予約日時")
     num_people = models.PositiveIntegerField("人数")
+    slot = models.ForeignKey(ReservationSlot, on_delete=models.SET_NULL, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # 管理画面・書き出しの期間での絞り込み
+            models.Index(fields=['date_time'], name='reservation_dt_idx'),
+        ]
 
     def __str__(self):
         return f'{self.shop.name} - {self.user.username} - {self.date_time}'
 
+# 曜日ごとの営業区間（営業時間・定休日の記述から hours.py で作る。日付をまたぐ分は翌日に分ける）
+class OpeningPeriod(models.Model):
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='opening_periods')
+    weekday = models.PositiveSmallIntegerField("曜日")  # 0=月曜
+    open_minute = models.PositiveSmallIntegerField("開店（0時からの分）")
+    close_minute = models.PositiveSmallIntegerField("閉店（0時からの分）")
+
+    class Meta:
+        indexes = [
+            # 指定の曜日・時刻に営業中の店舗の絞り込みに使う
+            models.Index(fields=['weekday', 'open_minute', 'close_minute'], name='opening_period_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_id} {"月火水木金土日"[self.weekday]} {self.open_minute // 60}:{self.open_minute % 60:02d}-{self.close_minute // 60}:{self.close_minute % 60:02d}'
+
+# 似ている店舗の上位（refresh_similar_shops コマンドが similar.py で計算して入れ替える）
+class ShopSimilarity(models.Model):
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='similarities')
+    similar = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='+')
+    rank = models.PositiveSmallIntegerField("順位")  # 0 が最も似ている
+    score = models.FloatField("類似度")
+
+    class Meta:
+        # 店舗ページは (shop, rank) のインデックスを順に読むだけで表示できる
+        unique_together = ('shop', 'rank')
+
+    def __str__(self):
+        return f'{self.shop_id} → {self.similar_id} ({self.score:.3f})'
+
 class Favorite(models.Model):
     shop = models.ForeignKey(Shop, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -125,15 +413,45 @@ class Profile(models.Model):
     stripe_card_no = models.CharField(max_length=20, blank=True)
     stripe_card_brand = models.CharField(max_length=20, blank=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 変更のあった列だけを保存できるよう、読み込んだ時点の値を覚えておく
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def changed_fields(self):
+        """読み込み後に値が変わった列名の一覧（未保存なら全列）"""
+        loaded = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded is None:
+            return [f.attname for f in self._meta.concrete_fields if not f.primary_key]
+        return [
+            attname for attname, value in loaded.items()
+            if attname != self._meta.pk.attname and getattr(self, attname) != value
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {f.attname: getattr(self, f.attname) for f in self._meta.concrete_fields}
+
 # ユーザー作成時にプロフィールを自動作成
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def create_user_profile(sender, instance, created, **kwargs):
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
     """Create user profile when user is created"""
-    if created:
-        Profile.objects.create(user=instance)
+    if created and not raw:
+        Profile.objects.get_or_create(user=instance)
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def save_user_profile(sender, instance, **kwargs):
-    """Update user profile when user is saved"""
-    instance.profile.save()
+def save_user_profile(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    """Save the user's profile when it was loaded and changed alongside the user"""
+    # last_login など列を指定した保存や新規作成ではプロフィールに触れない
+    if created or raw or update_fields is not None:
+        return
+    # プロフィールを読み込んでいなければ変更もないので、SELECTもしない
+    profile = instance._state.fields_cache.get('profile')
+    if profile is None:
+        return
+    changed = profile.changed_fields()
+    if changed:
+        profile.save(update_fields=None if profile._state.adding else changed)
 
@@ -0,0 +1,49 @@
+"""件数を推定するページネーター
+
+管理画面の一覧は、ページごとに表全体の COUNT(*) を実行する。行数が多い表では
+これが一覧の表示時間の大半になるので、絞り込みのない一覧では DB の統計情報
+（PostgreSQL）か主キーの最大値から件数を推定する。推定値が
+ADMIN_ESTIMATED_COUNT_THRESHOLD 未満なら数えても軽いので正確に数える。
+"""
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max
+from django.utils.functional import cached_property
+
+
+def estimated_count(queryset):
+    """表の行数の推定値（推定できなければ None）"""
+    model = queryset.model
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+            row = cursor.fetchone()
+        # 一度も ANALYZE されていない表は -1 になる
+        return row[0] if row and row[0] >= 0 else None
+    # 主キーの最大値はインデックスから読めるので、表の大きさによらず速い
+    return model._default_manager.using(queryset.db).aggregate(last=Max('pk'))['last']
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where and not query.distinct:
+            estimate = estimated_count(self.object_list)
+            if estimate is not None and estimate >= getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 10000):
+                return estimate
+        return super().count
+
+
+class KnownCountPaginator(Paginator):
+    """件数が分かっている一覧のページネーター（集計列などの件数を使い、COUNT(*) を実行しない）"""
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self._known_count = count
+
+    @property
+    def count(self):
+        return self._known_count
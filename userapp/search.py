@@ -0,0 +1,294 @@
+"""店舗のフリーワード検索インデックス
+
+SQLiteではFTS5の仮想テーブル、それ以外のDBでは ShopSearchToken による
+転置インデックスを使う。どちらも文字 n-gram（bi-gram）で分かち書きするので、
+分かち書きのない日本語でも部分一致に近い検索ができる。
+"""
+import math
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Avg, Count
+from django.db.models.expressions import RawSQL
+
+from .models import Shop, ShopSearchDocument, ShopSearchToken
+
+NGRAM_SIZE = 2
+
+FTS_TABLE = 'userapp_shop_fts'
+
+# 項目ごとの重み（店舗名 > カテゴリ名 > 紹介文・住所）
+FIELD_WEIGHTS = {
+    'name': 3,
+    'category': 2,
+    'body': 1,
+}
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SEPARATOR_RE = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """全角・半角や大文字・小文字の揺れを吸収する"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def tokenize(text, n=NGRAM_SIZE, tail=False):
+    """テキストを n-gram のトークン列に分割する
+
+    tail=True のときは末尾の1文字もトークンに加え、1文字の語の前方一致で
+    語末の文字も拾えるようにする（インデックス作成時に使う）。
+    """
+    tokens = []
+    for chunk in _SEPARATOR_RE.split(normalize(text)):
+        if not chunk:
+            continue
+        if len(chunk) < n:
+            tokens.append(chunk)
+        else:
+            tokens.extend(chunk[i:i + n] for i in range(len(chunk) - n + 1))
+            if tail:
+                tokens.append(chunk[-1])
+    return tokens
+
+
+def parse_query(freeword, n=NGRAM_SIZE):
+    """フリーワードを語ごとのトークン列に分ける（語同士はAND条件）"""
+    terms = []
+    for chunk in _SEPARATOR_RE.split(normalize(freeword)):
+        if chunk:
+            terms.append(tokenize(chunk, n))
+    return terms
+
+
+def shop_fields(shop):
+    """インデックス対象の項目を取り出す"""
+    body = ' '.join(filter(None, [shop.pr_long, shop.description, shop.address]))
+    return {
+        'name': shop.name,
+        'category': shop.category.name if shop.category_id else '',
+        'body': body,
+    }
+
+
+class Fts5Backend:
+    """SQLite FTS5 を使うバックエンド"""
+
+    def index(self, shops):
+        rows = []
+        for shop in shops:
+            fields = shop_fields(shop)
+            rows.append((
+                shop.pk,
+                ' '.join(tokenize(fields['name'], tail=True)),
+                ' '.join(tokenize(fields['category'], tail=True)),
+                ' '.join(tokenize(fields['body'], tail=True)),
+            ))
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, category, body) VALUES (%s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove(self, shop_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in shop_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+    def match_expression(self, terms):
+        expressions = []
+        for tokens in terms:
+            if len(tokens) == 1 and len(tokens[0]) < NGRAM_SIZE:
+                # 1文字の語は前方一致で探す
+                expressions.append(f'"{tokens[0]}" *')
+            else:
+                # 連続するn-gramのフレーズ一致で部分一致を表現する
+                expressions.append('"%s"' % ' '.join(tokens))
+        return ' AND '.join(expressions)
+
+    def matching(self, terms):
+        return [RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.match_expression(terms)])]
+
+    def search(self, terms, limit, within=None):
+        weights = ', '.join(str(float(FIELD_WEIGHTS[f])) for f in ('name', 'category', 'body'))
+        sql = f'SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, {weights}) AS score FROM {FTS_TABLE}'
+        params = []
+        if within is not None:
+            # 絞り込み後の店舗の中で順位を付ける。CROSS JOIN で FTS 側を外側のループに固定する
+            # （rowid IN (...) では店舗ごとに全文検索を評価し直して遅い）
+            within_sql, within_params = within.order_by().values('pk').query.sql_with_params()
+            sql += f' CROSS JOIN ({within_sql}) AS within ON within.id = {FTS_TABLE}.rowid'
+            params.extend(within_params)
+        sql += f' WHERE {FTS_TABLE} MATCH %s ORDER BY score, {FTS_TABLE}.rowid LIMIT %s'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*params, self.match_expression(terms), limit])
+            # bm25() は小さいほど適合度が高いので符号を反転する
+            return [(shop_id, -score) for shop_id, score in cursor.fetchall()]
+
+
+class InvertedIndexBackend:
+    """どのDBでも動く転置インデックスのバックエンド"""
+
+    def index(self, shops):
+        shops = list(shops)
+        if not shops:
+            return
+        documents = []
+        tokens = []
+        for shop in shops:
+            counts = defaultdict(int)
+            length = 0
+            for field, text in shop_fields(shop).items():
+                for token in tokenize(text, tail=True):
+                    counts[token] += FIELD_WEIGHTS[field]
+                    length += 1
+            documents.append(ShopSearchDocument(shop_id=shop.pk, length=length))
+            tokens.extend(ShopSearchToken(shop_id=shop.pk, token=t, tf=tf) for t, tf in counts.items())
+        with transaction.atomic():
+            self.remove([shop.pk for shop in shops])
+            ShopSearchDocument.objects.bulk_create(documents)
+            ShopSearchToken.objects.bulk_create(tokens, batch_size=1000)
+
+    def remove(self, shop_ids):
+        ShopSearchToken.objects.filter(shop_id__in=shop_ids).delete()
+        ShopSearchDocument.objects.filter(shop_id__in=shop_ids).delete()
+
+    def clear(self):
+        ShopSearchToken.objects.all().delete()
+        ShopSearchDocument.objects.all().delete()
+
+    def _matching(self, tokens):
+        if len(tokens) == 1 and len(tokens[0]) < NGRAM_SIZE:
+            return ShopSearchToken.objects.filter(token__startswith=tokens[0])
+        return ShopSearchToken.objects.filter(token__in=set(tokens))
+
+    def _term_shops(self, tokens):
+        """語のトークンをすべて含む店舗IDの QuerySet"""
+        required = 1 if len(tokens) == 1 and len(tokens[0]) < NGRAM_SIZE else len(set(tokens))
+        return (
+            self._matching(tokens).values('shop_id')
+            .annotate(hits=Count('token', distinct=True))
+            .filter(hits__gte=required)
+            .values_list('shop_id', flat=True)
+        )
+
+    def matching(self, terms):
+        return [self._term_shops(tokens) for tokens in terms]
+
+    def search(self, terms, limit, within=None):
+        # すべての語のトークンを含む店舗だけを候補にする
+        candidates = None
+        for tokens in terms:
+            ids = set(self._term_shops(tokens))
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        if within is not None:
+            candidates = set(within.filter(pk__in=candidates).values_list('pk', flat=True))
+            if not candidates:
+                return []
+
+        stats = ShopSearchDocument.objects.aggregate(total=Count('shop'), avg_length=Avg('length'))
+        total = stats['total'] or 0
+        avg_length = stats['avg_length'] or 1
+        lengths = dict(ShopSearchDocument.objects.filter(shop_id__in=candidates).values_list('shop_id', 'length'))
+
+        scores = defaultdict(float)
+        for tokens in terms:
+            matching = self._matching(tokens)
+            doc_freq = dict(matching.values('token').annotate(df=Count('shop')).values_list('token', 'df'))
+            for shop_id, token, tf in matching.filter(shop_id__in=candidates).values_list('shop_id', 'token', 'tf'):
+                df = doc_freq.get(token, 0)
+                idf = math.log((total - df + 0.5) / (df + 0.5) + 1)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths.get(shop_id, 0) / avg_length)
+                scores[shop_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+
+_fts5_available = {}
+
+
+def get_backend():
+    """利用中のDBに合ったバックエンドを返す"""
+    if connection.vendor == 'sqlite':
+        alias = connection.settings_dict['NAME']
+        if alias not in _fts5_available:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+                _fts5_available[alias] = cursor.fetchone() is not None
+        if _fts5_available[alias]:
+            return Fts5Backend()
+    return InvertedIndexBackend()
+
+
+def search_shops(freeword, limit=None, within=None):
+    """フリーワードに一致する店舗IDを適合度の高い順に先頭 limit 件返す
+
+    within（店舗の QuerySet）を渡すと、その中の店舗だけに順位を付ける。
+    """
+    terms = parse_query(freeword)
+    if not terms:
+        return []
+    if limit is None:
+        limit = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+    return [shop_id for shop_id, _ in get_backend().search(terms, limit, within)]
+
+
+def filter_matching(queryset, freeword):
+    """フリーワードに一致するすべての店舗に絞り込む（件数の上限なし、順位は付けない）"""
+    terms = parse_query(freeword)
+    if not terms:
+        return queryset.none()
+    for shop_ids in get_backend().matching(terms):
+        queryset = queryset.filter(pk__in=shop_ids)
+    return queryset
+
+
+def index_shops(shop_ids):
+    """指定した店舗をインデックスに登録し直す"""
+    shop_ids = list(shop_ids)
+    backend = get_backend()
+    shops = Shop.objects.filter(pk__in=shop_ids).select_related('category')
+    found = {shop.pk for shop in shops}
+    backend.index(shops)
+    missing = [pk for pk in shop_ids if pk not in found]
+    if missing:
+        backend.remove(missing)
+
+
+def remove_shops(shop_ids):
+    get_backend().remove(list(shop_ids))
+
+
+def rebuild_index(batch_size=1000):
+    """インデックスを全件作り直す"""
+    backend = get_backend()
+    total = 0
+    with transaction.atomic():
+        backend.clear()
+        queryset = Shop.objects.select_related('category').order_by('pk')
+        batch = []
+        for shop in queryset.iterator(chunk_size=batch_size):
+            batch.append(shop)
+            if len(batch) >= batch_size:
+                backend.index(batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            backend.index(batch)
+            total += len(batch)
+    return total
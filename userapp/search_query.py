@@ -0,0 +1,206 @@
+"""店舗検索の絞り込み・ページング・結果キャッシュ"""
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import hours, search
+from .models import Shop
+
+# 検索条件として扱うGETパラメータ
+SEARCH_FIELDS = ('selected_category', 'freeword', 'region', 'price_range', 'rating', 'open_at')
+
+# 店舗データが変わるたびに更新するバージョンキー
+VERSION_KEY = 'shop_search:version'
+
+
+def page_size():
+    return getattr(settings, 'SEARCH_PAGE_SIZE', 10)
+
+
+def max_results():
+    return getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+
+
+def get_cache():
+    """検索用のキャッシュ（複数台構成では共有キャッシュを指定する）"""
+    return caches[getattr(settings, 'SEARCH_CACHE_ALIAS', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+
+
+def normalize_params(data):
+    """検索条件から空の値を除き、表記揺れを揃えた dict を返す"""
+    params = {}
+    for field in SEARCH_FIELDS:
+        value = (data.get(field) or '').strip()
+        if field == 'freeword':
+            value = ' '.join(search.normalize(value).split())
+        if field == 'open_at':
+            # 「now」や日時は曜日と時刻に揃える（結果は曜日と時刻だけで決まる）
+            open_at = hours.parse_open_at(value)
+            value = hours.format_open_at(*open_at) if open_at else ''
+        if value:
+            params[field] = value
+    return params
+
+
+def get_version():
+    cache = get_cache()
+    # 初期値を時刻にして、キャッシュが消えた後に古い値と衝突しないようにする
+    cache.add(VERSION_KEY, time.time_ns(), None)
+    return cache.get(VERSION_KEY)
+
+
+def bump_version(**kwargs):
+    """店舗・カテゴリ・レビューの変更時に呼び、検索関連のキャッシュをまとめて無効にする"""
+    cache = get_cache()
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def cache_key(prefix, params):
+    """正規化済みの検索条件からキャッシュキーを作る"""
+    digest = hashlib.md5(urlencode(sorted(params.items())).encode()).hexdigest()
+    return f'shop_search:{prefix}:{get_version()}:{digest}'
+
+
+def filter_shops(params):
+    """検索条件で絞り込んだ QuerySet を返す"""
+    category_id = params.get('selected_category')
+    freeword = params.get('freeword')
+    region = params.get('region')  # 地域
+    price_range = params.get('price_range')  # 価格帯
+    rating = params.get('rating')  # 評価
+    open_at = hours.parse_open_at(params.get('open_at'))  # 営業中の曜日・時刻
+
+    query = Shop.objects.all()
+
+    # カテゴリのフィルタリング
+    if category_id:
+        query = query.filter(category_id=category_id)
+
+    # フリーワードのフィルタリング（検索インデックスに一致する全件をDBで絞り込む）
+    if freeword:
+        query = search.filter_matching(query, freeword)
+
+    # 地域のフィルタリング（住所に地域が含まれるか）
+    if region:
+        query = query.filter(region__icontains=region)
+
+    # 価格帯のフィルタリング（数値の予算列で範囲検索）
+    if price_range:
+        price_range_values = price_range.split('-')
+        min_price = int(price_range_values[0])
+        max_price = price_range_values[1]
+        if max_price:
+            max_price = int(max_price)
+            query = query.filter(min_budget__gte=min_price, min_budget__lte=max_price)
+        else:
+            query = query.filter(min_budget__gte=min_price)
+
+    # 評価のフィルタリング（平均スコアでフィルタリング）
+    if rating:
+        try:
+            min_rating_value = int(rating)
+            max_rating_value = min_rating_value + 1
+
+            query = query.filter(avg_score__gte=min_rating_value, avg_score__lt=max_rating_value)
+        except ValueError:
+            pass  # 無効なratingが渡された場合はフィルタを適用しない
+
+    # 営業中のフィルタリング（営業区間のインデックスで引く）
+    if open_at:
+        query = query.filter(pk__in=hours.open_shop_ids(*open_at))
+
+    return query
+
+
+def get_results(params):
+    """検索結果の店舗ID（表示順）と件数を、検索条件ごとにキャッシュして返す
+
+    保持するIDは先頭の SEARCH_MAX_RESULTS 件まで。フリーワードありは絞り込み後の
+    店舗の中での適合度（BM25）順、なしは店舗IDの昇順。それを超える分は
+    complete=False として件数をDBで数え、ページング時にDBから続きを読む。
+    """
+    cache = get_cache()
+    key = cache_key('results', params)
+    results = cache.get(key)
+    if results is None:
+        query = filter_shops(params)
+        limit = max_results()
+        ranked = bool(params.get('freeword'))
+        if ranked:
+            ids = search.search_shops(params['freeword'], limit + 1, within=query)
+        else:
+            ids = list(query.order_by('pk').values_list('pk', flat=True)[:limit + 1])
+        complete = len(ids) <= limit
+        ids = ids[:limit]
+        count = len(ids) if complete else query.count()
+        results = {'ids': ids, 'count': count, 'complete': complete, 'ranked': ranked}
+        cache.set(key, results, cache_timeout())
+    return results
+
+
+def parse_cursor(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    """カーソル（直前のページ末尾の店舗ID）で次ページを取得した結果"""
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def paginate(params, results, after=None, size=None):
+    """キーセット方式で1ページ分の店舗を取得する
+
+    フリーワードなしは店舗IDの昇順、ありは適合度順で並べる。
+    キャッシュしたIDの範囲内なら店舗の主キー検索だけで済み、範囲外でも
+    OFFSETを使わず主キーの範囲読み込みで続きを取得する（適合度順の結果は、
+    キャッシュした分の後に残りの店舗を店舗IDの昇順で続ける）。
+    """
+    size = size or page_size()
+    ids = results['ids']
+    start = None
+    if after is None:
+        start = 0
+    else:
+        try:
+            start = ids.index(after) + 1
+        except ValueError:
+            pass
+    page_ids = ids[start:start + size + 1] if start is not None else []
+
+    if len(page_ids) <= size and not results['complete']:
+        # キャッシュした範囲を超えたページはDBから読む（店舗IDの昇順）
+        query = filter_shops(params)
+        if results.get('ranked'):
+            # 適合度順のIDは店舗IDの順ではないので、残りは先頭から（カーソルが残りの中ならその後から）読む
+            query = query.exclude(pk__in=ids)
+            last = None if start is not None else after
+        else:
+            last = page_ids[-1] if page_ids else after
+        if last is not None:
+            query = query.filter(pk__gt=last)
+        page_ids += list(query.order_by('pk').values_list('pk', flat=True)[:size + 1 - len(page_ids)])
+
+    found = Shop.objects.in_bulk(page_ids[:size])
+    shops = [found[shop_id] for shop_id in page_ids[:size] if shop_id in found]
+    next_cursor = page_ids[size - 1] if len(page_ids) > size else None
+    return KeysetPage(shops, next_cursor)
@@ -0,0 +1,104 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import availability, booking, catalog, hours, membership, search, search_query, similar
+from .models import Category, Favorite, Reservation, Review, Shop, Subscription
+
+# 店舗の保存・削除に合わせて検索インデックスを更新
+@receiver(post_save, sender=Shop)
+def index_shop(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(lambda: search.index_shops([instance.pk]))
+    transaction.on_commit(search_query.bump_version)
+
+@receiver(post_delete, sender=Shop)
+def unindex_shop(sender, instance, **kwargs):
+    shop_id = instance.pk
+    transaction.on_commit(lambda: search.remove_shops([shop_id]))
+    transaction.on_commit(search_query.bump_version)
+
+# カテゴリ名は店舗のインデックスに含まれるので、所属店舗を更新
+@receiver(post_save, sender=Category)
+def index_category_shops(sender, instance, created=False, raw=False, **kwargs):
+    if raw or created:
+        return
+    category_id = instance.pk
+    transaction.on_commit(
+        lambda: search.index_shops(Shop.objects.filter(category_id=category_id).values_list('pk', flat=True))
+    )
+
+# カテゴリ一覧のキャッシュを読み直させる
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def expire_category_catalog(sender, **kwargs):
+    transaction.on_commit(catalog.bump_version)
+
+# カテゴリ・レビューの変更は検索結果（カテゴリ名・評価での絞り込み）に影響するので、
+# 検索キャッシュのバージョンを上げる
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def expire_search_cache(sender, **kwargs):
+    transaction.on_commit(search_query.bump_version)
+
+# レビュー削除時に店舗の集計値を減らす（一括削除・カスケード削除も含む）
+@receiver(post_delete, sender=Review)
+def unrate_shop(sender, instance, **kwargs):
+    Shop.update_rating(instance.shop_id, -1, -instance.score)
+
+# 会員状態のキャッシュを破棄し、ユーザー・プロフィールのフラグを同期する
+@receiver(post_save, sender=Subscription)
+def sync_membership(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    membership.sync_user_flags(instance.user_id, instance.active)
+    membership.invalidate(instance.user_id)
+    transaction.on_commit(lambda: membership.invalidate(instance.user_id))
+
+@receiver(post_delete, sender=Subscription)
+def expire_membership(sender, instance, **kwargs):
+    user_id = instance.user_id
+    membership.sync_user_flags(user_id, False)
+    membership.invalidate(user_id)
+    transaction.on_commit(lambda: membership.invalidate(user_id))
+
+# 予約の削除（キャンセル）で枠の席を空ける
+@receiver(post_delete, sender=Reservation)
+def release_reservation(sender, instance, **kwargs):
+    booking.release(instance)
+
+# 予約の作成・変更・削除で、その日の空き状況のキャッシュを破棄
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+def invalidate_availability(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    shop_id, date_time = instance.shop_id, instance.date_time
+    transaction.on_commit(lambda: availability.invalidate(shop_id, date_time))
+
+# 営業時間・定休日の変更を営業区間に反映
+@receiver(post_save, sender=Shop)
+def index_opening_hours(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and not {'opening_hours', 'regular_holiday'} & set(update_fields)):
+        return
+    hours.index_shops([instance])
+
+# レビュー・お気に入りが変わった店舗は、似ている店舗の計算し直しの対象にする
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def mark_similar_shops_stale(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    similar.mark_stale(instance.shop_id)
+
+# 店舗の席数の変更をこれからの予約枠に反映
+@receiver(post_save, sender=Shop)
+def sync_slot_capacity(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or created or (update_fields is not None and 'capacity' not in update_fields):
+        return
+    booking.sync_capacity(instance)
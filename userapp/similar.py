@@ -0,0 +1,134 @@
+"""似ている店舗（レビューとお気に入りからのアイテム間の協調フィルタリング）
+
+同じユーザーが高く評価した・お気に入りにした店舗どうしを「似ている」とみなす。
+店舗ごとにユーザーを次元とするベクトルを作り、コサイン類似度の上位
+SIMILAR_SHOPS_COUNT 件を ShopSimilarity に保存しておく。店舗ページは
+(shop, rank) のインデックスを1回引くだけで表示でき、計算はリクエストでは行わない。
+
+計算は refresh_similar_shops コマンドでまとめて行う。疎行列の積（店舗×店舗）を、
+ユーザーごとの {店舗: 重み} をたどって対象の店舗の行だけ求める。
+レビュー・お気に入りが変わった店舗には Shop.similar_shops_stale が立つので、
+差分の更新ではその店舗と、それを似ている店舗として載せている店舗だけを計算し直す
+（変わった店舗が他の店舗の上位に新しく入る分は --all での計算し直しで反映される）。
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from .batching import iter_rows
+from .models import Favorite, Review, Shop, ShopSimilarity
+
+FAVORITE_WEIGHT = 1.0
+
+
+def review_weight(score):
+    """スコア 1〜5 を重みにする（2 は中立、1 は「好みでない」として負にする）"""
+    return (score - 2) / 3
+
+
+class Interactions:
+    """ユーザー×店舗の疎行列を、ユーザーごと・店舗ごとの辞書の両方で持つ"""
+
+    def __init__(self, pairs, max_user_items=None):
+        users = defaultdict(dict)
+        for user_id, shop_id, weight in pairs:
+            users[user_id][shop_id] = weight
+        self.users = {}
+        self.shops = defaultdict(dict)
+        for user_id, items in users.items():
+            items = {shop_id: weight for shop_id, weight in items.items() if weight}
+            # 多くの店舗に付けているユーザーは店舗どうしの関係をほとんど表さず、計算量だけ増やす
+            if not items or (max_user_items and len(items) > max_user_items):
+                continue
+            self.users[user_id] = items
+            for shop_id, weight in items.items():
+                self.shops[shop_id][user_id] = weight
+        self.norms = {
+            shop_id: math.sqrt(sum(weight * weight for weight in column.values()))
+            for shop_id, column in self.shops.items()
+        }
+
+    @classmethod
+    def load(cls):
+        """レビューとお気に入りを主キー順に少しずつ読んで行列を作る"""
+        def pairs():
+            for user_id, shop_id, score in iter_rows(Review.objects.all(), ['user_id', 'shop_id', 'score']):
+                yield user_id, shop_id, review_weight(score)
+            # お気に入りはレビューより強い好みとして、同じ店舗のレビューの重みを上書きする
+            for user_id, shop_id in iter_rows(Favorite.objects.all(), ['user_id', 'shop_id']):
+                yield user_id, shop_id, FAVORITE_WEIGHT
+        return cls(pairs(), getattr(settings, 'SIMILAR_SHOPS_MAX_USER_ITEMS', 500))
+
+    def neighbours(self, shop_id, count, shrink=0):
+        """shop_id に似ている店舗の [(類似度, 店舗ID)] を類似度の高い順に count 件"""
+        column = self.shops.get(shop_id)
+        if not column:
+            return []
+        dots = defaultdict(float)
+        common = defaultdict(int)
+        for user_id, weight in column.items():
+            for other_id, other_weight in self.users[user_id].items():
+                if other_id != shop_id:
+                    dots[other_id] += weight * other_weight
+                    common[other_id] += 1
+        norm = self.norms[shop_id]
+        scored = []
+        for other_id, dot in dots.items():
+            if dot <= 0:
+                continue
+            # 共通のユーザーが少ない組は偶然の一致が多いので割り引く
+            n = common[other_id]
+            scored.append((dot / (norm * self.norms[other_id]) * n / (n + shrink), other_id))
+        return heapq.nlargest(count, scored)
+
+
+def mark_stale(shop_id):
+    """レビュー・お気に入りが変わった店舗に、計算し直しの印を付ける"""
+    Shop.objects.filter(pk=shop_id, similar_shops_stale=False).update(similar_shops_stale=True)
+
+
+def stale_shop_ids():
+    """差分の更新で計算し直す店舗（印の付いた店舗と、それを似ている店舗に載せている店舗）"""
+    stale = set(Shop.objects.filter(similar_shops_stale=True).values_list('pk', flat=True))
+    listing = ShopSimilarity.objects.filter(similar__similar_shops_stale=True).values_list('shop_id', flat=True)
+    return stale, stale | set(listing)
+
+
+def refresh(full=False, batch_size=500):
+    """似ている店舗を計算し直し、計算した店舗の数を返す。full でなければ印の付いた店舗の分だけ"""
+    if full:
+        targets = list(Shop.objects.order_by('pk').values_list('pk', flat=True))
+        Shop.objects.filter(similar_shops_stale=True).update(similar_shops_stale=False)
+    else:
+        stale, targets = stale_shop_ids()
+        if not targets:
+            return 0
+        targets = sorted(targets)
+        # 行列を読む前に印を消す（計算中に増えたレビュー・お気に入りは次の更新で拾う）
+        stale = sorted(stale)
+        for start in range(0, len(stale), batch_size):
+            Shop.objects.filter(pk__in=stale[start:start + batch_size]).update(similar_shops_stale=False)
+
+    interactions = Interactions.load()
+    count = getattr(settings, 'SIMILAR_SHOPS_COUNT', 10)
+    shrink = getattr(settings, 'SIMILAR_SHOPS_SHRINK', 5)
+    for start in range(0, len(targets), batch_size):
+        batch = targets[start:start + batch_size]
+        rows = [
+            ShopSimilarity(shop_id=shop_id, similar_id=similar_id, rank=rank, score=score)
+            for shop_id in batch
+            for rank, (score, similar_id) in enumerate(interactions.neighbours(shop_id, count, shrink))
+        ]
+        with transaction.atomic():
+            ShopSimilarity.objects.filter(shop_id__in=batch).delete()
+            ShopSimilarity.objects.bulk_create(rows)
+    return len(targets)
+
+
+def similar_shops(shop, limit):
+    """店舗ページに出す似ている店舗（保存済みの上位を1回のクエリで読む）"""
+    rows = ShopSimilarity.objects.filter(shop=shop).select_related('similar__category').order_by('rank')[:limit]
+    return [row.similar for row in rows]
@@ -3,6 +3,27 @@
     そのセッションを基にStripeに対してクエリを送信します。
 */
 
+// Stripe処理（アウトボックス）が完了または失敗するまで状態を取得し続ける
+const waitForOperation = (pollUrl) => new Promise((resolve, reject) => {
+    if (!pollUrl) {
+        reject(new Error('poll_url が返されませんでした'));
+        return;
+    }
+    const poll = () => {
+        fetch(pollUrl, { headers: { 'Accept': 'application/json' } })
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'done' || data.status === 'failed') {
+                    resolve(data);
+                } else {
+                    setTimeout(poll, 1000);
+                }
+            })
+            .catch(reject);
+    };
+    poll();
+});
+
 // Stripeの公開可能キーを取得
 fetch("/subscription/config/")
     // 結果オブジェクトを取得
@@ -46,6 +67,8 @@ fetch("/subscription/config/")
                     })
                 })
                 .then(response => response.json())
+                // セッションはワーカーで作成されるので、できあがるまで状態をポーリングする
+                .then(data => waitForOperation(data.poll_url))
                 .then(data => {
                     if (data.sessionId) {
                         // Stripe Checkoutにリダイレクト
@@ -0,0 +1,144 @@
+"""Stripe Webhook イベントの受信と反映
+
+Webhook は署名を確かめて生のイベントを保存するだけにして、すぐに200を返す。
+保存したイベントは process_stripe_events コマンドがまとめて読み、
+サブスクリプションごとに最終的な状態を決めてから Subscription と
+会員フラグを一括で更新する。同じイベントの再送はイベントIDの一意制約で捨てる。
+"""
+import json
+import logging
+
+import stripe
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from . import membership
+from .models import StripeEvent, Subscription
+
+logger = logging.getLogger(__name__)
+
+# 有料会員として扱うサブスクリプションの状態
+ACTIVE_STATUSES = ('active', 'trialing')
+
+SUBSCRIPTION_EVENTS = (
+    'customer.subscription.created',
+    'customer.subscription.updated',
+    'customer.subscription.deleted',
+)
+INVOICE_EVENTS = ('invoice.paid', 'invoice.payment_failed')
+CHECKOUT_EVENTS = ('checkout.session.completed',)
+
+
+def parse(payload, signature):
+    """署名を検証してイベントの dict を返す（不正なら ValueError か SignatureVerificationError）
+
+    署名の鍵が設定されていなければ ImproperlyConfigured にする（空の鍵では誰でも署名を作れる）。
+    """
+    secret = getattr(settings, 'STRIPE_WEBHOOK_SECRET', '')
+    if not secret:
+        raise ImproperlyConfigured('STRIPE_WEBHOOK_SECRET が設定されていません')
+    stripe.WebhookSignature.verify_header(
+        payload.decode('utf-8'), signature, secret, getattr(settings, 'STRIPE_WEBHOOK_TOLERANCE', 300),
+    )
+    return json.loads(payload)
+
+
+def store(event):
+    """イベントを保存する。既に受信済みなら False を返す"""
+    _, created = StripeEvent.objects.get_or_create(
+        event_id=event['id'], defaults={'type': event.get('type', ''), 'payload': event},
+    )
+    return created
+
+
+def subscription_state(event):
+    """イベントから (サブスクリプションID, 顧客ID, 有効か, メールアドレス) を取り出す（対象外は None）"""
+    obj = event['data']['object']
+    event_type = event['type']
+    if event_type in SUBSCRIPTION_EVENTS:
+        active = event_type != 'customer.subscription.deleted' and obj.get('status') in ACTIVE_STATUSES
+        return obj['id'], obj.get('customer'), active, None
+    if event_type in INVOICE_EVENTS and obj.get('subscription'):
+        return obj['subscription'], obj.get('customer'), event_type == 'invoice.paid', None
+    if event_type in CHECKOUT_EVENTS and obj.get('subscription'):
+        email = obj.get('customer_email') or (obj.get('customer_details') or {}).get('email')
+        return obj['subscription'], obj.get('customer'), True, email
+    return None
+
+
+def process_batch(batch_size=None):
+    """未処理のイベントを1バッチ反映し、処理した件数を返す"""
+    batch_size = batch_size or getattr(settings, 'STRIPE_EVENT_BATCH_SIZE', 100)
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update().filter(processed_at__isnull=True).order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0
+
+        # サブスクリプションごとに、発生日時が最も新しいイベントの状態を採用する
+        states = {}
+        for event in sorted(events, key=lambda e: (e.payload.get('created', 0), e.pk)):
+            state = subscription_state(event.payload)
+            if state is not None:
+                states[state[0]] = state
+        apply_states(states)
+
+        StripeEvent.objects.filter(pk__in=[e.pk for e in events]).update(processed_at=timezone.now())
+    return len(events)
+
+
+def apply_states(states):
+    """{サブスクリプションID: 状態} を Subscription と会員フラグにまとめて反映する"""
+    if not states:
+        return
+    emails = [email.lower() for _, _, _, email in states.values() if email]
+    condition = Q(stripe_subscription_id__in=list(states))
+    if emails:
+        # Checkout で登録したばかりのものは、まだStripeのIDが入っていないのでメールアドレスで探す
+        # 登録時のメールアドレスは大文字を含むことがあるので、小文字にそろえて比べる
+        condition |= Q(stripe_subscription_id='', user_email__in=emails)
+    subscriptions = Subscription.objects.annotate(user_email=Lower('user__email')).filter(condition).select_related('user')
+
+    by_email = {}
+    for subscription_id, customer_id, active, email in states.values():
+        if email:
+            by_email[email.lower()] = (subscription_id, customer_id, active)
+
+    changed = []
+    for subscription in subscriptions:
+        if subscription.stripe_subscription_id:
+            subscription_id, customer_id, active, _ = states[subscription.stripe_subscription_id]
+        else:
+            state = by_email.get(subscription.user.email.lower())
+            if state is None:
+                continue
+            subscription_id, customer_id, active = state
+        if (subscription.stripe_subscription_id, subscription.active) == (subscription_id, active):
+            continue
+        subscription.stripe_subscription_id = subscription_id
+        subscription.stripe_customer_id = customer_id or subscription.stripe_customer_id
+        subscription.active = active
+        changed.append(subscription)
+
+    if changed:
+        Subscription.objects.bulk_update(changed, ['stripe_subscription_id', 'stripe_customer_id', 'active'])
+        # bulk_update ではシグナルが飛ばないので、会員フラグとキャッシュはここでまとめて同期する
+        membership.sync_many({s.user_id: s.active for s in changed})
+    unknown = set(states) - {s.stripe_subscription_id for s in subscriptions}
+    if unknown:
+        logger.info('対応するサブスクリプションがないイベントを無視しました: %s', ', '.join(sorted(unknown)))
+
+
+def drain(batch_size=None):
+    """未処理のイベントがなくなるまで反映し、処理した件数を返す"""
+    processed = 0
+    while True:
+        count = process_batch(batch_size)
+        if not count:
+            return processed
+        processed += count
@@ -0,0 +1,195 @@
+"""Stripe API への接続口
+
+すべての Stripe 呼び出しはここを通す。
+
+- 接続はプロセス内で1つの requests.Session を使い回す（keep-alive）
+- 処理ごとに接続・読み取りのタイムアウトを設定する（STRIPE_TIMEOUTS）
+- ネットワークエラーの再試行は SDK に任せ、回数を STRIPE_MAX_NETWORK_RETRIES で抑える
+- 失敗が続いたらサーキットブレーカーを開き、一定時間は Stripe を呼ばずにすぐ失敗させる
+- 呼び出しごとの所要時間をログ（userapp.stripe_gateway）に記録する
+
+STRIPE_API_BASE を変えると、stripe-mock や run_stripe_stub のローカルスタブに向けられる。
+"""
+import json
+import logging
+import threading
+import time
+
+import requests
+import stripe
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = (3.05, 10)  # (接続, 読み取り) 秒
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """サーキットブレーカーが開いていて Stripe を呼ばなかった"""
+
+
+class CircuitBreaker:
+    """連続した失敗で開き、reset_timeout 秒後に1回だけ試して閉じるか判断する"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        """呼び出してよければ何もしない。開いていれば CircuitOpenError を送出する"""
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self.trial_running:
+                # 回復したかを確かめる呼び出しは1つだけ通す
+                self.trial_running = True
+                return
+        raise CircuitOpenError('Stripe への接続を一時的に停止しています')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+    def release_trial(self):
+        """Stripe の状態と関係なく終わった呼び出しの後に、次の呼び出しで試し直せるようにする"""
+        with self.lock:
+            self.trial_running = False
+
+
+# Stripe の障害とみなすエラー（カードエラーや入力エラーはブレーカーに数えない）
+FAILURE_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError, stripe.error.RateLimitError)
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_breaker = None
+
+
+def get_session():
+    """プロセス内で共有する keep-alive の HTTP セッション"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_breaker():
+    global _breaker
+    with _lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                getattr(settings, 'STRIPE_BREAKER_THRESHOLD', 5),
+                getattr(settings, 'STRIPE_BREAKER_RESET_TIMEOUT', 30),
+            )
+        return _breaker
+
+
+def timeout_for(operation):
+    timeouts = getattr(settings, 'STRIPE_TIMEOUTS', {})
+    return tuple(timeouts.get(operation, timeouts.get('default', DEFAULT_TIMEOUT)))
+
+
+def get_client(operation):
+    """処理ごとのタイムアウトを設定した StripeClient（HTTPセッションは共有）"""
+    timeout = timeout_for(operation)
+    key = (timeout, getattr(settings, 'STRIPE_API_BASE', None))
+    client = _clients.get(key)
+    if client is None:
+        base = getattr(settings, 'STRIPE_API_BASE', None)
+        client = stripe.StripeClient(
+            settings.STRIPE_SECRET_KEY,
+            http_client=stripe.RequestsClient(timeout=timeout, session=get_session()),
+            max_network_retries=getattr(settings, 'STRIPE_MAX_NETWORK_RETRIES', 2),
+            base_addresses={'api': base} if base else {},
+        )
+        _clients[key] = client
+    return client
+
+
+def call(operation, func):
+    """func(client) を実行し、ブレーカーの判定と所要時間の記録を行う"""
+    breaker = get_breaker()
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        record(operation, 0, 'circuit_open')
+        raise
+
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        result = func(get_client(operation))
+    except FAILURE_ERRORS as e:
+        outcome = type(e).__name__
+        breaker.record_failure()
+        raise
+    except stripe.error.StripeError as e:
+        # 入力・カードのエラーは Stripe が応答できているので成功として扱う
+        outcome = type(e).__name__
+        breaker.record_success()
+        raise
+    except Exception as e:
+        # 手元の不具合などは Stripe の成否が分からないので数えないが、試しの呼び出しは終わらせる
+        # （そのままだとブレーカーが開いたまま戻らない）
+        outcome = type(e).__name__
+        breaker.release_trial()
+        raise
+    else:
+        breaker.record_success()
+        return result
+    finally:
+        record(operation, time.perf_counter() - start, outcome)
+
+
+def record(operation, elapsed, outcome):
+    """Stripe 呼び出しのレイテンシを記録する"""
+    metric = {
+        'operation': operation,
+        'latency_ms': round(elapsed * 1000, 1),
+        'outcome': outcome,
+        'breaker': get_breaker().state,
+    }
+    level = logging.INFO if outcome == 'ok' else logging.WARNING
+    logger.log(level, json.dumps(metric, ensure_ascii=False), extra={'stripe_call': metric})
+
+
+def reset():
+    """接続・ブレーカーを作り直す（設定を変えたテストなどで使う）"""
+    global _session, _breaker
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _breaker = None
+        _clients.clear()
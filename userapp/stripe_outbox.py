@@ -0,0 +1,262 @@
+"""Stripe API 呼び出しのアウトボックス
+
+ビューは Stripe を直接呼ばず、ローカルの変更と同じトランザクションで
+StripeOperation を登録してすぐに応答する。登録された処理は
+process_stripe_outbox コマンド（ワーカー）が順に実行し、失敗したものは
+指数バックオフで再試行する。Stripe への呼び出しには処理ごとの
+冪等キーを付けるので、再試行しても二重に課金・登録されない。
+"""
+import logging
+import random
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import stripe_gateway
+from .models import StripeOperation, Subscription
+
+logger = logging.getLogger(__name__)
+
+# 時間をおけば成功する見込みのあるエラー（それ以外は再試行しない）
+RETRYABLE_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.RateLimitError,
+    stripe.error.APIError,
+    stripe.error.IdempotencyError,
+)
+
+
+def max_attempts():
+    return getattr(settings, 'STRIPE_OUTBOX_MAX_ATTEMPTS', 8)
+
+
+def backoff(attempts):
+    """attempts 回失敗した後の待ち時間（秒）。上限付きの指数バックオフに揺らぎを加える"""
+    base = getattr(settings, 'STRIPE_OUTBOX_BACKOFF', 2)
+    cap = getattr(settings, 'STRIPE_OUTBOX_BACKOFF_MAX', 600)
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class StripeClient:
+    """Stripe API を呼び出すクライアント（戻り値はJSONに保存できる dict）"""
+
+    def create_customer(self, idempotency_key, **params):
+        customer = stripe_gateway.call('create_customer', lambda client: client.customers.create(
+            params=params, options={'idempotency_key': idempotency_key},
+        ))
+        return {'id': customer.id}
+
+    def create_subscription(self, idempotency_key, **params):
+        subscription = stripe_gateway.call('create_subscription', lambda client: client.subscriptions.create(
+            params=params, options={'idempotency_key': idempotency_key},
+        ))
+        return {'id': subscription.id, 'status': subscription.status}
+
+    def cancel_subscription(self, idempotency_key, subscription_id):
+        subscription = stripe_gateway.call('cancel_subscription', lambda client: client.subscriptions.cancel(
+            subscription_id, options={'idempotency_key': idempotency_key},
+        ))
+        return {'id': subscription.id, 'status': subscription.status}
+
+    def create_checkout_session(self, idempotency_key, **params):
+        session = stripe_gateway.call('create_checkout_session', lambda client: client.checkout.sessions.create(
+            params=params, options={'idempotency_key': idempotency_key},
+        ))
+        return {'id': session.id, 'url': session.url}
+
+
+class FakeStripeClient:
+    """テスト・開発用の Stripe を呼ばないクライアント
+
+    同じ冪等キーには同じ結果を返す。fail_times を指定すると、その回数だけ
+    再試行可能なエラーを送出してから成功する。
+    """
+
+    def __init__(self, fail_times=0):
+        self.fail_times = fail_times
+        self.calls = []
+        self.responses = {}
+
+    def _call(self, method, idempotency_key, params, make_result):
+        self.calls.append((method, idempotency_key, params))
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise stripe.error.APIConnectionError('fake connection error')
+        if idempotency_key not in self.responses:
+            self.responses[idempotency_key] = make_result(len(self.responses) + 1)
+        return self.responses[idempotency_key]
+
+    def create_customer(self, idempotency_key, **params):
+        return self._call('create_customer', idempotency_key, params, lambda n: {'id': f'cus_fake{n}'})
+
+    def create_subscription(self, idempotency_key, **params):
+        return self._call(
+            'create_subscription', idempotency_key, params, lambda n: {'id': f'sub_fake{n}', 'status': 'active'},
+        )
+
+    def cancel_subscription(self, idempotency_key, subscription_id):
+        return self._call(
+            'cancel_subscription', idempotency_key, {'subscription_id': subscription_id},
+            lambda n: {'id': subscription_id, 'status': 'canceled'},
+        )
+
+    def create_checkout_session(self, idempotency_key, **params):
+        return self._call(
+            'create_checkout_session', idempotency_key, params,
+            lambda n: {'id': f'cs_fake{n}', 'url': f'https://checkout.stripe.test/cs_fake{n}'},
+        )
+
+
+def get_client():
+    """settings.STRIPE_CLIENT で指定したクライアントを返す"""
+    return import_string(getattr(settings, 'STRIPE_CLIENT', 'userapp.stripe_outbox.StripeClient'))()
+
+
+def enqueue(operation, payload, user=None):
+    """Stripe の処理を登録する（呼び出し側のトランザクション内で使う）"""
+    return StripeOperation.objects.create(operation=operation, payload=payload, user=user)
+
+
+def has_pending(user, operation):
+    return StripeOperation.objects.filter(
+        user=user, operation=operation, status__in=[StripeOperation.PENDING, StripeOperation.PROCESSING],
+    ).exists()
+
+
+def latest(user, operation):
+    """ユーザーの直近の処理（なければ None）"""
+    return StripeOperation.objects.filter(user=user, operation=operation).order_by('-created_at', '-pk').first()
+
+
+def retry(queryset):
+    """失敗した処理をもう一度実行待ちにし、件数を返す（冪等キーは同じものを使う）"""
+    return queryset.filter(status=StripeOperation.FAILED).update(
+        status=StripeOperation.PENDING, attempts=0, next_attempt_at=timezone.now(), locked_at=None,
+        updated_at=timezone.now(),
+    )
+
+
+# 処理ごとの Stripe 呼び出しとローカルへの反映
+def _create_subscription(client, op):
+    payload = op.payload
+    customer = client.create_customer(
+        f'{op.idempotency_key}:customer',
+        email=payload.get('email'), source=payload['token'], name=payload.get('name'),
+    )
+    subscription = client.create_subscription(
+        f'{op.idempotency_key}:subscription',
+        customer=customer['id'], items=[{'price': payload['price']}],
+    )
+    with transaction.atomic():
+        local = Subscription.objects.select_for_update().filter(user_id=op.user_id).first()
+        if local is not None:
+            local.stripe_customer_id = customer['id']
+            local.stripe_subscription_id = subscription['id']
+            local.active = True
+            local.save()
+    return {'customer': customer['id'], 'subscription': subscription['id']}
+
+
+def _cancel_subscription(client, op):
+    result = client.cancel_subscription(op.idempotency_key, op.payload['subscription_id'])
+    # Stripe側で解約できてから会員を外す（その後に登録し直したサブスクリプションには触れない）
+    with transaction.atomic():
+        local = Subscription.objects.select_for_update().filter(
+            stripe_subscription_id=op.payload['subscription_id'], active=True,
+        ).first()
+        if local is not None:
+            local.active = False
+            local.save()
+    return result
+
+
+def _create_checkout_session(client, op):
+    return client.create_checkout_session(op.idempotency_key, **op.payload)
+
+
+HANDLERS = {
+    StripeOperation.CREATE_SUBSCRIPTION: _create_subscription,
+    StripeOperation.CANCEL_SUBSCRIPTION: _cancel_subscription,
+    StripeOperation.CREATE_CHECKOUT_SESSION: _create_checkout_session,
+}
+
+
+def claim(batch_size):
+    """実行時刻を過ぎた処理を取り出して処理中にする
+
+    複数のワーカーが同時に動いても同じ処理を取り合わないよう、状態が
+    変わっていない行だけを条件付き UPDATE で確保する。処理中のまま
+    止まったもの（ワーカーの異常終了など）は一定時間後に取り直す。
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=getattr(settings, 'STRIPE_OUTBOX_LOCK_TIMEOUT', 300))
+    due = (
+        StripeOperation.objects.filter(status=StripeOperation.PENDING, next_attempt_at__lte=now)
+        | StripeOperation.objects.filter(status=StripeOperation.PROCESSING, locked_at__lt=stale)
+    )
+    claimed = []
+    for pk, status, locked_at in due.order_by('next_attempt_at', 'pk').values_list(
+        'pk', 'status', 'locked_at',
+    )[:batch_size]:
+        # 読み取った時点から状態が変わっていなければ確保できる
+        if StripeOperation.objects.filter(pk=pk, status=status, locked_at=locked_at).update(
+            status=StripeOperation.PROCESSING, locked_at=now,
+        ):
+            claimed.append(pk)
+    return list(StripeOperation.objects.filter(pk__in=claimed).order_by('pk'))
+
+
+def process(op, client):
+    """1件の処理を実行し、成功・再試行・失敗のいずれかを記録する"""
+    op.attempts += 1
+    try:
+        result = HANDLERS[op.operation](client, op)
+    except Exception as e:
+        retryable = isinstance(e, RETRYABLE_ERRORS) and op.attempts < max_attempts()
+        op.last_error = f'{type(e).__name__}: {e}'
+        op.locked_at = None
+        if retryable:
+            op.status = StripeOperation.PENDING
+            op.next_attempt_at = timezone.now() + timedelta(seconds=backoff(op.attempts))
+            logger.warning('Stripe処理を再試行します: %s #%s (%s)', op.operation, op.pk, op.last_error)
+        else:
+            op.status = StripeOperation.FAILED
+            logger.error('Stripe処理が失敗しました: %s #%s (%s)', op.operation, op.pk, op.last_error)
+        op.save(update_fields=['attempts', 'status', 'next_attempt_at', 'locked_at', 'last_error', 'updated_at'])
+        return False
+    op.status = StripeOperation.DONE
+    op.result = result
+    op.locked_at = None
+    op.last_error = ''
+    op.save(update_fields=['attempts', 'status', 'result', 'locked_at', 'last_error', 'updated_at'])
+    return True
+
+
+def drain(client=None, batch_size=None):
+    """実行可能な処理をなくなるまで実行し、処理した件数を返す"""
+    client = client or get_client()
+    batch_size = batch_size or getattr(settings, 'STRIPE_OUTBOX_BATCH_SIZE', 20)
+    processed = 0
+    while True:
+        ops = claim(batch_size)
+        if not ops:
+            return processed
+        for op in ops:
+            process(op, client)
+            processed += 1
+
+
+def status_payload(op):
+    """画面からのポーリングに返す処理状態"""
+    data = {'status': op.status, 'operation': op.operation}
+    if op.status == StripeOperation.DONE and op.operation == StripeOperation.CREATE_CHECKOUT_SESSION:
+        data['sessionId'] = op.result['id']
+        data['url'] = op.result['url']
+    if op.status == StripeOperation.FAILED:
+        data['message'] = '決済サービスとの通信に失敗しました。時間をおいて再度お試しください。'
+    return data
@@ -1,3 +1,1382 @@
-from django.test import TestCase
+import csv
+import hashlib
+import hmac
+import io
+import json
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import datetime, time as dt_time, timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.forms import PasswordResetForm
+from django.core import mail as django_mail
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed, ValidationError
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, close_old_connections, connection, transaction
+from django.db.models import F, Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from userapp import (
+    availability, batching, booking, catalog, facets, geo, hours, mail, membership, search, search_query, similar,
+    stripe_events, stripe_gateway, stripe_outbox,
+)
+from userapp.forms import SignUpForm
+from userapp.management.commands.benchmark_views import percentile
+from userapp.membership import is_paid_member
+from userapp.middleware import QueryBudgetMiddleware, fingerprint
+from userapp.models import (
+    Category, Favorite, OpeningPeriod, Profile, QueuedEmail, Reservation, ReservationSlot, Review, Shop, ShopSimilarity,
+    StripeEvent, StripeOperation, Subscription, budget_bounds,
+)
+from userapp.views import ShopInfoView
+
+User = get_user_model()
+
+
+# Stripe API 呼び出しのアウトボックス
+@override_settings(STRIPE_CLIENT='userapp.stripe_outbox.FakeStripeClient', STRIPE_OUTBOX_BACKOFF=0)
+class StripeOutboxTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def subscribe(self):
+        response = self.client.post(
+            reverse('userapp:subscribe'), {'token': 'tok_visa', 'name': 'Taro Nagoya'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 202)
+        return response.json()['poll_url']
+
+    def poll(self, url):
+        return self.client.get(url, HTTP_ACCEPT='application/json').json()
+
+    def test_subscribe_is_pending_until_worker_runs(self):
+        poll_url = self.subscribe()
+        self.assertEqual(self.poll(poll_url)['status'], StripeOperation.PENDING)
+        self.assertFalse(Subscription.objects.get(user=self.user).active)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(stripe_outbox.drain(), 1)
+        status = self.poll(poll_url)
+        self.assertEqual(status['status'], StripeOperation.DONE)
+        self.assertEqual(status['redirect'], reverse('userapp:subscription'))
+        subscription = Subscription.objects.get(user=self.user)
+        self.assertTrue(subscription.active)
+        self.assertTrue(subscription.stripe_subscription_id.startswith('sub_fake'))
+        self.assertTrue(is_paid_member(User.objects.get(pk=self.user.pk)))
+
+    def test_retries_reuse_idempotency_keys(self):
+        self.subscribe()
+        client = stripe_outbox.FakeStripeClient(fail_times=2)
+        stripe_outbox.drain(client)
+        op = StripeOperation.objects.get()
+        self.assertEqual(op.status, StripeOperation.DONE)
+        self.assertEqual(op.attempts, 3)
+        customer_keys = {key for method, key, _ in client.calls if method == 'create_customer'}
+        self.assertEqual(customer_keys, {f'{op.idempotency_key}:customer'})
+
+    @override_settings(STRIPE_OUTBOX_MAX_ATTEMPTS=2)
+    def test_gives_up_after_max_attempts(self):
+        poll_url = self.subscribe()
+        stripe_outbox.drain(stripe_outbox.FakeStripeClient(fail_times=5))
+        op = StripeOperation.objects.get()
+        self.assertEqual(op.status, StripeOperation.FAILED)
+        self.assertEqual(op.attempts, 2)
+        self.assertIn('message', self.poll(poll_url))
+        self.assertFalse(Subscription.objects.get(user=self.user).active)
+
+    def test_cancel_takes_effect_when_stripe_confirms(self):
+        Subscription.objects.create(
+            user=self.user, stripe_customer_id='cus_1', stripe_subscription_id='sub_1', active=True,
+        )
+        self.client.post(reverse('userapp:cancel_subscription'))
+        # Stripe側で解約できるまでは有料会員のまま
+        self.assertTrue(Subscription.objects.get(user=self.user).active)
+        op = StripeOperation.objects.get()
+        self.assertEqual((op.operation, op.payload), (StripeOperation.CANCEL_SUBSCRIPTION, {'subscription_id': 'sub_1'}))
+        self.client.post(reverse('userapp:cancel_subscription'))
+        self.assertEqual(StripeOperation.objects.count(), 1)
+
+        client = stripe_outbox.FakeStripeClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            stripe_outbox.drain(client)
+        self.assertEqual(client.calls[0][0], 'cancel_subscription')
+        self.assertEqual(StripeOperation.objects.get().status, StripeOperation.DONE)
+        self.assertFalse(Subscription.objects.get(user=self.user).active)
+        self.assertFalse(is_paid_member(User.objects.get(pk=self.user.pk)))
+
+    @override_settings(STRIPE_OUTBOX_MAX_ATTEMPTS=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_failed_cancel_keeps_membership_and_can_be_retried(self):
+        Subscription.objects.create(
+            user=self.user, stripe_customer_id='cus_1', stripe_subscription_id='sub_1', active=True,
+        )
+        self.client.post(reverse('userapp:cancel_subscription'))
+        stripe_outbox.drain(stripe_outbox.FakeStripeClient(fail_times=1))
+        op = StripeOperation.objects.get()
+        self.assertEqual(op.status, StripeOperation.FAILED)
+        self.assertTrue(Subscription.objects.get(user=self.user).active)
+        response = self.client.get(reverse('userapp:cancel_subscription'))
+        self.assertEqual(response.context['cancel_operation'], op)
+
+        self.assertEqual(stripe_outbox.retry(StripeOperation.objects.all()), 1)
+        stripe_outbox.drain(stripe_outbox.FakeStripeClient())
+        self.assertEqual(StripeOperation.objects.get().status, StripeOperation.DONE)
+        self.assertFalse(Subscription.objects.get(user=self.user).active)
+
+    def test_cancel_waits_for_the_stripe_subscription_id(self):
+        Subscription.objects.create(user=self.user, stripe_customer_id='', stripe_subscription_id='', active=True)
+        self.client.post(reverse('userapp:cancel_subscription'))
+        self.assertFalse(StripeOperation.objects.exists())
+        self.assertTrue(Subscription.objects.get(user=self.user).active)
+
+    def test_second_subscribe_is_rejected_and_keeps_customer(self):
+        Subscription.objects.create(user=self.user, stripe_customer_id='cus_old', stripe_subscription_id='sub_old', active=False)
+        self.subscribe()
+        response = self.client.post(
+            reverse('userapp:subscribe'), {'token': 'tok_visa', 'name': 'Taro Nagoya'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(StripeOperation.objects.count(), 1)
+        subscription = Subscription.objects.get(user=self.user)
+        self.assertEqual((subscription.stripe_customer_id, subscription.stripe_subscription_id), ('cus_old', ''))
+
+    def test_checkout_session_is_returned_by_polling(self):
+        response = self.client.post(reverse('userapp:create_checkout_session'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        stripe_outbox.drain()
+        status = self.poll(response.json()['poll_url'])
+        self.assertTrue(status['sessionId'].startswith('cs_fake'))
+
+
+# Stripe Webhook の受信とイベントの反映（記録したイベントJSONを再生する）
+WEBHOOK_SECRET = 'whsec_test'
+EVENT_DIR = Path(__file__).resolve().parent / 'testdata' / 'stripe_events'
+
+
+def load_event(name):
+    return (EVENT_DIR / f'{name}.json').read_bytes()
+
+
+def sign(payload, secret=WEBHOOK_SECRET):
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class StripeWebhookTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        Subscription.objects.create(
+            user=self.user, stripe_customer_id='cus_QWtestCustomer',
+            stripe_subscription_id='sub_1PfTestSubscription', active=True,
+        )
+
+    def replay(self, *names):
+        for name in names:
+            payload = load_event(name)
+            response = self.client.post(
+                reverse('userapp:stripe_webhook'), payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=sign(payload),
+            )
+            self.assertEqual(response.status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            stripe_events.drain()
+
+    def assertPaid(self, user, paid):
+        user = User.objects.get(pk=user.pk)
+        self.assertEqual(Subscription.objects.get(user=user).active, paid)
+        self.assertEqual(user.is_paid_member, paid)
+        self.assertEqual(is_paid_member(user), paid)
+
+    def test_rejects_invalid_signature(self):
+        payload = load_event('invoice.paid')
+        response = self.client.post(
+            reverse('userapp:stripe_webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign(payload, 'whsec_other'),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='')
+    def test_rejects_everything_without_secret(self):
+        # 空の鍵で作った署名は正しく見えるので、鍵が未設定なら何も保存しない
+        payload = load_event('customer.subscription.deleted')
+        response = self.client.post(
+            reverse('userapp:stripe_webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=sign(payload, ''),
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(StripeEvent.objects.exists())
+        self.assertPaid(self.user, True)
+
+    def test_events_are_stored_once_and_processed_later(self):
+        payload = load_event('customer.subscription.updated')
+        for _ in range(2):
+            self.client.post(
+                reverse('userapp:stripe_webhook'), payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=sign(payload),
+            )
+        self.assertEqual(StripeEvent.objects.count(), 1)
+        self.assertPaid(self.user, True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(stripe_events.drain(), 1)
+        self.assertPaid(self.user, False)
+        self.assertFalse(StripeEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_latest_event_in_batch_wins(self):
+        # 受信順に関係なく、発生日時が新しい invoice.paid（更新成功）が past_due より優先される
+        self.replay('invoice.paid', 'customer.subscription.updated')
+        self.assertPaid(self.user, True)
+
+    def test_subscription_deleted_in_dashboard(self):
+        self.replay('customer.subscription.deleted')
+        self.assertPaid(self.user, False)
+
+    def test_checkout_completed_links_subscription_by_email(self):
+        hanako = User.objects.create_user('hanako', 'hanako@example.com', 'password')
+        Subscription.objects.create(user=hanako, stripe_customer_id='', stripe_subscription_id='', active=False)
+        self.replay('checkout.session.completed')
+        self.assertPaid(hanako, True)
+        subscription = Subscription.objects.get(user=hanako)
+        self.assertEqual(subscription.stripe_subscription_id, 'sub_1PfCheckoutSubscription')
+        self.assertEqual(subscription.stripe_customer_id, 'cus_QWcheckoutCustomer')
+        self.assertPaid(self.user, True)
+
+    def test_checkout_completed_matches_mixed_case_email(self):
+        hanako = User.objects.create_user('hanako', 'Hanako@Example.com', 'password')
+        Subscription.objects.create(user=hanako, stripe_customer_id='', stripe_subscription_id='', active=False)
+        self.replay('checkout.session.completed')
+        self.assertPaid(hanako, True)
+
+
+# メールの送信キュー
+class CountingBackend(LocmemEmailBackend):
+    """接続を開いた回数を数え、指定回数だけ切断エラーを起こす locmem バックエンド"""
+
+    def __init__(self, disconnects=0, **kwargs):
+        super().__init__(**kwargs)
+        self.opened = 0
+        self.disconnects = disconnects
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        if self.disconnects:
+            self.disconnects -= 1
+            raise smtplib.SMTPServerDisconnected('connection lost')
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='userapp.mail.QueuedEmailBackend', QUEUED_EMAIL_BACKOFF=0)
+class QueuedEmailTests(TestCase):
+    def setUp(self):
+        for i in range(3):
+            User.objects.create_user(f'user{i}', f'user{i}@example.com', 'password')
+
+    def request_resets(self):
+        for i in range(3):
+            form = PasswordResetForm({'email': f'user{i}@example.com'})
+            self.assertTrue(form.is_valid())
+            form.save(domain_override='testserver')
+
+    def test_password_reset_is_queued_and_sent_over_one_connection(self):
+        self.request_resets()
+        self.assertEqual(len(django_mail.outbox), 0)
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.PENDING).count(), 3)
+
+        connection = CountingBackend()
+        self.assertEqual(mail.drain(connection), 3)
+        self.assertEqual(connection.opened, 1)
+        self.assertEqual(sorted(m.to[0] for m in django_mail.outbox), [f'user{i}@example.com' for i in range(3)])
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.SENT).count(), 3)
+
+    def test_disconnect_reopens_and_retries(self):
+        self.request_resets()
+        connection = CountingBackend(disconnects=1)
+        self.assertEqual(mail.drain(connection), 3)
+        self.assertEqual(connection.opened, 2)
+        self.assertEqual(len(django_mail.outbox), 3)
+
+    @override_settings(QUEUED_EMAIL_MAX_ATTEMPTS=2)
+    def test_gives_up_after_max_attempts(self):
+        django_mail.send_mail('件名', '本文', None, ['user0@example.com'])
+        for _ in range(2):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                mail.drain(CountingBackend(disconnects=2))
+        email = QueuedEmail.objects.get()
+        self.assertEqual((email.status, email.attempts), (QueuedEmail.FAILED, 2))
+        self.assertEqual(mail.drain(CountingBackend()), 0)
+
+    def test_claimed_emails_are_not_sent_by_another_worker(self):
+        self.request_resets()
+        claimed = mail.claim(2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(QueuedEmail.objects.filter(status=QueuedEmail.SENDING).count(), 2)
+        # 別のワーカーは確保されていない1通だけを送る
+        self.assertEqual(mail.drain(CountingBackend()), 1)
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertEqual(mail.claim(10), [])
+
+    def test_stale_claims_are_taken_over(self):
+        self.request_resets()
+        mail.claim(10)
+        QueuedEmail.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(mail.drain(CountingBackend()), 3)
+
+    def test_unsent_rows_are_released_when_the_connection_fails(self):
+        self.request_resets()
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            mail.drain(CountingBackend(disconnects=2))
+        self.assertFalse(QueuedEmail.objects.filter(status=QueuedEmail.SENDING).exists())
+        self.assertEqual(
+            sorted(QueuedEmail.objects.values_list('attempts', flat=True)), [0, 0, 1],
+        )
+        self.assertEqual(mail.drain(CountingBackend()), 3)
+
+
+# 予約枠の席数
+class BookingTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='テスト店', category=category, capacity=4)
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        self.date_time = (timezone.localtime() + timedelta(days=1)).replace(hour=18, minute=30)
+
+    def test_books_until_capacity(self):
+        booking.book(self.shop, self.user, self.date_time, 3)
+        with self.assertRaises(booking.SlotFullError):
+            booking.book(self.shop, self.user, self.date_time.replace(minute=0), 2)
+        booking.book(self.shop, self.user, self.date_time.replace(minute=59), 1)
+        slot = ReservationSlot.objects.get()
+        self.assertEqual((slot.booked, slot.start.minute), (4, 0))
+
+    def test_cancel_releases_seats(self):
+        reservation = booking.book(self.shop, self.user, self.date_time, 4)
+        reservation.delete()
+        self.assertEqual(ReservationSlot.objects.get().booked, 0)
+        booking.book(self.shop, self.user, self.date_time, 4)
+
+    def test_slot_smaller_than_party_is_full(self):
+        # 席数を減らした枠に、席数より多い人数で予約しても負の値を作らずに満席になる
+        slot = booking.get_slot(self.shop, booking.slot_start(self.shop, self.date_time))
+        ReservationSlot.objects.filter(pk=slot.pk).update(capacity=2)
+        with self.assertRaises(booking.SlotFullError):
+            booking.book(self.shop, self.user, self.date_time, 3)
+        self.assertEqual(ReservationSlot.objects.get().booked, 0)
+
+    def test_slot_minutes_must_be_positive(self):
+        self.shop.slot_minutes = 0
+        with self.assertRaises(ValidationError):
+            self.shop.full_clean()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.shop.save()
+
+
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='テスト店', category=category, capacity=4)
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        self.day = timezone.localdate() + timedelta(days=1)
+        self.date_time = timezone.make_aware(datetime.combine(self.day, dt_time(18, 30)))
+
+    def remaining(self):
+        slots = availability.get_availability([self.shop.pk], self.day, self.day, dt_time(17), dt_time(21))
+        return {start.hour: remaining for start, remaining in slots[self.shop]}
+
+    def test_reads_remaining_seats_from_slots(self):
+        booking.book(self.shop, self.user, self.date_time, 3)
+        # 枠ごとに席数を変えた枠は、店舗の席数ではなく枠の席数を使う
+        ReservationSlot.objects.create(
+            shop=self.shop, start=self.date_time.replace(hour=20, minute=0), capacity=2, booked=1,
+        )
+        # 枠に割り当てられていない予約は受付の判定に使われないので、空き状況にも数えない
+        Reservation.objects.create(shop=self.shop, user=self.user, date_time=self.date_time.replace(hour=19), num_people=4)
+        caches['default'].clear()
+        self.assertEqual(self.remaining(), {17: 4, 18: 1, 19: 4, 20: 1})
+
+    def test_cache_follows_bookings_and_capacity(self):
+        self.assertEqual(self.remaining()[18], 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = booking.book(self.shop, self.user, self.date_time, 3)
+        self.assertEqual(self.remaining()[18], 1)
+        self.shop.capacity = 6
+        self.shop.save()
+        self.assertEqual(self.remaining(), {17: 6, 18: 3, 19: 6, 20: 6})
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.delete()
+        self.assertEqual(self.remaining()[18], 6)
+
+    def test_invalidate_does_not_read_shop(self):
+        self.remaining()
+        key = availability.cache_key(self.shop.pk, self.day)
+        self.assertIsNotNone(caches['default'].get(key))
+        with self.assertNumQueries(0):
+            availability.invalidate(self.shop.pk, self.date_time)
+        self.assertIsNone(caches['default'].get(key))
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    threads = 20
+
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='人気店', category=category, capacity=7)
+        self.users = [User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw') for i in range(self.threads)]
+        self.date_time = (timezone.localtime() + timedelta(days=1)).replace(hour=11, minute=0)
+        # 枠は先に作っておき、全スレッドが同じ行への加算を取り合うようにする
+        booking.get_slot(self.shop, booking.slot_start(self.shop, self.date_time))
+
+    def test_capacity_holds_under_concurrent_bookings(self):
+        barrier = threading.Barrier(self.threads)
+        results = []
+
+        def worker(user):
+            try:
+                barrier.wait()
+                for _ in range(50):
+                    try:
+                        booking.book(self.shop, user, self.date_time, 1)
+                        results.append('booked')
+                        return
+                    except booking.SlotFullError:
+                        results.append('full')
+                        return
+                    except OperationalError:
+                        # SQLite のロック待ちのタイムアウトは再試行する
+                        time.sleep(0.01)
+                results.append('gave up')
+            finally:
+                close_old_connections()
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count('booked'), self.shop.capacity)
+        self.assertEqual(results.count('full'), self.threads - self.shop.capacity)
+        self.assertEqual(ReservationSlot.objects.get().booked, self.shop.capacity)
+        self.assertEqual(Reservation.objects.count(), self.shop.capacity)
+
+
+# 近くの店舗の検索
+class NearbyTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        # 名古屋駅から約 0m・約 1.1km・約 11km
+        self.station = self.create_shop('駅前店', 35.1709, 136.8815)
+        self.sakae = self.create_shop('栄店', 35.1709, 136.8937)
+        self.far = self.create_shop('郊外店', 35.2709, 136.8815)
+
+    def create_shop(self, name, latitude, longitude):
+        return Shop.objects.create(name=name, category=self.category, latitude=latitude, longitude=longitude)
+
+    def test_returns_shops_within_radius_nearest_first(self):
+        shops = geo.nearby(35.1709, 136.8815, 2000)
+        self.assertEqual([shop.name for shop in shops], ['駅前店', '栄店'])
+        self.assertAlmostEqual(shops[1].distance, 1110, delta=20)
+        self.assertEqual([shop.name for shop in geo.nearby(35.1709, 136.8815, 20000, limit=1)], ['駅前店'])
+
+    def test_cells_cover_the_circle(self):
+        cells = geo.cells_within(35.1709, 136.8815, 2000)
+        self.assertIn(self.station.geo_cell, cells)
+        self.assertIn(self.sakae.geo_cell, cells)
+        self.assertNotIn(self.far.geo_cell, cells)
+
+    def test_cell_count_is_bounded_near_the_poles(self):
+        for latitude in (89, 89.9, 89.99, 90, -90):
+            cells = geo.cells_within(latitude, 136.9, 5000)
+            self.assertTrue(cells is None or len(cells) <= geo.MAX_CELLS)
+
+    def test_api_near_the_pole(self):
+        self.create_shop('極点店', 89.995, 0)
+        response = self.client.get(
+            reverse('userapp:nearby_shops'), {'lat': 89.99, 'lng': 136.9, 'radius': 5000}, HTTP_HOST='127.0.0.1',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([shop['name'] for shop in response.json()['shops']], ['極点店'])
+
+
+# フリーワード検索と検索結果のページング
+@override_settings(SEARCH_MAX_RESULTS=3, SEARCH_PAGE_SIZE=2)
+class SearchTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        other = Category.objects.create(category_l='和食', name='味噌煮込み')
+        self.shops = [
+            Shop.objects.create(name=f'名物店{i}', category=category, region='中区' if i % 2 else '東区')
+            for i in range(9)
+        ]
+        self.cafe = Shop.objects.create(name='喫茶店', category=other, description='名物のモーニング')
+        Shop.objects.create(name='定食屋', category=other)
+        search.rebuild_index()
+
+    def test_partial_match_ranks_name_above_description(self):
+        ids = search.search_shops('名物', limit=100)
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(ids[-1], self.cafe.pk)
+        self.assertEqual(len(search.search_shops('まぶ', limit=100)), 9)
+        self.assertEqual(search.search_shops('まぶ 名物店3'), [self.shops[3].pk])
+        self.assertEqual(search.search_shops('ﾓｰﾆﾝｸﾞ'), [self.cafe.pk])
+
+    def test_matching_is_not_capped(self):
+        self.assertEqual(search.filter_matching(Shop.objects.all(), '名物').count(), 10)
+        within = Shop.objects.filter(region='中区')
+        self.assertEqual(len(search.search_shops('名物', limit=100, within=within)), 4)
+
+    def walk(self, params):
+        results = search_query.get_results(params)
+        ids, after = [], None
+        while True:
+            page = search_query.paginate(params, results, after=after)
+            ids += [shop.pk for shop in page.object_list]
+            if not page.has_next:
+                return results, ids
+            after = page.next_cursor
+
+    def test_hits_beyond_the_cap_are_counted_and_paged(self):
+        results, ids = self.walk(search_query.normalize_params({'freeword': '名物'}))
+        self.assertEqual((results['count'], len(results['ids']), results['complete']), (10, 3, False))
+        self.assertEqual(ids[:3], results['ids'])
+        self.assertEqual(sorted(ids), sorted([shop.pk for shop in self.shops] + [self.cafe.pk]))
+
+    def test_filters_apply_to_all_hits_before_ranking(self):
+        expected = sorted(shop.pk for shop in self.shops if shop.region == '中区')
+        results, ids = self.walk(search_query.normalize_params({'freeword': '名物', 'region': '中区'}))
+        self.assertEqual(results['count'], 4)
+        self.assertTrue(set(results['ids']) <= set(expected))
+        self.assertEqual(sorted(ids), expected)
+
+    def test_inverted_index_backend(self):
+        backend = search.InvertedIndexBackend()
+        backend.index(Shop.objects.select_related('category'))
+        terms = search.parse_query('名物')
+        ranked = [shop_id for shop_id, _ in backend.search(terms, 100)]
+        self.assertEqual(len(ranked), 10)
+        self.assertEqual(ranked[-1], self.cafe.pk)
+        self.assertEqual(Shop.objects.filter(pk__in=backend.matching(terms)[0]).count(), 10)
+        within = Shop.objects.filter(region='中区')
+        self.assertEqual(len(backend.search(terms, 100, within)), 4)
+
+
+# 管理画面の店舗検索
+@override_settings(SEARCH_MAX_RESULTS=2, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ShopAdminSearchTests(TestCase):
+    def test_search_is_not_capped(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        for i in range(3):
+            Shop.objects.create(name=f'名物店{i}', category=category)
+        Shop.objects.create(name='喫茶店', category=category)
+        search.rebuild_index()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:userapp_shop_changelist'), {'q': '名物'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+
+@override_settings(STRIPE_CLIENT='userapp.stripe_outbox.FakeStripeClient')
+class ConcurrentSubscribeTests(TransactionTestCase):
+    threads = 5
+
+    def test_double_click_enqueues_one_subscription(self):
+        user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        barrier = threading.Barrier(self.threads)
+        statuses = []
+
+        clients = []
+        for _ in range(self.threads):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+
+        def worker(client):
+            try:
+                barrier.wait()
+                for _ in range(50):
+                    # SQLite のロック待ちで失敗したものは再試行する
+                    try:
+                        response = client.post(
+                            reverse('userapp:subscribe'), {'token': 'tok_visa', 'name': 'Taro Nagoya'},
+                            content_type='application/json',
+                        )
+                    except OperationalError:
+                        time.sleep(0.01)
+                        continue
+                    if response.status_code == 403 and 'locked' in response.json()['message']:
+                        time.sleep(0.01)
+                        continue
+                    statuses.append(response.status_code)
+                    return
+                statuses.append('gave up')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # ロック待ちで再試行した登録済みのクリックは 409 になるので、登録された処理の数で確かめる
+        self.assertEqual(len(statuses), self.threads)
+        self.assertTrue(set(statuses) <= {202, 409})
+        self.assertLessEqual(statuses.count(202), 1)
+        self.assertEqual(StripeOperation.objects.filter(operation=StripeOperation.CREATE_SUBSCRIPTION).count(), 1)
+
+
+# Stripe 呼び出しのサーキットブレーカー
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = stripe_gateway.CircuitBreaker(2, 30, clock=self.clock)
+
+    def test_opens_after_consecutive_failures_and_closes_after_a_good_trial(self):
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, self.breaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, self.breaker.OPEN)
+        with self.assertRaises(stripe_gateway.CircuitOpenError):
+            self.breaker.before_call()
+
+        self.clock.now = 30
+        self.breaker.before_call()
+        # 試しの呼び出しの間はほかの呼び出しを通さない
+        with self.assertRaises(stripe_gateway.CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, self.breaker.CLOSED)
+
+    def test_failed_trial_reopens(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.now = 30
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, self.breaker.OPEN)
+
+    @override_settings(STRIPE_BREAKER_THRESHOLD=1, STRIPE_BREAKER_RESET_TIMEOUT=0)
+    def test_unexpected_error_in_trial_does_not_wedge_the_breaker(self):
+        stripe_gateway.reset()
+        self.addCleanup(stripe_gateway.reset)
+
+        def fail(error):
+            def func(client):
+                raise error
+            return func
+
+        with self.assertRaises(stripe.error.APIConnectionError):
+            stripe_gateway.call('test', fail(stripe.error.APIConnectionError('down')))
+        self.assertEqual(stripe_gateway.get_breaker().state, stripe_gateway.CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(ValueError):
+            stripe_gateway.call('test', fail(ValueError('bug')))
+        self.assertEqual(stripe_gateway.call('test', lambda client: 'ok'), 'ok')
+        self.assertEqual(stripe_gateway.get_breaker().state, stripe_gateway.CircuitBreaker.CLOSED)
+
+
+# 店舗の一括取り込み
+class ImportShopsTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.existing = Shop.objects.create(name='本店', address='名古屋市中区1-1', category=self.category)
+        self.same_name = Shop.objects.create(name='本店', address='名古屋市東区2-2', category=self.category)
+        self.untouched = Shop.objects.create(name='対象外の店', category=self.category)
+        search.rebuild_index()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def run_import(self, filename, content):
+        path = Path(self.directory.name) / filename
+        path.write_text(content, encoding='utf-8')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_shops', str(path), stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_csv_creates_and_matches_by_name_and_address(self):
+        stdout, stderr = self.run_import('shops.csv', (
+            'name,address,category_l,category,opening_hours,capacity\n'
+            '本店,名古屋市中区1-1,和食,ひつまぶし,11:00-14:00,8\n'
+            '新店,名古屋市西区3-3,和食,味噌煮込み,17:00-23:00,\n'
+            ',住所だけ,和食,ひつまぶし,,\n'
+            '別店,,和食,ひつまぶし,,0\n'
+        ))
+        self.assertIn('新規 1件・更新 1件・変更なし 0件・エラー 2件', stdout)
+        self.assertIn('4行目: name は必須です', stderr)
+        self.assertIn('5行目: capacity は1以上で指定してください', stderr)
+        self.existing.refresh_from_db()
+        self.same_name.refresh_from_db()
+        self.assertEqual((self.existing.capacity, self.same_name.capacity), (8, 20))
+        created = Shop.objects.get(name='新店')
+        self.assertEqual(created.category.name, '味噌煮込み')
+        # 登録・更新した店舗だけがインデックスと営業区間に反映される
+        self.assertEqual(search.search_shops('新店'), [created.pk])
+        self.assertEqual(
+            set(OpeningPeriod.objects.values_list('shop_id', 'open_minute').distinct()),
+            {(self.existing.pk, 11 * 60), (created.pk, 17 * 60)},
+        )
+
+    def test_jsonl_matches_by_id_and_reports_error_rows(self):
+        search.remove_shops([self.untouched.pk])
+        stdout, stderr = self.run_import('shops.jsonl', '\n'.join([
+            json.dumps({'id': self.same_name.pk, 'name': '東区店', 'category_id': self.category.pk}, ensure_ascii=False),
+            json.dumps({'id': 900, 'name': '番号指定の店', 'category_id': self.category.pk}, ensure_ascii=False),
+            '{壊れた行',
+            json.dumps({'name': '業態なし'}, ensure_ascii=False),
+            json.dumps({'name': '業態の番号違い', 'category_id': 999}, ensure_ascii=False),
+        ]))
+        self.assertIn('新規 1件・更新 1件・変更なし 0件・エラー 3件', stdout)
+        self.assertIn('3行目: JSONとして読めません', stderr)
+        self.assertIn('4行目: category_l と category（または category_id）は必須です', stderr)
+        self.assertIn('5行目: category_id の業態がありません: 999', stderr)
+        self.same_name.refresh_from_db()
+        self.assertEqual((self.same_name.name, self.same_name.address), ('東区店', '名古屋市東区2-2'))
+        self.assertEqual(search.search_shops('東区店'), [self.same_name.pk])
+        self.assertEqual(search.search_shops('番号指定'), [900])
+        # インデックス全体は作り直さない
+        self.assertEqual(search.search_shops('対象外'), [])
+        # 連番は指定した id の続きから振られる
+        self.assertGreater(Shop.objects.create(name='次の店', category=self.category).pk, 900)
+
+    def test_unchanged_rows_are_counted(self):
+        self.run_import('shops.csv', 'name,address,category_l,category\n本店,名古屋市中区1-1,和食,ひつまぶし\n')
+        stdout, _ = self.run_import('shops.csv', 'name,address,category_l,category\n本店,名古屋市中区1-1,和食,ひつまぶし\n')
+        self.assertIn('新規 0件・更新 0件・変更なし 1件・エラー 0件', stdout)
+
+    def test_created_shops_are_indexed_without_returned_pks(self):
+        # MySQL の bulk_create は主キーを返さないので、照合キーで引き直してインデックスに登録する
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            self.run_import('shops.csv', (
+                'name,address,category_l,category,opening_hours\n'
+                '本店,名古屋市北区4-4,和食,ひつまぶし,11:00-14:00\n'
+            ))
+        created = Shop.objects.get(address='名古屋市北区4-4')
+        self.assertEqual(sorted(search.search_shops('本店', limit=100)), [self.existing.pk, self.same_name.pk, created.pk])
+        self.assertEqual(list(OpeningPeriod.objects.values_list('shop_id', flat=True).distinct()), [created.pk])
+
+
+# レビュー・予約・サブスクリプションの書き出し
+class ExportTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='テスト店', category=category)
+        comments = ['=HYPERLINK("http://example.com")', '+1', '-1+2', '@SUM(A1)', '\t=1', 'おいしい', '1-2']
+        self.reviews = [
+            Review.objects.create(
+                shop=self.shop, user=User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw'),
+                comment=comment, score=i % 5 + 1,
+            )
+            for i, comment in enumerate(comments)
+        ]
+
+    def export(self, *args):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'out'
+        call_command('export_data', *args, '-o', str(path), stderr=io.StringIO())
+        return path.read_text(encoding='utf-8')
+
+    def test_csv_escapes_formulas(self):
+        rows = list(csv.reader(io.StringIO(self.export('reviews', '--chunk-size', '3'))))
+        self.assertEqual(rows[0][:3], ['id', 'shop_id', 'shop__name'])
+        self.assertEqual([row[6] for row in rows[1:]], [
+            '\'=HYPERLINK("http://example.com")', "'+1", "'-1+2", "'@SUM(A1)", "'\t=1", 'おいしい', '1-2',
+        ])
+        # 数値の列はそのまま書き出す
+        self.assertEqual([row[0] for row in rows[1:]], [str(review.pk) for review in self.reviews])
+
+    def test_jsonl_keeps_values_and_filters_dates(self):
+        Review.objects.filter(pk=self.reviews[0].pk).update(created_at=timezone.now() - timedelta(days=10))
+        since = (timezone.localdate() - timedelta(days=1)).isoformat()
+        rows = [json.loads(line) for line in self.export('reviews', '--format', 'jsonl', '--since', since).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [review.pk for review in self.reviews[1:]])
+        self.assertEqual(rows[0]['comment'], '+1')
+
+    def test_subscriptions_cannot_be_filtered_by_date(self):
+        with self.assertRaises(CommandError):
+            call_command('export_data', 'subscriptions', '--since', '2024-01-01')
+
+    def test_iter_rows_reads_every_chunk(self):
+        rows = list(batching.iter_rows(Review.objects.filter(score__gte=2), ['score'], chunk_size=2))
+        self.assertEqual(rows, [(review.score,) for review in self.reviews if review.score >= 2])
+
+
+# ユーザーの保存に合わせたプロフィールの保存
+class ProfileSaveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+
+    def profile_updates(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        return [query['sql'] for query in queries if query['sql'].startswith('UPDATE "userapp_profile"')]
+
+    def test_profile_is_created_with_user(self):
+        self.assertTrue(Profile.objects.filter(user=self.user).exists())
+
+    def test_unloaded_or_unchanged_profile_is_not_saved(self):
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            user.save()
+        user.profile.tel
+        self.assertEqual(self.profile_updates(user), [])
+
+    def test_only_changed_columns_are_saved(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.profile.tel = '052-000-0000'
+        updates = self.profile_updates(user)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"tel"', updates[0])
+        self.assertNotIn('"address"', updates[0])
+        self.assertEqual(Profile.objects.get(user=self.user).tel, '052-000-0000')
+        # 保存した値が読み込み時の値になるので、もう一度保存しても書き込まない
+        self.assertEqual(self.profile_updates(user), [])
+
+    def test_saving_specific_fields_skips_profile(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.profile.tel = '052-000-0000'
+        user.save(update_fields=['last_login'])
+        self.assertEqual(Profile.objects.get(user=self.user).tel, '')
+
+
+# 店舗の評価の集計値（レビューの保存・削除で差分を反映する）
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='本店', category=category)
+        self.other = Shop.objects.create(name='支店', category=category)
+        self.users = [User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw') for i in range(3)]
+
+    def rating(self, shop):
+        shop.refresh_from_db()
+        return shop.review_count, shop.score_sum, shop.avg_score
+
+    def review(self, user, score, shop=None):
+        return Review.objects.create(shop=shop or self.shop, user=user, comment='おいしい', score=score)
+
+    def test_create_and_edit_apply_deltas(self):
+        review = self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        self.assertEqual(self.rating(self.shop), (2, 7, 3.5))
+        review = Review.objects.get(pk=review.pk)
+        review.score = 3
+        review.save()
+        self.assertEqual(self.rating(self.shop), (2, 5, 2.5))
+        review.shop = self.other
+        review.save()
+        self.assertEqual(self.rating(self.shop), (1, 2, 2.0))
+        self.assertEqual(self.rating(self.other), (1, 3, 3.0))
+
+    def test_delete_paths_remove_reviews(self):
+        first = self.review(self.users[0], 5)
+        for user, score in zip(self.users[1:], [4, 1]):
+            self.review(user, score)
+        first.delete()
+        self.assertEqual(self.rating(self.shop), (2, 5, 2.5))
+        # 一括削除でも1件ずつシグナルが飛ぶ
+        Review.objects.filter(shop=self.shop).delete()
+        self.assertEqual(self.rating(self.shop), (0, 0, 0.0))
+
+    def test_repair_ratings_recomputes_from_reviews(self):
+        self.review(self.users[0], 4)
+        self.review(self.users[1], 1, shop=self.other)
+        Shop.objects.update(review_count=9, score_sum=9, avg_score=1.0)
+        stdout = io.StringIO()
+        call_command('repair_ratings', str(self.shop.pk), stdout=stdout)
+        self.assertIn('1件の店舗の評価を更新しました', stdout.getvalue())
+        self.assertEqual(self.rating(self.shop), (1, 4, 4.0))
+        self.assertEqual(self.rating(self.other), (9, 9, 1.0))
+        Shop.recompute_ratings()
+        self.assertEqual(self.rating(self.other), (1, 1, 1.0))
+
+
+# 予算の数値列と価格帯での絞り込み
+class BudgetBoundsTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(category_l='和食', name='ひつまぶし')
+
+    def test_bounds_follow_price_range(self):
+        self.assertEqual(budget_bounds('3000'), (3000, 3000))
+        self.assertEqual(budget_bounds(''), (None, None))
+        self.assertEqual(budget_bounds(None), (None, None))
+        shop = Shop.objects.create(name='本店', category=self.category, price_range='2000')
+        self.assertEqual((shop.min_budget, shop.max_budget), (2000, 2000))
+        # price_range だけを保存しても数値列が一緒に更新される
+        shop.price_range = '5000'
+        shop.save(update_fields=['price_range'])
+        shop.refresh_from_db()
+        self.assertEqual((shop.min_budget, shop.max_budget), (5000, 5000))
+
+    def test_price_range_filter_uses_bounds(self):
+        shops = {
+            price: Shop.objects.create(name=f'{price}円の店', category=self.category, price_range=price)
+            for price in ['1000', '2000', '3000', '5000']
+        }
+        Shop.objects.create(name='予算未設定の店', category=self.category)
+
+        def matching(price_range):
+            return set(search_query.filter_shops({'price_range': price_range}).values_list('pk', flat=True))
+
+        self.assertEqual(matching('1000-2000'), {shops['1000'].pk, shops['2000'].pk})
+        self.assertEqual(matching('3000-'), {shops['3000'].pk, shops['5000'].pk})
+
+
+# 検索結果のキーセット方式のページングと結果キャッシュ
+@override_settings(
+    SEARCH_MAX_RESULTS=3, SEARCH_PAGE_SIZE=2,
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+)
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shops = [
+            Shop.objects.create(name=f'店{i}', category=category, region='中区' if i % 3 else '北区')
+            for i in range(7)
+        ]
+
+    def pages(self, params):
+        results = search_query.get_results(params)
+        pages, after = [], None
+        while True:
+            page = search_query.paginate(params, results, after=after)
+            pages.append([shop.pk for shop in page.object_list])
+            if not page.has_next:
+                return results, pages
+            after = page.next_cursor
+
+    def test_pages_follow_pk_order_past_the_cache(self):
+        results, pages = self.pages({})
+        ids = [shop.pk for shop in self.shops]
+        self.assertEqual((results['count'], results['complete']), (7, False))
+        self.assertEqual(results['ids'], ids[:3])
+        self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:6], ids[6:]])
+
+    def test_filtered_results_fit_in_the_cache(self):
+        results, pages = self.pages({'region': '北区'})
+        ids = [shop.pk for shop in self.shops if shop.region == '北区']
+        self.assertEqual((results['count'], results['complete'], results['ids']), (3, True, ids))
+        self.assertEqual(pages, [ids[:2], ids[2:]])
+
+    def test_results_are_cached_until_shops_change(self):
+        self.assertEqual(search_query.get_results({})['count'], 7)
+        with self.assertNumQueries(0):
+            self.assertEqual(search_query.get_results({})['count'], 7)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shops[0].delete()
+        self.assertEqual(search_query.get_results({})['count'], 6)
+
+    def test_view_links_the_next_page_by_cursor(self):
+        response = self.client.get(reverse('userapp:search'))
+        self.assertEqual(response.context['total_hit_count'], 7)
+        self.assertEqual(response.context['next_query'], f'after={self.shops[1].pk}')
+        response = self.client.get(reverse('userapp:search'), {'after': self.shops[5].pk})
+        self.assertEqual([shop.pk for shop in response.context['shop_info']], [self.shops[6].pk])
+        self.assertIsNone(response.context['next_query'])
+
+
+# 検索結果のファセット（絞り込み候補ごとの件数）
+class FacetTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        categories = [
+            Category.objects.create(category_l='和食', name='ひつまぶし'),
+            Category.objects.create(category_l='和食', name='味噌煮込み'),
+        ]
+        regions = ['北区', '中区', '昭和区', None]
+        prices = ['1000', '3000', '5000', None]
+        for i in range(12):
+            Shop.objects.create(
+                name=f'名物店{i}' if i % 2 else f'店{i}', category=categories[i % 2], region=regions[i % 4],
+                price_range=prices[i % 3], review_count=1 if i % 5 else 0, score_sum=i % 5, avg_score=i % 5,
+            )
+        search.rebuild_index()
+
+    def assert_counts_match_search(self, params):
+        for facet in facets.build_facets(params):
+            for option in facet['options']:
+                expected = search_query.filter_shops(dict(params, **{facet['field']: option['value']})).count()
+                self.assertEqual(option['count'], expected, (params, facet['field'], option['value']))
+
+    def test_counts_match_the_search_when_each_option_is_selected(self):
+        self.assert_counts_match_search({})
+        self.assert_counts_match_search({'region': '中区', 'rating': '3'})
+        self.assert_counts_match_search({'freeword': '名物', 'price_range': '1000-2999'})
+
+    def test_cube_is_one_query_and_cached(self):
+        catalog.get_categories()
+        with self.assertNumQueries(1):
+            facets.build_facets({'region': '北区'})
+        # ファセット以外の条件が同じなら、選択を変えても集計し直さない
+        with self.assertNumQueries(0):
+            facets.build_facets({'region': '中区', 'rating': '2'})
+
+
+# リクエストごとのクエリ数の計測
+@override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_DEFAULT=3, QUERY_BUDGET_REPEAT_THRESHOLD=3)
+class QueryBudgetMiddlewareTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop_ids = [Shop.objects.create(name=f'店{i}', category=category).pk for i in range(4)]
+
+    def run_view(self, queries):
+        def view(request):
+            for shop_id in self.shop_ids[:queries]:
+                Shop.objects.get(pk=shop_id)
+            return HttpResponse()
+        return QueryBudgetMiddleware(view)(RequestFactory().get('/search/'))
+
+    def test_fingerprint_ignores_values(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'a''b' AND n = 10"),
+            fingerprint("SELECT * FROM t  WHERE id IN (%s) AND name = 'c' AND n = 2"),
+        )
+
+    def test_within_budget(self):
+        with self.assertLogs('userapp.middleware', 'INFO') as logs:
+            response = self.run_view(2)
+        self.assertEqual(response['X-DB-Query-Count'], '2')
+        self.assertNotIn('X-DB-Query-Budget-Exceeded', response)
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual(logs.records[0].query_budget['repeated'], [])
+
+    def test_over_budget_and_repeated_queries_warn(self):
+        with self.assertLogs('userapp.middleware', 'WARNING') as logs:
+            response = self.run_view(4)
+        self.assertEqual((response['X-DB-Query-Count'], response['X-DB-Query-Budget-Exceeded']), ('4', '3'))
+        record = logs.records[0].query_budget
+        self.assertEqual((record['queries'], record['budget'], len(record['repeated'])), (4, 3, 1))
+        self.assertEqual(record['repeated'][0]['count'], 4)
+
+    @override_settings(QUERY_BUDGET_ENABLED=False)
+    def test_disabled_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            QueryBudgetMiddleware(lambda request: HttpResponse())
+
+
+# カテゴリ一覧のプロセス内キャッシュ
+class CategoryCatalogTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.category = Category.objects.create(category_l='和食', name='ひつまぶし')
+
+    def test_reads_once_until_categories_change(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(catalog.get_categories(), [self.category])
+        with self.assertNumQueries(0):
+            catalog.get_categories()
+            self.assertEqual(catalog.get_category(str(self.category.pk)), self.category)
+            self.assertIsNone(catalog.get_category(0))
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Category.objects.create(category_l='洋食', name='あんかけスパ')
+        with self.assertNumQueries(1):
+            self.assertEqual(catalog.get_categories(), [self.category, other])
+
+    def test_version_is_shared_between_processes(self):
+        catalog.get_categories()
+        # 別のプロセスでの変更は、共有キャッシュのバージョンキーで伝わる
+        Category.objects.filter(pk=self.category.pk).update(name='味噌カツ')
+        caches['default'].incr(catalog.VERSION_KEY)
+        self.assertEqual(catalog.get_categories()[0].name, '味噌カツ')
+
+
+# 有料会員かどうかの判定のキャッシュ
+class MembershipTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+
+    def fresh_user(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def test_status_is_cached_per_user(self):
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertEqual(membership.get_status(user), membership.STATUS_NONE)
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertFalse(membership.is_paid_member(user))
+        self.assertEqual(membership.get_status(AnonymousUser()), membership.STATUS_NONE)
+
+    def test_subscription_changes_invalidate_and_sync_flags(self):
+        self.assertFalse(membership.is_paid_member(self.fresh_user()))
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription = Subscription.objects.create(user=self.user, active=True)
+        user = self.fresh_user()
+        self.assertTrue(membership.is_paid_member(user))
+        self.assertEqual((user.is_paid_member, user.profile.user_type), (True, 'payed'))
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription.active = False
+            subscription.save()
+        user = self.fresh_user()
+        self.assertEqual(membership.get_status(user), membership.STATUS_INACTIVE)
+        self.assertEqual((user.is_paid_member, user.profile.user_type), (False, 'free'))
+        with self.captureOnCommitCallbacks(execute=True):
+            subscription.delete()
+        self.assertEqual(membership.get_status(self.fresh_user()), membership.STATUS_NONE)
+
+    def test_sync_many_after_bulk_update(self):
+        other = User.objects.create_user('hanako', 'hanako@example.com', 'password')
+        Profile.objects.filter(user=other).delete()
+        membership.get_status(self.fresh_user())
+        Subscription.objects.bulk_create([Subscription(user=self.user, active=True)])
+        membership.sync_many({self.user.pk: True, other.pk: False})
+        self.assertTrue(membership.is_paid_member(self.fresh_user()))
+        self.assertTrue(self.fresh_user().is_paid_member)
+
+
+# 営業時間・定休日の解析と「営業中」の絞り込み
+class OpeningHoursTests(TestCase):
+    def periods(self, opening_hours, regular_holiday=''):
+        periods, problems = hours.parse(opening_hours, regular_holiday)
+        return {(day, start, end) for day, start, end in periods}, problems
+
+    def test_overnight_hours_are_split_at_midnight(self):
+        periods, problems = self.periods('17:00～翌2:00', '日曜日')
+        self.assertEqual(problems, [])
+        self.assertIn((0, 17 * 60, 1440), periods)
+        self.assertIn((1, 0, 120), periods)
+        # 日曜の営業がないので、月曜の深夜もない
+        self.assertNotIn((6, 17 * 60, 1440), periods)
+        self.assertNotIn((0, 0, 120), periods)
+        self.assertEqual(self.periods('18:00-2:00')[0], self.periods('18:00～翌2:00')[0])
+
+    def test_regular_holidays(self):
+        self.assertEqual({day for day, _, _ in self.periods('11:00-22:00', '毎週月・木曜日')[0]}, {1, 2, 4, 5, 6})
+        self.assertEqual(len(self.periods('11:00-22:00', '定休日なし')[0]), 7)
+        self.assertEqual(len(self.periods('11:00-22:00', '年中無休')[0]), 7)
+        periods, problems = self.periods('11:00-22:00', '第2月曜日')
+        self.assertEqual((len(periods), problems), (7, ['月単位の定休日は扱えません: 第2月曜日']))
+
+    def test_parenthesised_days_override_the_default_hours(self):
+        periods, problems = self.periods('11:00～23:00(土日祝は11:00-22:00)', '水曜日')
+        self.assertEqual(problems, [])
+        self.assertEqual(periods, {
+            (0, 660, 1380), (1, 660, 1380), (3, 660, 1380), (4, 660, 1380), (5, 660, 1320), (6, 660, 1320),
+        })
+        periods, _ = self.periods('月~金 11:30-14:00、17:00-22:00 土日 11:00-22:00')
+        self.assertEqual({(start, end) for day, start, end in periods if day == 2}, {(690, 840), (1020, 1320)})
+        self.assertEqual({(start, end) for day, start, end in periods if day == 6}, {(660, 1320)})
+
+    def test_unreadable_notes_are_reported(self):
+        periods, problems = self.periods('11:30～14:00, 17:00～23:00 (L.O.22:30)')
+        self.assertEqual((len(periods), problems), (14, []))
+        periods, problems = self.periods('11:00-22:00(要予約)')
+        self.assertEqual(len(periods), 7)
+        self.assertEqual(problems, ['解析できない記述があります: 11:00-22:00(要予約)'])
+        self.assertEqual(self.periods('要予約'), (set(), ['解析できない記述があります: 要予約']))
+
+    def test_open_at_filter_uses_saved_periods(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        bar = Shop.objects.create(name='バー', category=category, opening_hours='17:00～翌2:00', regular_holiday='日曜日')
+        lunch = Shop.objects.create(name='定食屋', category=category, opening_hours='11:00-15:00(土日は11:00-14:00)')
+        broken = Shop.objects.create(name='不明な店', category=category, opening_hours='要予約')
+        broken.refresh_from_db()
+        self.assertEqual(broken.opening_hours_error, '解析できない記述があります: 要予約')
+
+        def open_at(value):
+            params = search_query.normalize_params({'open_at': value})
+            return set(search_query.filter_shops(params).values_list('pk', flat=True))
+
+        self.assertEqual(open_at('0-01:30'), set())
+        self.assertEqual(open_at('1-01:30'), {bar.pk})
+        self.assertEqual(open_at('5-14:30'), set())
+        self.assertEqual(open_at('4-14:30'), {lunch.pk})
+        self.assertEqual(open_at('6-18:00'), set())
+
+
+# 似ている店舗の計算
+@override_settings(SIMILAR_SHOPS_COUNT=2, SIMILAR_SHOPS_SHRINK=0)
+class SimilarShopsTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.a, self.b, self.c, self.d = [Shop.objects.create(name=name, category=category) for name in 'ABCD']
+        self.users = [User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw') for i in range(4)]
+        self.review(0, self.a, 5)
+        self.review(0, self.b, 5)
+        self.review(1, self.a, 4)
+        self.review(1, self.b, 4)
+        Favorite.objects.create(user=self.users[1], shop=self.c)
+        # スコア1は「好みでない」なので、同じユーザーが高く評価した店舗とは似ていない
+        self.review(2, self.c, 1)
+        self.review(2, self.d, 5)
+
+    def review(self, user, shop, score):
+        return Review.objects.create(user=self.users[user], shop=shop, comment='感想', score=score)
+
+    def similar_ids(self, shop):
+        return [similar_shop.pk for similar_shop in similar.similar_shops(shop, 10)]
+
+    def test_full_refresh_ranks_by_cosine_similarity(self):
+        self.assertEqual(similar.refresh(full=True), 4)
+        self.assertEqual(self.similar_ids(self.a), [self.b.pk, self.c.pk])
+        self.assertEqual(set(self.similar_ids(self.c)), {self.a.pk, self.b.pk})
+        self.assertEqual(self.similar_ids(self.d), [])
+        self.assertFalse(Shop.objects.filter(similar_shops_stale=True).exists())
+        ranks = ShopSimilarity.objects.filter(shop=self.a).values_list('rank', 'score')
+        self.assertEqual([rank for rank, _ in ranks], [0, 1])
+        self.assertGreater(ranks[0][1], ranks[1][1])
+
+    def test_incremental_refresh_recomputes_stale_shops_and_their_listings(self):
+        similar.refresh(full=True)
+        self.assertEqual(similar.refresh(), 0)
+        self.review(3, self.d, 5)
+        Favorite.objects.create(user=self.users[3], shop=self.b)
+        # B と、B を似ている店舗に載せている A・C と、D を計算し直す
+        self.assertEqual(similar.refresh(), 4)
+        self.assertEqual(self.similar_ids(self.d), [self.b.pk])
+        self.assertEqual(self.similar_ids(self.b)[0], self.a.pk)
+        self.assertIn(self.d.pk, self.similar_ids(self.b))
+
+    @override_settings(SIMILAR_SHOPS_MAX_USER_ITEMS=2)
+    def test_users_with_many_items_are_ignored(self):
+        stdout = io.StringIO()
+        call_command('refresh_similar_shops', '--all', stdout=stdout)
+        self.assertIn('4件の店舗の似ている店舗を計算し直しました', stdout.getvalue())
+        self.assertEqual(self.similar_ids(self.a), [self.b.pk])
+        self.assertEqual(self.similar_ids(self.c), [])
+
+
+# メールアドレスの重複（大文字小文字を区別しない）
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class EmailUniquenessFormTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('taro', 'taro@example.com', 'password')
+        User.objects.create_user('hanako', 'Hanako@Example.com', 'password')
+
+    def edit_profile(self, email):
+        self.client.force_login(self.user)
+        return self.client.post(reverse('userapp:profile_edit'), {'username': 'taro', 'email': email})
+
+    def test_profile_edit_rejects_another_users_email(self):
+        response = self.edit_profile('HANAKO@example.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(response.context['form'], 'email', 'このメールアドレスは既に登録されています。')
+        self.assertEqual(User.objects.get(pk=self.user.pk).email, 'taro@example.com')
+
+    def test_profile_edit_keeps_own_email(self):
+        response = self.edit_profile('Taro@Example.com')
+        self.assertRedirects(response, reverse('userapp:profile'), fetch_redirect_response=False)
+        self.assertEqual(User.objects.get(pk=self.user.pk).email_lower, 'taro@example.com')
+
+    def test_signup_rejects_email_in_other_case(self):
+        form = SignUpForm({
+            'username': 'jiro', 'email': 'TARO@example.com', 'password1': 'x8Tq!pz2Lm', 'password2': 'x8Tq!pz2Lm',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('email', form.errors)
+
+
+# ベンチマーク用の合成データとビューの計測
+class BenchmarkCommandTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def generate(self, **options):
+        options = {'categories': 3, 'shops': 5, 'users': 4, 'reviews': 10, 'favorites': 5, **options}
+        call_command('generate_dataset', stdout=io.StringIO(), **options)
+
+    def test_generated_reservations_fill_slots(self):
+        # 席数を超えるほど予約を作り、席数で打ち切られることも確かめる
+        self.generate(reservations=300, skew=3)
+        self.generate(reservations=50, seed=1)
+        self.assertFalse(Reservation.objects.filter(slot=None).exists())
+        slots = ReservationSlot.objects.annotate(people=Sum('reservation__num_people'))
+        self.assertTrue(slots.exists())
+        for slot in slots:
+            self.assertEqual(slot.booked, slot.people)
+            self.assertLessEqual(slot.booked, slot.capacity)
+        self.assertTrue(slots.filter(booked__gt=F('capacity') - 8).exists())
+
+    def test_percentile_uses_nearest_rank(self):
+        self.assertEqual(percentile(range(1, 11), 50), 5)
+        self.assertEqual(percentile(range(1, 21), 95), 19)
+        self.assertEqual(percentile(range(1, 21), 99), 20)
+        self.assertEqual(percentile([7], 50), 7)
+
+    def test_benchmark_views_reports_every_scenario(self):
+        self.generate(reservations=20)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'bench.json'
+        call_command(
+            'benchmark_views', '--iterations', '2', '--warmup', '0', '--output', str(path),
+            stdout=io.StringIO(), stderr=io.StringIO(),
+        )
+        report = json.loads(path.read_text(encoding='utf-8'))
+        self.assertEqual(report['iterations'], 2)
+        self.assertIn('shop_info:login', report['scenarios'])
+        self.assertIn('search:all', report['scenarios'])
+        for result in report['scenarios'].values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['queries'], 0)
+
+
+# 店舗ページのクエリ数（レビュー数や似ている店舗の数によらず一定）
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ShopInfoQueryCountTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        category = Category.objects.create(category_l='和食', name='ひつまぶし')
+        self.shop = Shop.objects.create(name='本店', category=category)
+        others = [Shop.objects.create(name=f'似ている店{i}', category=category) for i in range(6)]
+        reviews_per_page = ShopInfoView.reviews_per_page
+        users = [User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw') for i in range(reviews_per_page + 5)]
+        for i, user in enumerate(users):
+            Review.objects.create(shop=self.shop, user=user, comment=f'感想{i}', score=i % 5 + 1)
+        ShopSimilarity.objects.bulk_create(
+            ShopSimilarity(shop=self.shop, similar=other, rank=rank, score=1 - rank / 10)
+            for rank, other in enumerate(others)
+        )
+        self.user = users[0]
+        self.url = reverse('userapp:shop_info', args=[self.shop.pk])
+        # 業態一覧はプロセス内キャッシュから読むので、先に読み込んでおく
+        catalog.get_categories()
+
+    def get(self, queries, **params):
+        with self.assertNumQueries(queries):
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    # 店舗・似ている店舗・レビューのページ（投稿者を含む）
+    def test_anonymous(self):
+        response = self.get(3)
+        self.assertEqual(len(response.context['review_list']), ShopInfoView.reviews_per_page)
+        self.assertEqual(len(response.context['similar_shops']), ShopInfoView.similar_shops_count)
+        response = self.get(3, page=2)
+        self.assertEqual(len(response.context['review_list']), 5)
+        self.assertEqual(response.context['review_page'].paginator.num_pages, 2)
+
+    # 上記に加えてセッション・ユーザー・お気に入りの有無
+    def test_logged_in(self):
+        self.client.force_login(self.user)
+        self.get(6)
+        self.get(6, page=2)
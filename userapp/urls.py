@@ -9,7 +9,7 @@ from .views import (
     ReservationsView, FavoritesView, PaymentMethodView, CancelSubscriptionView,
     ShopInfoView, ProfileEditView, ReservationCancelView,
     unfavorite_shop, SubscribeView, ReviewDeleteView, ReviewEditView, success, cancel, SubscriptionPaymentView,
-    stripe_config, create_checkout_session  # 追加されたビュー
+    stripe_config, create_checkout_session, stripe_operation_status, stripe_webhook, availability_api, nearby_shops_api  # 追加されたビュー
 )
 
 app_name = 'userapp'
@@ -94,4 +94,16 @@ urlpatterns = [
     # Stripe公開鍵とCheckoutセッション作成用
     path('subscription/config/', stripe_config, name='stripe_config'),
     path('subscription/create-checkout-session/', create_checkout_session, name='create_checkout_session'),
+
+    # Stripe処理の状態（ポーリング用）
+    path('subscription/operations/<str:key>/', stripe_operation_status, name='stripe_operation'),
+
+    # Stripe Webhook
+    path('stripe/webhook/', stripe_webhook, name='stripe_webhook'),
+
+    # 空き状況
+    path('api/availability/', availability_api, name='availability'),
+
+    # 近くの店舗
+    path('api/shops/nearby/', nearby_shops_api, name='nearby_shops'),
 ]
@@ -2,27 +2,34 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.views.generic import CreateView, TemplateView, View, FormView, ListView, UpdateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth import get_user_model
-from .models import Review, Category, Subscription, Shop, Reservation, Favorite
-from .forms import SearchForm, SignUpForm, EmailLoginForm, ReviewForm, ReservationForm, ReviewEditForm, SubscriptionForm, ProfileEditForm
+from .models import Review, Category, Subscription, Shop, Reservation, Favorite, StripeOperation
+from .forms import SearchForm, SignUpForm, EmailLoginForm, ReviewForm, ReservationForm, ReviewEditForm, SubscriptionForm, ProfileEditForm, AvailabilityForm, NearbyForm
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.views import LoginView, LogoutView
-from django.db.models import Avg, Q
+from django.db import transaction
+from django.db.models import Q
 from django.contrib import messages
 from django.conf import settings
 import stripe
 from django.http import JsonResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse, reverse_lazy
+from django.core.exceptions import ImproperlyConfigured
+from .paginators import KnownCountPaginator
 from .mixins import PaidMemberRequiredMixin
+from . import availability, booking, geo, hours, search_query, similar, stripe_events, stripe_outbox
+from .facets import build_facets
+from .catalog import get_categories
+from .membership import is_paid_member
 import json
 import logging
+from urllib.parse import urlencode
 
 logger = logging.getLogger(__name__)
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 # Stripeの公開鍵を返すビュー
 def stripe_config(request):
     if request.method == 'GET':
@@ -33,61 +40,36 @@ def stripe_config(request):
 def Search(request):
     total_hit_count = 0
     shop_info = []
+    next_query = None
+    facets = []
 
     if request.method == 'GET':
         searchform = SearchForm(request.GET)
-        
-        print('searchform.is_valid()',searchform.is_valid())
+
         if searchform.is_valid():
             # 各検索パラメータを取得
-            category_id = request.GET.get('selected_category', '')
-            freeword = request.GET.get('freeword', '')
-            region = request.GET.get('region', '')  # 地域
-            price_range = request.GET.get('price_range', '')  # 価格帯
-            rating = request.GET.get('rating', '')  # 評価
-
-            query = Shop.objects.all()
-
-            # カテゴリのフィルタリング
-            if category_id:
-                query = query.filter(category_id=category_id)
-
-            # フリーワードのフィルタリング（店名で検索）
-            if freeword:
-                query = query.filter(name__icontains=freeword)
-
-            # 地域のフィルタリング（住所に地域が含まれるか）
-            if region:
-                query = query.filter(region__icontains=region)
-
-            # 価格帯のフィルタリング
-            if price_range:
-                price_range_values = price_range.split('-')
-                min_price = int(price_range_values[0])
-                max_price = price_range_values[1]
-                if max_price:
-                    max_price = int(max_price)
-                    query = query.filter(price_range__gte=min_price, price_range__lte=max_price)
-                else:
-                    query = query.filter(price_range__gte=min_price)
+            search_params = search_query.normalize_params(request.GET)
+            # 検索結果（店舗IDと件数）は検索条件ごとにキャッシュされる
+            results = search_query.get_results(search_params)
+            total_hit_count = results['count']
 
-            # 評価のフィルタリング（平均スコアでフィルタリング）
-            if rating:
-                try:
-                    min_rating_value = int(rating)
-                    max_rating_value = min_rating_value + 1
-                    
-                    query = query.annotate(avg_rating=Avg('review__score')).filter(avg_rating__gte=min_rating_value, avg_rating__lt=max_rating_value)
-                except ValueError:
-                    pass  # 無効なratingが渡された場合はフィルタを適用しない
+            # 直前のページ末尾の店舗IDをカーソルにして次のページを取得
+            after = search_query.parse_cursor(request.GET.get('after'))
+            page = search_query.paginate(search_params, results, after=after)
+            shop_info = page.object_list
+
+            if page.has_next:
+                next_query = urlencode(dict(search_params, after=page.next_cursor))
 
-            total_hit_count = query.count()
-            shop_info = query[:10]  # 表示件数を制限
+            # 絞り込み候補ごとの件数
+            facets = build_facets(search_params)
 
     params = {
         'total_hit_count': total_hit_count,
         'shop_info': shop_info,
         'searchform': searchform,
+        'next_query': next_query,
+        'facets': facets,
     }
 
     return render(request, 'userapp/search.html', params)
@@ -95,6 +77,8 @@ def Search(request):
 # 店舗情報の表示および操作を行うビュー
 class ShopInfoView(View):
     template_name = 'userapp/shop_info.html'
+    reviews_per_page = 20
+    similar_shops_count = 5
 
     def get(self, request, shop_id):
         return self.render_shop_info(request, shop_id)
@@ -105,11 +89,7 @@ class ShopInfoView(View):
             messages.error(request, 'この操作を行うにはログインが必要です。', extra_tags='login')
             return redirect('userapp:login')
 
-        try:
-            subscription = Subscription.objects.get(user=request.user)
-            if not subscription.active:
-                raise Subscription.DoesNotExist
-        except Subscription.DoesNotExist:
+        if not is_paid_member(request.user):
             return redirect('userapp:subscription')
 
         # 各フォームの処理
@@ -133,11 +113,15 @@ class ShopInfoView(View):
         elif 'reservation_submit' in request.POST:
             reservation_form = ReservationForm(data=request.POST)
             if reservation_form.is_valid():
-                reservation = reservation_form.save(commit=False)
-                reservation.user = request.user
-                reservation.shop = shop
-                reservation.save()
-                messages.success(request, '予約が完了しました。', extra_tags='reservation')
+                # 枠の空きを確かめながら予約する（同時に予約が来ても席数を超えない）
+                try:
+                    booking.book(
+                        shop, request.user,
+                        reservation_form.cleaned_data['date_time'], reservation_form.cleaned_data['num_people'],
+                    )
+                    messages.success(request, '予約が完了しました。', extra_tags='reservation')
+                except booking.SlotFullError:
+                    messages.error(request, 'ご希望の時間帯は満席です。別の時間帯をお選びください。', extra_tags='reservation')
             else:
                 messages.error(request, '予約の投稿にエラーがあります。', extra_tags='reservation')
             return redirect('userapp:shop_info', shop_id=shop_id)
@@ -154,12 +138,16 @@ class ShopInfoView(View):
 
     def render_shop_info(self, request, shop_id):
         shop = get_object_or_404(Shop, pk=shop_id)
-        review_count = Review.objects.filter(shop=shop).count()
-        score_ave = Review.objects.filter(shop=shop).aggregate(Avg('score'))
-        average = score_ave['score__avg']
+        # 件数と平均は店舗の集計列から読む
+        review_count = shop.review_count
+        average = shop.avg_score if review_count else None
         average_rate = average / 5 * 100 if average else 0
         review_form = ReviewForm()
-        review_list = Review.objects.filter(shop=shop)
+        # レビューはページ単位で投稿者と一緒に取得し、件数は集計列を使ってCOUNTを省く
+        reviews = Review.objects.filter(shop=shop).select_related('user').order_by('-created_at', '-pk')
+        paginator = KnownCountPaginator(reviews, self.reviews_per_page, review_count)
+        review_page = paginator.get_page(request.GET.get('page'))
+        review_list = review_page.object_list
         reservation_form = ReservationForm(initial={'shop': shop})
 
         is_favorite = False
@@ -172,10 +160,12 @@ class ShopInfoView(View):
             'shop': shop,
             'review_form': review_form,
             'review_list': review_list,
+            'review_page': review_page,
             'average': average,
             'average_rate': average_rate,
             'reservation_form': reservation_form,
-            'is_favorite': is_favorite
+            'is_favorite': is_favorite,
+            'similar_shops': similar.similar_shops(shop, self.similar_shops_count),
         }
         return render(request, self.template_name, params)
 
@@ -188,7 +178,7 @@ class IndexView(TemplateView):
         searchform = SearchForm()
         pickup_list = Shop.objects.all()[:10]
         review_list = Review.objects.select_related('shop').all()[:10]
-        category_list = Category.objects.all()
+        category_list = get_categories()
 
         context.update({
             'searchform': searchform,
@@ -239,29 +229,31 @@ class SignUp(CreateView):
     def post(self, request, *args, **kwargs):
         form = self.form_class(data=request.POST)
         if form.is_valid():
-            user = form.save()
-            # Stripe Checkout Sessionを作成
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                customer_email=user.email,
-                line_items=[
-                    {
-                        'price': settings.STRIPE_PRICE_ID,
-                        'quantity': 1,
-                    },
-                ],
-                mode='subscription',
-                success_url=request.build_absolute_uri('/success/'),
-                cancel_url=request.build_absolute_uri('/cancel/'),
-            )
-            # 一時的にユーザー情報を保存
-            Subscription.objects.create(
-                user=user,
-                stripe_customer_id='',
-                stripe_subscription_id='',
-                active=False,
-            )
-            return redirect(checkout_session.url)
+            with transaction.atomic():
+                user = form.save()
+                # 一時的にユーザー情報を保存
+                Subscription.objects.create(
+                    user=user,
+                    stripe_customer_id='',
+                    stripe_subscription_id='',
+                    active=False,
+                )
+                # Stripe Checkout Sessionの作成はワーカーで行う
+                operation = stripe_outbox.enqueue(StripeOperation.CREATE_CHECKOUT_SESSION, {
+                    'payment_method_types': ['card'],
+                    'customer_email': user.email,
+                    'line_items': [
+                        {
+                            'price': settings.STRIPE_PRICE_ID,
+                            'quantity': 1,
+                        },
+                    ],
+                    'mode': 'subscription',
+                    'success_url': request.build_absolute_uri('/success/'),
+                    'cancel_url': request.build_absolute_uri('/cancel/'),
+                }, user=user)
+            messages.info(request, '決済ページを準備しています。')
+            return redirect(reverse('userapp:stripe_operation', args=[operation.idempotency_key]))
         return render(request, 'userapp/signup.html', {'form': form})
 
 # ログインのビュー
@@ -314,15 +306,6 @@ class ProfileView(LoginRequiredMixin, TemplateView):
 class MyPageView(LoginRequiredMixin, TemplateView):
     template_name = 'userapp/mypage.html'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        try:
-            subscription = Subscription.objects.get(user=self.request.user)
-            context['subscription'] = subscription
-        except Subscription.DoesNotExist:
-            context['subscription'] = None
-        return context
-
 # お気に入り一覧のビュー
 class FavoritesView(LoginRequiredMixin, ListView):
     model = Favorite
@@ -343,11 +326,11 @@ def unfavorite_shop(request, shop_id):
 # 予約一覧のビュー
 class ReservationsView(LoginRequiredMixin, ListView):
     model = Reservation
-    template_name = 'userapp/reservations.html'
+    template_name = 'userapp/reservation_list.html'
     context_object_name = 'reservations'
 
     def get_queryset(self):
-        return Reservation.objects.filter(user=self.request.user)
+        return Reservation.objects.filter(user=self.request.user).select_related('shop')
 
 # 支払い方法のビュー
 class PaymentMethodView(LoginRequiredMixin, TemplateView):
@@ -389,15 +372,35 @@ def cancel(request):
 class CancelSubscriptionView(LoginRequiredMixin, TemplateView):
     template_name = 'userapp/cancel_subscription.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # 直近の解約処理の状態（処理中・失敗を画面に出す）
+        context['cancel_operation'] = stripe_outbox.latest(self.request.user, StripeOperation.CANCEL_SUBSCRIPTION)
+        return context
+
     def post(self, request, *args, **kwargs):
         try:
-            subscription = Subscription.objects.get(user=request.user)
-            stripe.Subscription.delete(subscription.stripe_subscription_id)
-            subscription.active = False
-            subscription.save()
-            messages.success(request, '有料会員を解約しました。', extra_tags='subscription')
-        except stripe.error.InvalidRequestError as e:
-            messages.error(request, f'サブスクリプションの解除に失敗しました: {str(e)}')
+            if stripe_outbox.has_pending(request.user, StripeOperation.CREATE_SUBSCRIPTION):
+                messages.error(request, '有料会員の登録処理中です。完了してから解約してください。')
+                return redirect('userapp:subscription')
+            with transaction.atomic():
+                subscription = Subscription.objects.select_for_update().get(user=request.user)
+                if not subscription.active:
+                    messages.info(request, '有料会員は解約済みです。', extra_tags='subscription')
+                elif stripe_outbox.has_pending(request.user, StripeOperation.CANCEL_SUBSCRIPTION):
+                    messages.info(request, '解約の処理中です。', extra_tags='subscription')
+                elif not subscription.stripe_subscription_id:
+                    # Checkout の支払いの反映（Webhook）を待っている間は、Stripe側で解約する対象が分からない
+                    messages.error(request, 'お支払いの反映を待っています。しばらくしてから解約してください。')
+                else:
+                    # Stripe側の解約はワーカーで行い、成功するまでは有料会員のままにする
+                    # （失敗したまま会員だけ外すと、Stripeの課金が続く）
+                    stripe_outbox.enqueue(StripeOperation.CANCEL_SUBSCRIPTION, {
+                        'subscription_id': subscription.stripe_subscription_id,
+                    }, user=request.user)
+                    messages.success(request, '解約を受け付けました。手続きが完了すると有料会員の特典は終了します。', extra_tags='subscription')
+        except Subscription.DoesNotExist:
+            messages.error(request, 'サブスクリプションが見つかりません。')
         except Exception as e:
             messages.error(request, f'予期しないエラーが発生しました: {str(e)}')
 
@@ -424,34 +427,33 @@ class SubscribeView(View):
 
             cardholder_name = data.get('name')
 
-            # Stripeカスタマーを作成
-            customer = stripe.Customer.create(
-                email=request.user.email,
-                source=token,
-                name=cardholder_name
-            )
-
-            # Stripeサブスクリプションを作成
-            subscription = stripe.Subscription.create(
-                customer=customer.id,
-                items=[{'price': settings.STRIPE_PRICE_ID}],
-            )
-
-            # サブスクリプションを保存
-            Subscription.objects.create(
-                user=request.user,
-                stripe_customer_id=customer.id,
-                stripe_subscription_id=subscription.id,
-                active=True
-            )
-
-            messages.success(request, 'サブスクリプションの登録が完了しました。')
-            return JsonResponse({'status': 'success'}, status=200)
-
-        except stripe.error.StripeError as e:
-            logger.error(e, exc_info=True)
-            messages.error(request, f'エラーが発生しました: {str(e)}')
-            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+            # サブスクリプションを決済待ちで保存し、Stripeカスタマー・サブスクリプションの作成はワーカーで行う
+            with transaction.atomic():
+                Subscription.objects.get_or_create(
+                    user=request.user,
+                    defaults={'stripe_customer_id': '', 'stripe_subscription_id': '', 'active': False},
+                )
+                # 行をロックしてから確認し、二重クリックなどの同時の登録で二重に課金しない
+                subscription = Subscription.objects.select_for_update().get(user=request.user)
+                if subscription.active or stripe_outbox.has_pending(
+                    request.user, StripeOperation.CREATE_SUBSCRIPTION,
+                ):
+                    return JsonResponse({'status': 'error', 'message': '既に登録済み、または登録処理中です'}, status=409)
+                # 顧客IDは残し、解約済みのサブスクリプションIDだけ消す
+                subscription.stripe_subscription_id = ''
+                subscription.save()
+                operation = stripe_outbox.enqueue(StripeOperation.CREATE_SUBSCRIPTION, {
+                    'email': request.user.email,
+                    'token': token,
+                    'name': cardholder_name,
+                    'price': settings.STRIPE_PRICE_ID,
+                }, user=request.user)
+
+            return JsonResponse({
+                'status': operation.status,
+                'poll_url': reverse('userapp:stripe_operation', args=[operation.idempotency_key]),
+            }, status=202)
+
         except Exception as e:
             logger.error(e, exc_info=True)
             messages.error(request, f'予期しないエラーが発生しました: {str(e)}')
@@ -463,26 +465,109 @@ def create_checkout_session(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            # Stripe Checkoutセッションを作成
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[
+            # Stripe Checkoutセッションの作成はワーカーで行い、画面は poll_url で完了を待つ
+            operation = stripe_outbox.enqueue(StripeOperation.CREATE_CHECKOUT_SESSION, {
+                'payment_method_types': ['card'],
+                'line_items': [
                     {
                         'price': settings.STRIPE_PRICE_ID,  # Stripeの価格ID
                         'quantity': 1,
                     },
                 ],
-                mode='subscription',
-                success_url=request.build_absolute_uri('/subscription/success/'),
-                cancel_url=request.build_absolute_uri('/subscription/cancel/'),
-            )
+                'mode': 'subscription',
+                'success_url': request.build_absolute_uri('/subscription/success/'),
+                'cancel_url': request.build_absolute_uri('/subscription/cancel/'),
+            }, user=request.user if request.user.is_authenticated else None)
             return JsonResponse({
-                'sessionId': checkout_session['id']
-            })
+                'status': operation.status,
+                'poll_url': reverse('userapp:stripe_operation', args=[operation.idempotency_key]),
+            }, status=202)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
+# Stripe処理の状態を返すビュー（画面からポーリングする）
+def stripe_operation_status(request, key):
+    operation = get_object_or_404(StripeOperation, idempotency_key=key)
+    data = stripe_outbox.status_payload(operation)
+    if operation.operation == StripeOperation.CREATE_SUBSCRIPTION and operation.status == StripeOperation.DONE:
+        data['redirect'] = reverse('userapp:subscription')
+    elif 'url' in data:
+        data['redirect'] = data['url']
+    if 'application/json' in request.headers.get('Accept', ''):
+        return JsonResponse(data)
+    # 画面で開かれた場合は、完了するまで待機ページを表示する
+    if 'redirect' in data:
+        return redirect(data['redirect'])
+    return render(request, 'userapp/stripe_operation.html', {'operation': operation, 'status': data})
+
+# 複数店舗・複数日の空き状況（JSON）
+def availability_api(request):
+    form = AvailabilityForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    people = data['people']
+    results = availability.get_availability(
+        data['shops'], data['date_from'], data['date_to'], data['start'], data['end'],
+    )
+    return JsonResponse({
+        'people': people,
+        'shops': [
+            {
+                'id': shop.pk,
+                'name': shop.name,
+                'capacity': shop.capacity,
+                'slots': [
+                    {'start': start.isoformat(), 'remaining': remaining, 'available': remaining >= people}
+                    for start, remaining in slots
+                ],
+            }
+            for shop, slots in results.items()
+        ],
+    })
+
+# 近くの店舗（JSON、近い順）
+def nearby_shops_api(request):
+    form = NearbyForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    queryset = Shop.objects.select_related('category')
+    if data['open_at']:
+        queryset = queryset.filter(pk__in=hours.open_shop_ids(*data['open_at']))
+    shops = geo.nearby(data['lat'], data['lng'], data['radius'], queryset, limit=data['limit'])
+    return JsonResponse({
+        'shops': [
+            {
+                'id': shop.pk,
+                'name': shop.name,
+                'category': shop.category.name,
+                'address': shop.address,
+                'latitude': shop.latitude,
+                'longitude': shop.longitude,
+                'distance': round(shop.distance),
+                'url': reverse('userapp:shop_info', args=[shop.pk]),
+            }
+            for shop in shops
+        ],
+    })
+
+# Stripe Webhook の受信（イベントを保存するだけで、反映は process_stripe_events で行う）
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    try:
+        event = stripe_events.parse(request.body, request.headers.get('Stripe-Signature', ''))
+    except ImproperlyConfigured as e:
+        logger.error('Stripe Webhook を受け付けられません: %s', e)
+        return HttpResponse(status=503)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.warning('Stripe Webhook の検証に失敗しました: %s', e)
+        return HttpResponse(status=400)
+    stripe_events.store(event)
+    return HttpResponse(status=200)
+
 # 新規作成用
 class SignUpView(CreateView):
     form_class = SignUpForm
@@ -490,7 +575,7 @@ class SignUpView(CreateView):
 
     def form_valid(self, form):
         user = form.save()
-        backend = 'django.contrib.auth.backends.ModelBackend'  # ここで適切なバックエンドを指定します
+        backend = 'accounts.backends.EmailOrUsernameBackend'  # ここで適切なバックエンドを指定します
         login(self.request, user, backend=backend)
         return redirect('userapp:index')
 
@@ -521,29 +606,31 @@ class SignUp(CreateView):
     def post(self, request, *args, **kwargs):
         form = self.form_class(data=request.POST)
         if form.is_valid():
-            user = form.save()
-            # Stripe Checkout Sessionを作成
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                customer_email=user.email,
-                line_items=[
-                    {
-                        'price': settings.STRIPE_PRICE_ID,
-                        'quantity': 1,
-                    },
-                ],
-                mode='subscription',
-                success_url=request.build_absolute_uri('/success/'),
-                cancel_url=request.build_absolute_uri('/cancel/'),
-            )
-            # 一時的にユーザー情報を保存
-            Subscription.objects.create(
-                user=user,
-                stripe_customer_id='',
-                stripe_subscription_id='',
-                active=False,
-            )
-            return redirect(checkout_session.url)
+            with transaction.atomic():
+                user = form.save()
+                # 一時的にユーザー情報を保存
+                Subscription.objects.create(
+                    user=user,
+                    stripe_customer_id='',
+                    stripe_subscription_id='',
+                    active=False,
+                )
+                # Stripe Checkout Sessionの作成はワーカーで行う
+                operation = stripe_outbox.enqueue(StripeOperation.CREATE_CHECKOUT_SESSION, {
+                    'payment_method_types': ['card'],
+                    'customer_email': user.email,
+                    'line_items': [
+                        {
+                            'price': settings.STRIPE_PRICE_ID,
+                            'quantity': 1,
+                        },
+                    ],
+                    'mode': 'subscription',
+                    'success_url': request.build_absolute_uri('/success/'),
+                    'cancel_url': request.build_absolute_uri('/cancel/'),
+                }, user=user)
+            messages.info(request, '決済ページを準備しています。')
+            return redirect(reverse('userapp:stripe_operation', args=[operation.idempotency_key]))
         return render(request, 'userapp/signup.html', {'form': form})
 
 # ログインのビュー
@@ -596,15 +683,6 @@ class ProfileView(LoginRequiredMixin, TemplateView):
 class MyPageView(LoginRequiredMixin, TemplateView):
     template_name = 'userapp/mypage.html'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        try:
-            subscription = Subscription.objects.get(user=self.request.user)
-            context['subscription'] = subscription
-        except Subscription.DoesNotExist:
-            context['subscription'] = None
-        return context
-
 # お気に入り一覧のビュー
 class FavoritesView(LoginRequiredMixin, ListView):
     model = Favorite
@@ -625,11 +703,11 @@ def unfavorite_shop(request, shop_id):
 # 予約一覧のビュー
 class ReservationsView(LoginRequiredMixin, ListView):
     model = Reservation
-    template_name = 'userapp/reservations.html'
+    template_name = 'userapp/reservation_list.html'
     context_object_name = 'reservations'
 
     def get_queryset(self):
-        return Reservation.objects.filter(user=self.request.user)
+        return Reservation.objects.filter(user=self.request.user).select_related('shop')
 
 # 支払い方法のビュー
 class PaymentMethodView(LoginRequiredMixin, TemplateView):
@@ -671,15 +749,35 @@ def cancel(request):
 class CancelSubscriptionView(LoginRequiredMixin, TemplateView):
     template_name = 'userapp/cancel_subscription.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # 直近の解約処理の状態（処理中・失敗を画面に出す）
+        context['cancel_operation'] = stripe_outbox.latest(self.request.user, StripeOperation.CANCEL_SUBSCRIPTION)
+        return context
+
     def post(self, request, *args, **kwargs):
         try:
-            subscription = Subscription.objects.get(user=request.user)
-            stripe.Subscription.delete(subscription.stripe_subscription_id)
-            subscription.active = False
-            subscription.save()
-            messages.success(request, '有料会員を解約しました。', extra_tags='subscription')
-        except stripe.error.InvalidRequestError as e:
-            messages.error(request, f'サブスクリプションの解除に失敗しました: {str(e)}')
+            if stripe_outbox.has_pending(request.user, StripeOperation.CREATE_SUBSCRIPTION):
+                messages.error(request, '有料会員の登録処理中です。完了してから解約してください。')
+                return redirect('userapp:subscription')
+            with transaction.atomic():
+                subscription = Subscription.objects.select_for_update().get(user=request.user)
+                if not subscription.active:
+                    messages.info(request, '有料会員は解約済みです。', extra_tags='subscription')
+                elif stripe_outbox.has_pending(request.user, StripeOperation.CANCEL_SUBSCRIPTION):
+                    messages.info(request, '解約の処理中です。', extra_tags='subscription')
+                elif not subscription.stripe_subscription_id:
+                    # Checkout の支払いの反映（Webhook）を待っている間は、Stripe側で解約する対象が分からない
+                    messages.error(request, 'お支払いの反映を待っています。しばらくしてから解約してください。')
+                else:
+                    # Stripe側の解約はワーカーで行い、成功するまでは有料会員のままにする
+                    # （失敗したまま会員だけ外すと、Stripeの課金が続く）
+                    stripe_outbox.enqueue(StripeOperation.CANCEL_SUBSCRIPTION, {
+                        'subscription_id': subscription.stripe_subscription_id,
+                    }, user=request.user)
+                    messages.success(request, '解約を受け付けました。手続きが完了すると有料会員の特典は終了します。', extra_tags='subscription')
+        except Subscription.DoesNotExist:
+            messages.error(request, 'サブスクリプションが見つかりません。')
         except Exception as e:
             messages.error(request, f'予期しないエラーが発生しました: {str(e)}')
 
@@ -706,34 +804,33 @@ class SubscribeView(View):
 
             cardholder_name = data.get('name')
 
-            # Stripeカスタマーを作成
-            customer = stripe.Customer.create(
-                email=request.user.email,
-                source=token,
-                name=cardholder_name
-            )
-
-            # Stripeサブスクリプションを作成
-            subscription = stripe.Subscription.create(
-                customer=customer.id,
-                items=[{'price': settings.STRIPE_PRICE_ID}],
-            )
-
-            # サブスクリプションを保存
-            Subscription.objects.create(
-                user=request.user,
-                stripe_customer_id=customer.id,
-                stripe_subscription_id=subscription.id,
-                active=True
-            )
-
-            messages.success(request, 'サブスクリプションの登録が完了しました。')
-            return JsonResponse({'status': 'success'}, status=200)
-
-        except stripe.error.StripeError as e:
-            logger.error(e, exc_info=True)
-            messages.error(request, f'エラーが発生しました: {str(e)}')
-            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+            # サブスクリプションを決済待ちで保存し、Stripeカスタマー・サブスクリプションの作成はワーカーで行う
+            with transaction.atomic():
+                Subscription.objects.get_or_create(
+                    user=request.user,
+                    defaults={'stripe_customer_id': '', 'stripe_subscription_id': '', 'active': False},
+                )
+                # 行をロックしてから確認し、二重クリックなどの同時の登録で二重に課金しない
+                subscription = Subscription.objects.select_for_update().get(user=request.user)
+                if subscription.active or stripe_outbox.has_pending(
+                    request.user, StripeOperation.CREATE_SUBSCRIPTION,
+                ):
+                    return JsonResponse({'status': 'error', 'message': '既に登録済み、または登録処理中です'}, status=409)
+                # 顧客IDは残し、解約済みのサブスクリプションIDだけ消す
+                subscription.stripe_subscription_id = ''
+                subscription.save()
+                operation = stripe_outbox.enqueue(StripeOperation.CREATE_SUBSCRIPTION, {
+                    'email': request.user.email,
+                    'token': token,
+                    'name': cardholder_name,
+                    'price': settings.STRIPE_PRICE_ID,
+                }, user=request.user)
+
+            return JsonResponse({
+                'status': operation.status,
+                'poll_url': reverse('userapp:stripe_operation', args=[operation.idempotency_key]),
+            }, status=202)
+
         except Exception as e:
             logger.error(e, exc_info=True)
             messages.error(request, f'予期しないエラーが発生しました: {str(e)}')
@@ -745,26 +842,109 @@ def create_checkout_session(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            # Stripe Checkoutセッションを作成
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[
+            # Stripe Checkoutセッションの作成はワーカーで行い、画面は poll_url で完了を待つ
+            operation = stripe_outbox.enqueue(StripeOperation.CREATE_CHECKOUT_SESSION, {
+                'payment_method_types': ['card'],
+                'line_items': [
                     {
                         'price': settings.STRIPE_PRICE_ID,  # Stripeの価格ID
                         'quantity': 1,
                     },
                 ],
-                mode='subscription',
-                success_url=request.build_absolute_uri('/subscription/success/'),
-                cancel_url=request.build_absolute_uri('/subscription/cancel/'),
-            )
+                'mode': 'subscription',
+                'success_url': request.build_absolute_uri('/subscription/success/'),
+                'cancel_url': request.build_absolute_uri('/subscription/cancel/'),
+            }, user=request.user if request.user.is_authenticated else None)
             return JsonResponse({
-                'sessionId': checkout_session['id']
-            })
+                'status': operation.status,
+                'poll_url': reverse('userapp:stripe_operation', args=[operation.idempotency_key]),
+            }, status=202)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
+# Stripe処理の状態を返すビュー（画面からポーリングする）
+def stripe_operation_status(request, key):
+    operation = get_object_or_404(StripeOperation, idempotency_key=key)
+    data = stripe_outbox.status_payload(operation)
+    if operation.operation == StripeOperation.CREATE_SUBSCRIPTION and operation.status == StripeOperation.DONE:
+        data['redirect'] = reverse('userapp:subscription')
+    elif 'url' in data:
+        data['redirect'] = data['url']
+    if 'application/json' in request.headers.get('Accept', ''):
+        return JsonResponse(data)
+    # 画面で開かれた場合は、完了するまで待機ページを表示する
+    if 'redirect' in data:
+        return redirect(data['redirect'])
+    return render(request, 'userapp/stripe_operation.html', {'operation': operation, 'status': data})
+
+# 複数店舗・複数日の空き状況（JSON）
+def availability_api(request):
+    form = AvailabilityForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    people = data['people']
+    results = availability.get_availability(
+        data['shops'], data['date_from'], data['date_to'], data['start'], data['end'],
+    )
+    return JsonResponse({
+        'people': people,
+        'shops': [
+            {
+                'id': shop.pk,
+                'name': shop.name,
+                'capacity': shop.capacity,
+                'slots': [
+                    {'start': start.isoformat(), 'remaining': remaining, 'available': remaining >= people}
+                    for start, remaining in slots
+                ],
+            }
+            for shop, slots in results.items()
+        ],
+    })
+
+# 近くの店舗（JSON、近い順）
+def nearby_shops_api(request):
+    form = NearbyForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    data = form.cleaned_data
+    queryset = Shop.objects.select_related('category')
+    if data['open_at']:
+        queryset = queryset.filter(pk__in=hours.open_shop_ids(*data['open_at']))
+    shops = geo.nearby(data['lat'], data['lng'], data['radius'], queryset, limit=data['limit'])
+    return JsonResponse({
+        'shops': [
+            {
+                'id': shop.pk,
+                'name': shop.name,
+                'category': shop.category.name,
+                'address': shop.address,
+                'latitude': shop.latitude,
+                'longitude': shop.longitude,
+                'distance': round(shop.distance),
+                'url': reverse('userapp:shop_info', args=[shop.pk]),
+            }
+            for shop in shops
+        ],
+    })
+
+# Stripe Webhook の受信（イベントを保存するだけで、反映は process_stripe_events で行う）
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    try:
+        event = stripe_events.parse(request.body, request.headers.get('Stripe-Signature', ''))
+    except ImproperlyConfigured as e:
+        logger.error('Stripe Webhook を受け付けられません: %s', e)
+        return HttpResponse(status=503)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.warning('Stripe Webhook の検証に失敗しました: %s', e)
+        return HttpResponse(status=400)
+    stripe_events.store(event)
+    return HttpResponse(status=200)
+
 # 新規作成用
 class SignUpView(CreateView):
     form_class = SignUpForm
@@ -772,6 +952,6 @@ class SignUpView(CreateView):
 
     def form_valid(self, form):
         user = form.save()
-        backend = 'django.contrib.auth.backends.ModelBackend'  # ここで適切なバックエンドを指定します
+        backend = 'accounts.backends.EmailOrUsernameBackend'  # ここで適切なバックエンドを指定します
         login(self.request, user, backend=backend)
         return redirect('userapp:index')